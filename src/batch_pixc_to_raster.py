@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2017-, California Institute of Technology ("Caltech"). U.S.
+Government sponsorship acknowledged.
+All rights reserved.
+
+Author(s): Alexander Corben
+'''
+
+import os
+import time
+import shutil
+import logging
+import argparse
+import threading
+import traceback
+import multiprocessing
+
+from concurrent.futures import ThreadPoolExecutor
+from raster_cache import get_result_cache
+from pixc_to_raster import load_raster_configs, process_pixc_file, \
+    get_out_files, load_pixc_data, rasterize_pixc_data, write_outputs, \
+    get_cached_files
+
+LOGGER = logging.getLogger(__name__)
+
+description = """
+description:
+    batch_pixc_to_raster.py rasterizes many pixelclouds with one set of
+    algorithmic and runtime config files. The configs are parsed once and the
+    jobs are spread over a pool of worker processes.
+
+manifest format:
+    One job per line, whitespace separated, '#' starts a comment:
+        pixc_file  pixcvec_file  out_file
+    Use '-' as the pixcvec_file for jobs without a pixcvec.
+
+report format:
+    One line per job in manifest order:
+        status  elapsed_seconds  pixc_file  out_file  [error]
+    where status is one of done, skipped, cached or failed.
+
+result cache:
+    If the runtime config has a result_cache_dir (see pixc_to_raster.py),
+    jobs found in the cache are copied out before any job runs and are
+    reported as cached. Use --no_cache to rasterize every job.
+
+pipelined processing (--pipeline):
+    Jobs run in this process in manifest order. The inputs of the next job
+    are read and filtered on a background thread while the current job is
+    rasterized, and the outputs of the current job are written on another
+    background thread while the next job is rasterized. At most one job is
+    read ahead and one job is being written, so memory use stays at about
+    three jobs. The elapsed time of a job is measured from the start of its
+    rasterization to the end of its writes. netCDF/HDF5 is not thread-safe,
+    so the read of one job and the writes of another take turns (see
+    NC_LOCK), and only overlap with rasterization. Each product has its own
+    copy of the variable definitions (crs, TAI-UTC difference), so building
+    the next job does not change the outputs being written.
+"""
+
+NO_PIXCVEC = ['-', 'none']
+TMP_SUFFIX = '.part'
+
+# Held by the pipeline threads around all netCDF reads and writes, as
+# netCDF-C/HDF5 must not be called from several threads at once
+NC_LOCK = threading.Lock()
+
+# Configs shared by the jobs of a worker process (set by _init_worker)
+_WORKER_CONFIGS = {}
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description = description)
+    parser.add_argument("manifest_file", type=str,
+                        help='manifest of (pixc, pixcvec, output) jobs')
+    parser.add_argument("alg_config_file", type=str,
+                        help='raster algorithmic config file')
+    parser.add_argument("runtime_config_file", type=str,
+                        help='raster runtime config file')
+    parser.add_argument("-r", "--report_file", type=str, default=None,
+                        help='per-job status report file '
+                        '(default: <manifest>_report.txt)')
+    parser.add_argument("-j", "--num_procs", type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument("--overwrite", action='store_true',
+                        help='rerun jobs whose output already exists')
+    parser.add_argument("-p", "--pipeline", action='store_true',
+                        help='overlap input reads and output writes with '
+                        'rasterization (single process only)')
+    parser.add_argument("--no_cache", action='store_true',
+                        help='do not use the result cache')
+    args = parser.parse_args()
+    if args.pipeline and args.num_procs > 1:
+        parser.error('--pipeline runs in a single process, '
+                     'it cannot be combined with --num_procs > 1')
+
+    alg_cfg, rt_cfg = load_raster_configs(args.alg_config_file,
+                                          args.runtime_config_file)
+    jobs = read_manifest(args.manifest_file)
+
+    results = run_batch(jobs, alg_cfg, rt_cfg, num_procs=args.num_procs,
+                        overwrite=args.overwrite, pipeline=args.pipeline,
+                        use_cache=not args.no_cache)
+
+    report_file = args.report_file
+    if report_file is None:
+        report_file = os.path.splitext(args.manifest_file)[0] + '_report.txt'
+    write_report(report_file, results)
+
+    num_failed = sum(result['status'] == 'failed' for result in results)
+    LOGGER.info('Batch finished: {} jobs, {} failed, report: {}'.format(
+        len(results), num_failed, report_file))
+
+def read_manifest(manifest_file):
+    """Reads a job manifest into a list of
+       (pixc_file, pixcvec_file, out_file) tuples"""
+    jobs = []
+    with open(manifest_file, 'r') as manifest:
+        for line_num, line in enumerate(manifest, 1):
+            if not line.split('#', 1)[0].strip():
+                continue
+            try:
+                jobs.append(parse_job_line(line))
+            except ValueError as exception:
+                raise ValueError('Invalid manifest line {}: {}'.format(
+                    line_num, exception))
+    return jobs
+
+def parse_job_line(job_line):
+    """Parses a single manifest line into a
+       (pixc_file, pixcvec_file, out_file) tuple"""
+    fields = job_line.split('#', 1)[0].split()
+    if len(fields) != 3:
+        raise ValueError('expected 3 fields, got {}: {}'.format(
+            len(fields), job_line.strip()))
+    pixc_file, pixcvec_file, out_file = fields
+    if pixcvec_file.lower() in NO_PIXCVEC:
+        pixcvec_file = None
+    return (pixc_file, pixcvec_file, out_file)
+
+def run_batch(jobs, alg_cfg, rt_cfg, num_procs=1, overwrite=False,
+              pipeline=False, use_cache=True):
+    """Runs all jobs and returns a list of per-job results in job order"""
+    cache = get_result_cache(rt_cfg) if use_cache else None
+    results = [None]*len(jobs)
+    todo = []
+    for job_idx, job in enumerate(jobs):
+        # Skipped only if the GeoTIFF exports were written too
+        out_files = get_cached_files(job[2], rt_cfg)
+        if not overwrite and all(os.path.exists(out_file)
+                                 for out_file in out_files):
+            results[job_idx] = make_result(job, 'skipped', 0)
+        elif cache is not None and fetch_cached_job(cache, job, alg_cfg,
+                                                    rt_cfg):
+            results[job_idx] = make_result(job, 'cached', 0)
+        else:
+            todo.append((job_idx, job))
+
+    LOGGER.info('Running {} of {} jobs ({} skipped) on {} process(es)'.format(
+        len(todo), len(jobs), len(jobs)-len(todo), num_procs))
+
+    if pipeline:
+        for job_idx, result in run_pipelined(todo, alg_cfg, rt_cfg,
+                                             cache=cache):
+            results[job_idx] = result
+    elif num_procs > 1:
+        with multiprocessing.Pool(num_procs, initializer=_init_worker,
+                                  initargs=(alg_cfg, rt_cfg,
+                                            use_cache)) as pool:
+            for job_idx, result in pool.imap_unordered(
+                    _run_indexed_job, todo, chunksize=1):
+                results[job_idx] = result
+    else:
+        _init_worker(alg_cfg, rt_cfg, use_cache)
+        for job_idx, job in todo:
+            results[job_idx] = _run_indexed_job((job_idx, job))[1]
+
+    return results
+
+def fetch_cached_job(cache, job, alg_cfg, rt_cfg):
+    """Copies the outputs of a job from the result cache. Returns False if
+       the job is not cached."""
+    try:
+        return cache.fetch(cache.get_key(job[:2], alg_cfg, rt_cfg),
+                           get_cached_files(job[2], rt_cfg))
+    except OSError as exception:
+        # e.g. a missing input file, the job run reports it
+        LOGGER.warning('Result cache lookup failed for {}: {}'.format(
+            job[0], exception))
+        return False
+
+def run_job(job, alg_cfg, rt_cfg, use_cache=True):
+    """Runs a single job, writing to temporary files that are only renamed
+       to the output files on success"""
+    pixc_file, pixcvec_file, out_file = job
+    start = time.time()
+    try:
+        process_pixc_file(pixc_file, out_file, alg_cfg, rt_cfg,
+                          pixcvec_file=pixcvec_file, tmp_suffix=TMP_SUFFIX,
+                          use_cache=use_cache)
+    except Exception as exception:
+        return fail_job(job, rt_cfg, exception, time.time() - start)
+    return make_result(job, 'done', time.time() - start)
+
+def run_pipelined(indexed_jobs, alg_cfg, rt_cfg, cache=None):
+    """Runs (job_idx, job) pairs in order in this process, reading the
+       inputs of the next job and writing the outputs of the previous job on
+       background threads while the current job is rasterized. Finished
+       outputs are stored in cache if given. Yields (job_idx, result) pairs
+       as jobs finish"""
+    with ThreadPoolExecutor(1) as loader, ThreadPoolExecutor(1) as writer:
+        def submit_load(pos):
+            if pos >= len(indexed_jobs):
+                return None
+            pixc_file, pixcvec_file, _ = indexed_jobs[pos][1]
+            return loader.submit(load_job_inputs, pixc_file, pixcvec_file)
+
+        next_load = submit_load(0)
+        pending_write = None
+        for pos, (job_idx, job) in enumerate(indexed_jobs):
+            load = next_load
+            next_load = submit_load(pos + 1)
+            start = time.time()
+            try:
+                pixc_data = load.result()
+                products, _ = rasterize_pixc_data(
+                    pixc_data, job[2], alg_cfg, rt_cfg, tmp_suffix=TMP_SUFFIX)
+            except Exception as exception:
+                yield job_idx, fail_job(job, rt_cfg, exception,
+                                        time.time() - start)
+                continue
+            del pixc_data
+
+            # Hold the products of at most one job waiting to be written
+            if pending_write is not None:
+                yield finish_write(*pending_write, rt_cfg=rt_cfg)
+            pending_write = (job_idx, job, start, writer.submit(
+                write_job_outputs, job, products, alg_cfg, rt_cfg, cache))
+            del products
+
+        if pending_write is not None:
+            yield finish_write(*pending_write, rt_cfg=rt_cfg)
+
+def load_job_inputs(pixc_file, pixcvec_file):
+    """Reads the inputs of a pipelined job"""
+    with NC_LOCK:
+        return load_pixc_data(pixc_file, pixcvec_file)
+
+def write_job_outputs(job, products, alg_cfg, rt_cfg, cache=None):
+    """Writes the products of a pipelined job and stores them in cache"""
+    with NC_LOCK:
+        write_outputs(products,
+                      get_out_files(job[2], rt_cfg['raster_resolution']),
+                      rt_cfg, tmp_suffix=TMP_SUFFIX)
+    if cache is not None:
+        cache.store(cache.get_key(job[:2], alg_cfg, rt_cfg),
+                    get_cached_files(job[2], rt_cfg))
+
+def finish_write(job_idx, job, start, write, rt_cfg):
+    """Waits for the output writes of a pipelined job and returns its
+       (job_idx, result)"""
+    try:
+        write.result()
+    except Exception as exception:
+        return job_idx, fail_job(job, rt_cfg, exception, time.time() - start)
+    return job_idx, make_result(job, 'done', time.time() - start)
+
+def fail_job(job, rt_cfg, exception, elapsed):
+    """Logs a failed job, removes its temporary outputs and returns its
+       result"""
+    LOGGER.error('Job failed for {}:\n{}'.format(
+        job[0], ''.join(traceback.format_exception(
+            type(exception), exception, exception.__traceback__))))
+    for this_out_file in get_cached_files(job[2], rt_cfg):
+        if os.path.isdir(this_out_file + TMP_SUFFIX):
+            # zarr output
+            shutil.rmtree(this_out_file + TMP_SUFFIX)
+        elif os.path.exists(this_out_file + TMP_SUFFIX):
+            os.remove(this_out_file + TMP_SUFFIX)
+    return make_result(job, 'failed', elapsed, error=repr(exception))
+
+def make_result(job, status, elapsed, error=None):
+    return {'pixc_file': job[0],
+            'pixcvec_file': job[1],
+            'out_file': job[2],
+            'status': status,
+            'elapsed': elapsed,
+            'error': error}
+
+def write_report(report_file, results):
+    with open(report_file, 'w') as report:
+        for result in results:
+            fields = [result['status'], '{:.3f}'.format(result['elapsed']),
+                      result['pixc_file'], result['out_file']]
+            if result['error'] is not None:
+                fields.append(result['error'])
+            report.write('\t'.join(fields) + '\n')
+
+def _init_worker(alg_cfg, rt_cfg, use_cache=True):
+    _WORKER_CONFIGS['alg_cfg'] = alg_cfg
+    _WORKER_CONFIGS['rt_cfg'] = rt_cfg
+    _WORKER_CONFIGS['use_cache'] = use_cache
+
+def _run_indexed_job(indexed_job):
+    job_idx, job = indexed_job
+    return job_idx, run_job(job, _WORKER_CONFIGS['alg_cfg'],
+                            _WORKER_CONFIGS['rt_cfg'],
+                            use_cache=_WORKER_CONFIGS['use_cache'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2017-, California Institute of Technology ("Caltech"). U.S.
+Government sponsorship acknowledged.
+All rights reserved.
+
+Author(s): Alexander Corben
+'''
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import raster_products
+
+description = """
+description:
+    check_nc_storage.py reads a raster product and writes it again both
+    uncompressed (complevel 0, the product writer) and chunked/compressed
+    (the default RasterNcMixin.to_ncfile settings). The contents of the two
+    files (dimensions, attributes, fill values and data) are compared, as the
+    storage settings must not change them. Exits non-zero if they differ.
+"""
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description = description)
+    parser.add_argument('raster_file', help='raster product netCDF file')
+    parser.add_argument('-cl', '--complevel', type=int,
+                        default=raster_products.NC_COMPLEVEL,
+                        help='zlib level of the compressed file')
+    args = parser.parse_args()
+
+    product = get_product_class(args.raster_file).from_ncfile(
+        args.raster_file)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        plain_file = os.path.join(tmp_dir, 'plain.nc')
+        compressed_file = os.path.join(tmp_dir, 'compressed.nc')
+        product.to_ncfile(plain_file, complevel=0)
+        product.to_ncfile(compressed_file, complevel=args.complevel)
+        differences = raster_products.compare_ncfiles(plain_file,
+                                                      compressed_file)
+        print('uncompressed: {} bytes, compressed: {} bytes'.format(
+            os.path.getsize(plain_file), os.path.getsize(compressed_file)))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    for difference in differences:
+        print(difference)
+    print('{} differences'.format(len(differences)))
+    sys.exit(1 if differences else 0)
+
+def get_product_class(raster_file):
+    """Returns the raster product class of a raster file"""
+    from netCDF4 import Dataset
+    with Dataset(raster_file, 'r') as dataset:
+        utm = 'x' in dataset.dimensions
+        debug = 'classification' in dataset.variables
+    if utm:
+        if debug:
+            return raster_products.RasterUTMDebug
+        return raster_products.RasterUTM
+    if debug:
+        return raster_products.RasterGeoDebug
+    return raster_products.RasterGeo
+
+if __name__ == '__main__':
+    main()
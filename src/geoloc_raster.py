@@ -13,14 +13,9 @@ import raster
 import logging
 import argparse
 import numpy as np
-import raster_products
-import SWOTWater.aggregate as ag
-import cnes.modules.geoloc.lib.geoloc as geoloc
-import cnes.common.service_error as service_error
 
-from pixc_to_raster import load_raster_configs
-from SWOTWater.products.product import MutableProduct
-from cnes.common.lib.my_variables import GEN_RAD_EARTH_EQ, GEN_RAD_EARTH_POLE
+# Note: the SWOTWater and CNES modules are imported where they are used, so
+# they are only loaded when improved geolocation is actually computed
 
 class GeolocRaster(object):
     """
@@ -61,6 +56,7 @@ class GeolocRaster(object):
 
     def apply_improved_geoloc(self):
         """ Compute the new lat, lon, height using the new heights """
+        import cnes.common.service_error as service_error
         method = self.algorithmic_config[ \
             'lowres_raster_height_constrained_geoloc_method']
         if method == 'taylor':
@@ -73,6 +69,10 @@ class GeolocRaster(object):
         """
         Improve the height of noisy point (in object sensor)
         """
+        import SWOTWater.aggregate as ag
+        import cnes.modules.geoloc.lib.geoloc as geoloc
+        from cnes.common.lib.my_variables import \
+            GEN_RAD_EARTH_EQ, GEN_RAD_EARTH_POLE
         nb_pix = self.pixc['pixel_cloud']['height'].size
         # Convert geodetic coordinates (lat, lon, height) to cartesian coordinates (x, y, z)
         x, y, z = geoloc.convert_llh2ecef(self.pixc['pixel_cloud']['latitude'],
@@ -151,11 +151,17 @@ def geoloc_raster(pixc_prod, raster_prod, algorithmic_config):
 
 
 if __name__ == "__main__":
+    import raster_products
+    from pixc_to_raster import load_raster_configs
+    from SWOTWater.products.product import MutableProduct
+
     logging.basicConfig(level=logging.DEBUG)
     parser = argparse.ArgumentParser(
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument('pixc_file')
+    parser.add_argument('pixc_file',
+                        help='pixc file, or intermediate raster pixc .npy '
+                        'directory (see pixc_to_raster.py -if npy)')
     parser.add_argument('raster_file')
     parser.add_argument('alg_config_file')
     parser.add_argument('runtime_config_file')
@@ -165,7 +171,10 @@ if __name__ == "__main__":
     alg_cfg, rt_cfg = load_raster_configs(args.alg_config_file,
                                           args.runtime_config_file)
 
-    pixc_prod = MutableProduct.from_ncfile(args.pixc_file)
+    if os.path.isdir(args.pixc_file):
+        pixc_prod = raster_products.RasterPixc.from_npy_dir(args.pixc_file)
+    else:
+        pixc_prod = MutableProduct.from_ncfile(args.pixc_file)
 
     if rt_cfg['output_sampling_grid_type'] == 'utm':
         if alg_cfg['debug_flag']:
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2017-, California Institute of Technology ("Caltech"). U.S.
+Government sponsorship acknowledged.
+All rights reserved.
+
+Author(s): Alexander Corben
+'''
+
+import os
+import sys
+import argparse
+import subprocess
+
+description = """
+description:
+    import_budget.py measures the import time of the raster modules in a
+    fresh interpreter (python -X importtime) and checks it against a budget.
+    It also checks that heavy dependencies which are only needed by some code
+    paths are not loaded at import time. Exits non-zero if any budget is
+    exceeded.
+"""
+
+# Import time budget (ms) per module, measured in a fresh interpreter
+IMPORT_TIME_BUDGET_MS = {
+    'raster_crs': 250,
+    'raster': 250,
+    'metrics': 250,
+    'raster_products': 1500,
+    'pixc_to_raster': 2000,
+    'plot_raster_stats': 2500,
+}
+
+# Modules that must not be loaded by importing the given module
+DEFERRED_IMPORTS = {
+    'raster_crs': ['osgeo'],
+    'raster': ['osgeo', 'shapely', 'geoloc_raster', 'raster_products',
+               'SWOTWater.aggregate', 'cnes.modules.geoloc.lib.geoloc'],
+    'raster_products': ['osgeo', 'shapely'],
+    'pixc_to_raster': ['geoloc_raster', 'cnes.common.lib_lake.proc_pixc_vec',
+                       'cnes.modules.geoloc.lib.geoloc'],
+    'plot_raster_stats': ['matplotlib', 'mpl_scatter_density',
+                          'scatter_density', 'netCDF4'],
+}
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description = description)
+    parser.add_argument('modules', nargs='*',
+                        default=list(IMPORT_TIME_BUDGET_MS.keys()),
+                        help='modules to check (default: all budgeted)')
+    parser.add_argument('-n', '--num_runs', type=int, default=3,
+                        help='number of runs to take the best time of')
+    args = parser.parse_args()
+
+    over_budget = False
+    for module in args.modules:
+        import_ms = min(measure_import_ms(module)
+                        for _ in range(args.num_runs))
+        budget_ms = IMPORT_TIME_BUDGET_MS.get(module)
+        loaded = loaded_modules(module)
+        early = [name for name in DEFERRED_IMPORTS.get(module, [])
+                 if name in loaded]
+
+        status = 'ok'
+        if budget_ms is not None and import_ms > budget_ms:
+            status = 'OVER BUDGET'
+            over_budget = True
+        if early:
+            status = 'EAGER IMPORTS'
+            over_budget = True
+
+        print('{:<20s} {:8.1f} ms (budget: {} ms) {}{}'.format(
+            module, import_ms, budget_ms, status,
+            '' if not early else ': ' + ', '.join(early)))
+
+    sys.exit(1 if over_budget else 0)
+
+def measure_import_ms(module):
+    """Returns the cumulative import time of module in milliseconds"""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+        universal_newlines=True, check=True)
+    # lines look like: "import time:   self [us] | cumulative | name"
+    for line in proc.stderr.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000.
+    raise RuntimeError('Could not measure import time of {}'.format(module))
+
+def loaded_modules(module):
+    """Returns the set of module names loaded by importing module"""
+    proc = subprocess.run(
+        [sys.executable, '-c',
+         'import sys; import {}; print("\\n".join(sys.modules))'.format(module)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return set(proc.stdout.split())
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,33 @@ def metrics_fit(x, y, poly=3, pts=25):
     y_new = f(x_new)
     return x_new, y_new
 
+def metrics_fit_binned(x, y, poly=3, pts=25, bins=1000):
+    """Fits y against x as metrics_fit, but on the means of y in bins of x
+       weighted by the bin counts, so the fit cost does not grow with the
+       number of samples"""
+    x = np.ma.filled(np.ma.asarray(x, dtype=float), np.nan)
+    y = np.ma.filled(np.ma.asarray(y, dtype=float), np.nan)
+    valid = np.logical_and(np.isfinite(x), np.isfinite(y))
+    x, y = x[valid], y[valid]
+    x_min, x_max = np.min(x), np.max(x)
+    if x_max > x_min:
+        bin_idx = np.minimum(
+            ((x - x_min) / (x_max - x_min) * bins).astype(int), bins - 1)
+    else:
+        bin_idx = np.zeros(len(x), dtype=int)
+
+    counts = np.bincount(bin_idx, minlength=bins)
+    has_values = counts > 0
+    x_mean = np.bincount(bin_idx, weights=x, minlength=bins)[has_values] \
+             / counts[has_values]
+    y_mean = np.bincount(bin_idx, weights=y, minlength=bins)[has_values] \
+             / counts[has_values]
+    z = np.polyfit(x_mean, y_mean, poly, w=np.sqrt(counts[has_values]))
+    f = np.poly1d(z)
+    x_new = np.linspace(x_min, x_max, pts)
+    y_new = f(x_new)
+    return x_new, y_new
+
 def get_passfail():
     passfail = {
         '|wse_e_68_pct|': [0.10, 1],
@@ -34,12 +61,12 @@ def weighted_mean(data, weights=None):
 def weighted_percentile(data, pct, weights=None):
     if weights is None:
         weights = np.ones(len(data))
-    sorter = np.argsort(data)
+    sorter = np.argsort(data, kind='stable')
     values = data[sorter]
     weights = weights[sorter]
     weighted_pcts = np.nancumsum(weights) - 0.5 * weights
     weighted_pcts /= np.nansum(weights)
-    return np.interp(pct/100, weighted_pcts, data)
+    return np.interp(pct/100, weighted_pcts, values)
 
 def weighted_std(data, weights=None):
     mean = weighted_mean(data, weights)
@@ -79,3 +106,311 @@ def compute_metrics_from_error(err_array, weights=None, mask=None):
                                                       weights=weights)
 
     return error_metrics
+
+def grouped_metrics_from_error(err_array, group_ids, weights=None,
+                               mask=None, groups=None):
+    """Computes the compute_metrics_from_error metrics of each group of
+       err_array (e.g. per tile of a concatenated array, with the tile of
+       each error in group_ids) in one vectorized pass. Metrics are returned
+       for the given groups in order, or else for the sorted unique
+       group_ids. Returns (groups, metrics), with metrics a dict of
+       per-group arrays (NaN for groups without valid errors)."""
+    group_ids = np.asarray(group_ids)
+    if groups is None:
+        groups, segment_ids = np.unique(group_ids, return_inverse=True)
+    else:
+        groups = np.asarray(groups)
+        sorter = np.argsort(groups)
+        positions = np.clip(np.searchsorted(groups, group_ids, sorter=sorter),
+                            0, max(len(groups) - 1, 0))
+        segment_ids = sorter[positions]
+        # Errors of groups that were not asked for are ignored
+        in_groups = groups[segment_ids] == group_ids
+        mask = in_groups if mask is None else np.logical_and(mask, in_groups)
+
+    error_metrics, = compute_segmented_metrics(
+        err_array, segment_ids, len(groups), weights_list=[weights],
+        mask=mask)
+    return groups, error_metrics
+
+def compute_segmented_metrics(err_array, segment_ids, num_segments=None,
+                              weights_list=(None,), mask=None):
+    """Computes the compute_metrics_from_error metrics of each segment of
+       err_array, where segment_ids gives the segment (0 to num_segments-1)
+       of each error, for each weighting in weights_list (None for
+       unweighted). The errors and their absolute values are each sorted once
+       for all segments and weightings. Errors that are masked or NaN, and
+       errors with a NaN weight, are ignored. Returns a list (per weighting)
+       of metrics dicts of per-segment arrays, NaN for empty segments."""
+    err_array = np.ma.filled(np.ma.asarray(err_array, dtype=float), np.nan)
+    segment_ids = np.asarray(segment_ids, dtype=int)
+    if num_segments is None:
+        num_segments = segment_ids.max() + 1 if len(segment_ids) > 0 else 0
+
+    valid = ~np.isnan(err_array)
+    if mask is not None:
+        valid = np.logical_and(valid, mask)
+    err_array, segment_ids = err_array[valid], segment_ids[valid]
+
+    # Sort by segment, then by value
+    sorter = np.lexsort((err_array, segment_ids))
+    abs_sorter = np.lexsort((np.abs(err_array), segment_ids))
+
+    segment_metrics = []
+    for weights in weights_list:
+        if weights is not None:
+            weights = np.ma.filled(
+                np.ma.asarray(weights, dtype=float), np.nan)[valid]
+        segment_metrics.append(_get_segment_metrics(
+            err_array, segment_ids, num_segments, weights, sorter,
+            abs_sorter))
+    return segment_metrics
+
+def _get_segment_metrics(err_array, segment_ids, num_segments, weights,
+                         sorter, abs_sorter):
+    weighted = weights is not None
+    if weighted:
+        # Drop NaN weights, keeping the sort order
+        keep = ~np.isnan(weights)
+        sorter = sorter[keep[sorter]]
+        abs_sorter = abs_sorter[keep[abs_sorter]]
+        sum_weights = np.bincount(segment_ids[keep], weights=weights[keep],
+                                  minlength=num_segments)
+    else:
+        keep = np.ones(len(err_array), dtype=bool)
+        sum_weights = np.bincount(segment_ids,
+                                  minlength=num_segments).astype(float)
+        weights = np.ones(len(err_array))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(segment_ids[keep],
+                           weights=(weights*err_array)[keep],
+                           minlength=num_segments) / sum_weights
+        variance = np.bincount(
+            segment_ids[keep],
+            weights=(weights*(err_array - mean[segment_ids])**2)[keep],
+            minlength=num_segments) / sum_weights
+
+    error_metrics = {}
+    error_metrics['mean'] = mean
+    error_metrics['std'] = np.sqrt(variance)
+    if not weighted:
+        error_metrics['|68_pct|'] = _segmented_percentile(
+            np.abs(err_array[abs_sorter]), segment_ids[abs_sorter],
+            num_segments, 68)
+        error_metrics['50_pct'] = _segmented_percentile(
+            err_array[sorter], segment_ids[sorter], num_segments, 50)
+    else:
+        error_metrics['|68_pct|'] = _segmented_weighted_percentile(
+            np.abs(err_array[abs_sorter]), segment_ids[abs_sorter],
+            weights[abs_sorter], num_segments, 68)
+        error_metrics['50_pct'] = _segmented_weighted_percentile(
+            err_array[sorter], segment_ids[sorter], weights[sorter],
+            num_segments, 50)
+    return error_metrics
+
+def _segmented_percentile(values, segment_ids, num_segments, pct):
+    # Linear interpolation between order statistics, as np.percentile
+    counts = np.bincount(segment_ids, minlength=num_segments)
+    starts = np.cumsum(counts) - counts
+    result = np.full(num_segments, np.nan)
+    has_values = counts > 0
+    position = pct/100 * (counts[has_values] - 1)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, counts[has_values] - 1)
+    frac = position - lower
+    lower_values = values[starts[has_values] + lower]
+    upper_values = values[starts[has_values] + upper]
+    result[has_values] = lower_values + frac * (upper_values - lower_values)
+    return result
+
+def _segmented_weighted_percentile(values, segment_ids, weights, num_segments,
+                                   pct):
+    # Same interpolation as weighted_percentile, within each segment
+    counts = np.bincount(segment_ids, minlength=num_segments)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    sum_weights = np.bincount(segment_ids, weights=weights,
+                              minlength=num_segments)
+    cum_weights = np.cumsum(weights)
+    segment_cum_weights = cum_weights - np.concatenate(
+        ([0], cum_weights))[starts][segment_ids]
+    weighted_pcts = (segment_cum_weights - 0.5 * weights) \
+                    / sum_weights[segment_ids]
+
+    # Offsetting by the segment id makes the positions increase over all
+    # segments, so one search finds the percentile in every segment
+    positions = segment_ids + weighted_pcts
+    has_values = counts > 0
+    segments = np.flatnonzero(has_values)
+    upper = np.searchsorted(positions, segments + pct/100)
+    upper = np.clip(upper, starts[segments], ends[segments] - 1)
+    lower = np.maximum(upper - 1, starts[segments])
+
+    x_lower, x_upper = positions[lower], positions[upper]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.clip((segments + pct/100 - x_lower) / (x_upper - x_lower),
+                       0, 1)
+    frac[upper == lower] = 0
+    result = np.full(num_segments, np.nan)
+    result[segments] = values[lower] + frac * (values[upper] - values[lower])
+    return result
+
+QUANTILE_SKETCH_COMPRESSION = 1000
+
+class QuantileSketch(object):
+    '''Mergeable weighted quantile sketch (a merging t-digest)
+
+       Keeps weighted centroids, merging neighbouring values into at most
+       about compression centroids with a finer resolution in the tails.
+       Percentiles of unweighted values use the same interpolation as
+       np.percentile, and percentiles of weighted values the same as
+       weighted_percentile, so they are exact until the first compression.'''
+    def __init__(self, compression=QUANTILE_SKETCH_COMPRESSION):
+        self.compression = compression
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.weighted = False
+
+    def update(self, values, weights=None):
+        values = np.asarray(values, dtype=float).ravel()
+        if weights is None:
+            weights = np.ones(len(values))
+        else:
+            self.weighted = True
+        weights = np.asarray(weights, dtype=float).ravel()
+        self._add(values, weights)
+
+    def merge(self, other):
+        """Merges the centroids of another sketch into self"""
+        self.weighted = self.weighted or other.weighted
+        self._add(other.means, other.weights)
+        return self
+
+    def percentile(self, pct):
+        if len(self.means) == 0:
+            return np.nan
+        total = np.sum(self.weights)
+        if self.weighted:
+            weighted_pcts = np.cumsum(self.weights) - 0.5 * self.weights
+            weighted_pcts /= total
+            return np.interp(pct/100, weighted_pcts, self.means)
+        if total <= 1:
+            return self.means[0]
+        # The centroid weights are sample counts, interpolate between the
+        # centre ranks of the centroids as np.percentile does between samples
+        ranks = np.cumsum(self.weights) - 0.5 * (self.weights + 1)
+        return np.interp(pct/100 * (total - 1), ranks, self.means)
+
+    def _add(self, means, weights):
+        valid = np.logical_and(~np.isnan(means), weights > 0)
+        means = np.concatenate((self.means, means[valid]))
+        weights = np.concatenate((self.weights, weights[valid]))
+        sorter = np.argsort(means, kind='stable')
+        self.means, self.weights = means[sorter], weights[sorter]
+        if len(self.means) > self.compression:
+            self._compress()
+
+    def _compress(self):
+        # Centroids are grouped by the k1 scale function of their mid-rank,
+        # which keeps small groups near quantiles 0 and 1
+        total = np.sum(self.weights)
+        mid_q = (np.cumsum(self.weights) - 0.5 * self.weights) / total
+        k = self.compression/2 * (np.arcsin(2*mid_q - 1)/np.pi*2 + 1)
+        group = np.floor(k).astype(int)
+        group_weights = np.bincount(group, weights=self.weights)
+        group_sums = np.bincount(group, weights=self.weights*self.means)
+        keep = group_weights > 0
+        self.weights = group_weights[keep]
+        self.means = group_sums[keep] / self.weights
+
+
+class ErrorMetricsAccumulator(object):
+    '''Accumulates the compute_metrics_from_error metrics of many error
+       arrays without keeping the samples
+
+       The (weighted) mean and std are updated with a mergeable moments
+       update, and the percentiles come from quantile sketches of the errors
+       and of their absolute values. With exact=True the samples are kept
+       and the metrics are computed by compute_metrics_from_error.'''
+    def __init__(self, exact=False, compression=QUANTILE_SKETCH_COMPRESSION):
+        self.exact = exact
+        self.sum_weights = 0.
+        self.mean = 0.
+        self.m2 = 0.
+        self.sketch = QuantileSketch(compression)
+        self.abs_sketch = QuantileSketch(compression)
+        self.err_arrays = []
+        self.weight_arrays = []
+
+    def update(self, err_array, weights=None):
+        """Adds the (masked or nan) errors of err_array"""
+        if self.exact:
+            self.err_arrays.append(np.ma.asarray(err_array, dtype=float))
+            if weights is not None:
+                self.weight_arrays.append(np.ma.asarray(weights, dtype=float))
+            return
+
+        err_array = np.ma.filled(np.ma.asarray(err_array, dtype=float), np.nan)
+        sketch_weights = weights
+        if weights is None:
+            weights = np.ones(err_array.shape)
+        weights = np.ma.filled(np.ma.asarray(weights, dtype=float), np.nan)
+        valid = np.logical_and(~np.isnan(err_array), ~np.isnan(weights))
+        err_array, weights = err_array[valid], weights[valid]
+        sum_weights = np.sum(weights)
+        if len(err_array) == 0 or sum_weights == 0:
+            return
+
+        mean = np.sum(weights * err_array) / sum_weights
+        m2 = np.sum(weights * (err_array - mean)**2)
+        self._merge_moments(sum_weights, mean, m2)
+        # Unweighted errors keep the np.percentile interpolation
+        if sketch_weights is not None:
+            sketch_weights = weights
+        self.sketch.update(err_array, sketch_weights)
+        self.abs_sketch.update(np.abs(err_array), sketch_weights)
+
+    def merge(self, other):
+        """Merges the errors accumulated by another accumulator into self"""
+        if self.exact != other.exact:
+            raise ValueError('Cannot merge exact and approximate accumulators')
+        self.err_arrays += other.err_arrays
+        self.weight_arrays += other.weight_arrays
+        if other.sum_weights > 0:
+            self._merge_moments(other.sum_weights, other.mean, other.m2)
+        self.sketch.merge(other.sketch)
+        self.abs_sketch.merge(other.abs_sketch)
+        return self
+
+    def get_metrics(self):
+        """Returns the same metrics dict as compute_metrics_from_error
+           (with approximate percentiles once the sketches are compressed)"""
+        if self.exact:
+            if not self.err_arrays:
+                return compute_metrics_from_error(np.zeros(0))
+            weights = None
+            if self.weight_arrays:
+                weights = np.ma.concatenate(self.weight_arrays)
+            return compute_metrics_from_error(
+                np.ma.concatenate(self.err_arrays), weights=weights)
+
+        error_metrics = {}
+        if self.sum_weights == 0:
+            error_metrics['mean'] = np.nan
+            error_metrics['std'] = np.nan
+        else:
+            error_metrics['mean'] = self.mean
+            error_metrics['std'] = np.sqrt(self.m2 / self.sum_weights)
+        error_metrics['|68_pct|'] = self.abs_sketch.percentile(68)
+        error_metrics['50_pct'] = self.sketch.percentile(50)
+        return error_metrics
+
+    def _merge_moments(self, sum_weights, mean, m2):
+        # Chan et al. pairwise update of the weighted mean and variance
+        total_weights = self.sum_weights + sum_weights
+        delta = mean - self.mean
+        self.mean += delta * sum_weights / total_weights
+        self.m2 += m2 + delta**2 * self.sum_weights * sum_weights \
+                   / total_weights
+        self.sum_weights = total_weights
@@ -14,9 +14,10 @@ import raster
 import logging
 import argparse
 
-from raster_products import RasterPixc
+from raster_zarr import ZARR_BAND_ROWS
+from raster_cache import get_result_cache, replace_output
+from raster_products import RasterPixc, NC_COMPLEVEL
 from SWOTWater.products.product import MutableProduct
-from cnes.common.lib_lake.proc_pixc_vec import PixelCloudVec
 
 description = """
 description:
@@ -42,6 +43,61 @@ example runtime config parameters:
     utm_zone_adjust             (-) = 0
     mgrs_band_adjust            (-) = 0
 
+optional runtime config parameters:
+    output_nc_complevel         (-) = 4
+        zlib level of the chunked output raster variables (1-9), or 0 to
+        write the raster without chunking or compression
+    output_layout               (-) = dense
+        dense writes full rasters, sparse writes the occupied raster cell
+        indices and the packed values of each variable in those cells
+        (see raster_products.SparseRaster), and zarr writes a zarr
+        directory store in row bands while rasterizing, so the full raster
+        is never held in memory (see raster_zarr.ZarrRasterWriter)
+    output_zarr_band_rows       (-) = 256
+        raster rows per band (and per chunk) of zarr output
+    output_geotiff_variables    (-) = ['wse', 'water_frac']
+        variables to also export as cloud-optimized GeoTIFFs, written
+        next to the output raster as <out_file root>_<variable>.tif
+    result_cache_dir            (-) = /path/to/cache
+        directory of a cache of finished outputs (see
+        raster_cache.RasterResultCache). Jobs with the same input files
+        (path, size and modification time), configs and code copy their
+        outputs from the cache instead of rasterizing. Not used with
+        --bin_stats_file or --intermediate_files_dir, or with --no_cache.
+    result_cache_max_gb         (-) = 50
+        size above which the least recently used cache entries are evicted
+    geoloc_cache_dir            (-) = /path/to/geoloc_cache
+        directory of a cache of the height-constrained geolocation (see
+        raster_cache.GeolocCache), keyed by the pixc contents and the low-res
+        raster grid. Rasters of the same pixc that share the low-res grid,
+        e.g. runs whose raster_resolution / lowres_raster_scale_factor match,
+        reuse the geolocation instead of recomputing it.
+    geoloc_cache_max_gb         (-) = 20
+        size above which the least recently used cache entries are evicted
+
+multiple resolutions:
+    raster_resolution may also be a list (e.g. [100, 250, 1000]). The
+    pixelcloud is then read, geolocated and projected once and one raster is
+    written per resolution, named <out_file root>_<resolution><ext>. The
+    first resolution in the list is used for height-constrained geolocation.
+
+incremental scenes:
+    With --bin_stats_file, the per-bin statistics of the raster are kept in
+    the given file. If the file already exists, the pixelcloud is rasterized
+    on the grid stored in the file and merged into the stored statistics,
+    and the output raster is made from the merged statistics. This adds a
+    late tile to a scene without rasterizing the earlier tiles again. Pixels
+    outside of the stored grid are dropped, and a tile cannot be merged
+    twice. Only a single raster_resolution is supported in this mode.
+
+bin index sidecars:
+    With --bin_index_file, the projected pixel coordinates and raster bin
+    indices are kept in the given file (see
+    raster_bin_index.BinIndexSidecar). Later runs over the same pixc with a
+    matching output grid reload them and skip the projection, e.g. when only
+    aggregation methods or class lists change. The file is checked against
+    a checksum of the pixc lat/lon, and stale entries are recomputed.
+
 """
 
 def main():
@@ -62,29 +118,182 @@ def main():
     parser.add_argument("-id", "--intermediate_files_dir", type=str,
                         help='directory to write out intermediate files',
                         default=None)
+    parser.add_argument("-if", "--intermediate_format", type=str,
+                        choices=['nc', 'npy'], default='nc',
+                        help='intermediate pixc format: a netCDF file, or a '
+                        'directory of .npy files that can be memory mapped')
+    parser.add_argument("-bs", "--bin_stats_file", type=str,
+                        help='per-bin statistics file to merge into',
+                        default=None)
+    parser.add_argument("-bi", "--bin_index_file", type=str,
+                        help='sidecar file of projected coordinates and bin '
+                        'indices to reuse and update', default=None)
+    parser.add_argument("--no_cache", action='store_true',
+                        help='do not use the result cache')
     args = parser.parse_args()
 
     alg_cfg, rt_cfg = load_raster_configs(args.alg_config_file,
                                           args.runtime_config_file)
 
-    pixc_tile = MutableProduct.from_ncfile(args.pixc_file)
-    if args.pixcvec_file is not None:
+    process_pixc_file(args.pixc_file, args.out_file, alg_cfg, rt_cfg,
+                      pixcvec_file=args.pixcvec_file,
+                      intermediate_files_dir=args.intermediate_files_dir,
+                      intermediate_format=args.intermediate_format,
+                      bin_stats_file=args.bin_stats_file,
+                      bin_index_file=args.bin_index_file,
+                      use_cache=not args.no_cache)
+
+def process_pixc_file(pixc_file, out_file, alg_cfg, rt_cfg, pixcvec_file=None,
+                      intermediate_files_dir=None, tmp_suffix='',
+                      bin_stats_file=None, intermediate_format='nc',
+                      use_cache=True, bin_index_file=None):
+    """Rasterizes a single pixc file (and optional pixcvec file) to out_file
+       using already parsed algorithmic and runtime configs. Returns the list
+       of output files (one per raster resolution). If tmp_suffix is given,
+       each output is written to <output><tmp_suffix> and then renamed. If
+       bin_stats_file is given, the raster is merged into the per-bin
+       statistics in that file (see L2PixcToRaster.process_incremental).
+       If bin_index_file is given, the pixel binning is kept in that sidecar
+       file for later runs. If use_cache is set, the result cache of the
+       runtime config is used for jobs without side outputs."""
+    cache, cache_key = None, None
+    if use_cache and bin_stats_file is None and intermediate_files_dir is None:
+        cache = get_result_cache(rt_cfg)
+    if cache is not None:
+        cache_key = cache.get_key([pixc_file, pixcvec_file], alg_cfg, rt_cfg)
+        if cache.fetch(cache_key, get_cached_files(out_file, rt_cfg)):
+            return get_out_files(out_file, rt_cfg['raster_resolution'])
+
+    pixc_data = load_pixc_data(pixc_file, pixcvec_file)
+    products, out_files = rasterize_pixc_data(
+        pixc_data, out_file, alg_cfg, rt_cfg,
+        intermediate_files_dir=intermediate_files_dir, tmp_suffix=tmp_suffix,
+        bin_stats_file=bin_stats_file,
+        intermediate_format=intermediate_format,
+        bin_index_file=bin_index_file)
+    write_outputs(products, out_files, rt_cfg, tmp_suffix=tmp_suffix)
+    if cache is not None:
+        cache.store(cache_key, get_cached_files(out_file, rt_cfg))
+    return out_files
+
+def load_pixc_data(pixc_file, pixcvec_file=None):
+    """Reads a pixc file (and optional pixcvec file) into a RasterPixc"""
+    pixc_tile = MutableProduct.from_ncfile(pixc_file)
+    if pixcvec_file is not None:
+        # The CNES lake stack is only needed when reading pixcvec files
+        from cnes.common.lib_lake.proc_pixc_vec import PixelCloudVec
         pixcvec_tile = PixelCloudVec("SP")
-        pixcvec_tile.set_from_pixcvec_file(args.pixcvec_file)
+        pixcvec_tile.set_from_pixcvec_file(pixcvec_file)
     else:
         pixcvec_tile = None
 
-    pixc_data = RasterPixc.from_tile(pixc_tile, pixcvec_tile)
+    return RasterPixc.from_tile(pixc_tile, pixcvec_tile)
+
+def rasterize_pixc_data(pixc_data, out_file, alg_cfg, rt_cfg,
+                        intermediate_files_dir=None, tmp_suffix='',
+                        bin_stats_file=None, intermediate_format='nc',
+                        bin_index_file=None):
+    """Rasterizes a loaded RasterPixc. Returns the list of raster products
+       and the list of output files, with a None product for outputs that
+       were already written while rasterizing (zarr layout)"""
+    resolutions = get_resolutions(rt_cfg)
+    output_layout = rt_cfg.get('output_layout', 'dense')
+    if bin_stats_file is not None and len(resolutions) > 1:
+        raise ValueError(
+            'Bin stats files only support a single raster_resolution')
+    if bin_stats_file is not None and output_layout == 'zarr':
+        raise ValueError('Bin stats files do not support zarr output')
+
+    out_files = get_out_files(out_file, rt_cfg['raster_resolution'])
+    if len(resolutions) > 1:
+        rt_cfg = dict(rt_cfg, raster_resolution=resolutions[0])
 
     proc = raster.L2PixcToRaster(pixc=pixc_data, algorithmic_config=alg_cfg,
                                  runtime_config=rt_cfg)
-    product = proc.process()
+    if output_layout == 'zarr':
+        # Written while rasterizing
+        proc.process_to_zarr(
+            [this_out_file + tmp_suffix for this_out_file in out_files],
+            resolutions,
+            band_rows=rt_cfg.get('output_zarr_band_rows', ZARR_BAND_ROWS),
+            complevel=rt_cfg.get('output_nc_complevel', NC_COMPLEVEL),
+            bin_index_file=bin_index_file)
+        products = [None]*len(out_files)
+    elif bin_stats_file is not None:
+        products = [proc.process_incremental(bin_stats_file,
+                                             bin_index_file=bin_index_file)]
+    else:
+        products = proc.process_multires(resolutions,
+                                         bin_index_file=bin_index_file)
+
+    if intermediate_files_dir is not None:
+        if intermediate_format == 'npy':
+            proc.pixc.to_npy_dir(os.path.join(intermediate_files_dir,
+                                              'intermediate_raster_pixc'))
+        else:
+            proc.pixc.to_ncfile(os.path.join(intermediate_files_dir,
+                                             'intermediate_raster_pixc.nc'))
+    return products, out_files
+
+def write_outputs(products, out_files, rt_cfg, tmp_suffix=''):
+    """Writes the products from rasterize_pixc_data to their output files.
+       With a tmp_suffix, all files (rasters and GeoTIFF exports) are written
+       to temporary names and only renamed once they are all written."""
+    written_files = []
+    for product, this_out_file in zip(products, out_files):
+        if product is not None:
+            write_product(product, this_out_file + tmp_suffix, rt_cfg)
+        written_files.append(this_out_file)
+        if product is not None and rt_cfg.get('output_geotiff_variables'):
+            product.to_geotiff(os.path.splitext(this_out_file)[0],
+                               variables=rt_cfg['output_geotiff_variables'],
+                               suffix=tmp_suffix)
+            written_files += get_geotiff_files(this_out_file, rt_cfg)
+    if tmp_suffix:
+        for this_out_file in written_files:
+            # Replaces existing (zarr) output directories too
+            replace_output(this_out_file + tmp_suffix, this_out_file)
+
+def write_product(product, out_file, rt_cfg):
+    """Writes a raster product with the runtime config output settings"""
+    complevel = rt_cfg.get('output_nc_complevel', NC_COMPLEVEL)
+    output_layout = rt_cfg.get('output_layout', 'dense')
+    if output_layout == 'dense':
+        product.to_ncfile(out_file, complevel=complevel)
+    elif output_layout == 'sparse':
+        product.to_sparse().to_ncfile(out_file, complevel=complevel)
+    else:
+        raise ValueError('Invalid output_layout: {}'.format(output_layout))
+
+def get_resolutions(rt_cfg):
+    """Returns the list of raster resolutions in a runtime config"""
+    if isinstance(rt_cfg['raster_resolution'], (list, tuple)):
+        return list(rt_cfg['raster_resolution'])
+    return [rt_cfg['raster_resolution']]
+
+def get_out_files(out_file, raster_resolution):
+    """Returns the output file names for a single raster resolution or a
+       list of raster resolutions"""
+    if not isinstance(raster_resolution, (list, tuple)):
+        return [out_file]
+    root, ext = os.path.splitext(out_file)
+    return ['{}_{:g}{}'.format(root, resolution, ext)
+            for resolution in raster_resolution]
 
-    if args.intermediate_files_dir is not None:
-        proc.pixc.to_ncfile(os.path.join(args.intermediate_files_dir,
-                                         'intermediate_raster_pixc.nc'))
+def get_cached_files(out_file, rt_cfg):
+    """Returns all files written for out_file: the output rasters and any
+       GeoTIFF exports"""
+    out_files = get_out_files(out_file, rt_cfg['raster_resolution'])
+    cached_files = list(out_files)
+    if rt_cfg.get('output_layout', 'dense') != 'zarr':
+        for this_out_file in out_files:
+            cached_files += get_geotiff_files(this_out_file, rt_cfg)
+    return cached_files
 
-    product.to_ncfile(args.out_file)
+def get_geotiff_files(out_file, rt_cfg):
+    """Returns the GeoTIFF exports of an output raster file"""
+    return ['{}_{}.tif'.format(os.path.splitext(out_file)[0], name)
+            for name in rt_cfg.get('output_geotiff_variables') or []]
 
 def load_raster_configs(alg_config_file, runtime_config_file):
     alg_cfg = RDF.RDF()
@@ -105,7 +314,8 @@ def load_raster_configs(alg_config_file, runtime_config_file):
 
     # Typecast most config values with eval (except strings)
     for key in rt_cfg.keys():
-        if key in ['output_sampling_grid_type']:
+        if key in ['output_sampling_grid_type', 'output_layout',
+                   'result_cache_dir', 'geoloc_cache_dir']:
             continue
         rt_cfg[key] = ast.literal_eval(rt_cfg[key])
 
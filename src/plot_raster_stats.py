@@ -9,21 +9,47 @@ Author(s): Alexander Corben
 '''
 
 import os
+import re
+import sys
 import glob
-import scipy
+import json
+import pickle
+import hashlib
 import argparse
+import functools
+import multiprocessing
 import numpy as np
-import raster_products
-import matplotlib.pyplot as plt
 import SWOTRiver.analysis.tabley
-from scatter_density import scatter_density
 from metrics import *
 
 from pathlib import Path
-from SWOTWater.products.product import MutableProduct
 
 import warnings
 
+# Raster variables read by load_data from the truth and processed rasters.
+# The tile metrics use all of them, so the load_data filters need no more
+TRUTH_VARIABLES = ['wse', 'water_area', 'water_frac', 'dark_frac',
+                   'cross_track']
+DATA_VARIABLES = ['wse', 'wse_uncert', 'water_area', 'water_area_uncert',
+                  'water_frac', 'dark_frac', 'n_wse_pix', 'n_area_pix']
+
+# Tile metrics summed for the global pixel counts
+PIX_COUNT_KEYS = ['total_wse_pix', 'common_wse_pix', 'uncommon_wse_pix_truth',
+                  'uncommon_wse_pix_data', 'total_area_pix', 'common_area_pix',
+                  'uncommon_area_pix_truth', 'uncommon_area_pix_data']
+
+# Number of tile pixels to compute the tile table rows of at once
+TILE_CHUNK_PIXELS = 10000000
+
+# Number of samples above which --scatter_plot draws the points as a density
+# image instead of markers
+SCATTER_MAX_POINTS = 100000
+
+# Tile metrics arrays that are concatenated for plotting
+PLOT_KEYS = ['dark_frac', 'dark_frac_err', 'water_frac', 'water_frac_err',
+             'wse_err', 'wse_uncert', 'area_perc_err', 'area_perc_uncert',
+             'cross_track', 'n_wse_pix']
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('proc_raster', type=str, default=None,
@@ -58,9 +84,31 @@ def main():
     parser.add_argument('-e', '--exclude_scenes', default=[], nargs='+',
                         help='List of sim scenes to exclude')
     parser.add_argument('--scatter_plot', action='store_true',
-                        help='Flag for plotting old scatterplots')
+                        help='Flag for plotting old scatterplots (as '
+                        'density images above {} points)'.format(
+                            SCATTER_MAX_POINTS))
+    parser.add_argument('--no_plot', action='store_true',
+                        help='Flag to only print the metric tables')
+    parser.add_argument('-j', '--num_procs', type=int, default=1,
+                        help='Number of processes to load tile pairs and '
+                        'save plots with')
+    parser.add_argument('-pd', '--plot_dir', type=str, default=None,
+                        help='Directory to save the plots to as png files, '
+                        'without a display, instead of showing them')
+    parser.add_argument('-mc', '--metrics_cache_dir', type=str, default=None,
+                        help='Directory to cache per-tile metrics in, so '
+                        'reruns only load new or modified tile pairs')
+    parser.add_argument('--exact_global_metrics', action='store_true',
+                        help='Keep all samples to compute exact global '
+                        'percentiles instead of streaming quantile sketches')
     args = vars(parser.parse_args())
 
+    load_kwargs = {key: args[key] for key in
+                   ['dark_frac_thresh', 'water_frac_thresh',
+                    'wse_uncert_thresh', 'area_uncert_thresh',
+                    'cross_track_bounds', 'min_wse_pixels',
+                    'min_area_pixels']}
+
     metrics = []
     if args['basedir'] is not None:
         if args['slc_basename'] is None or args['pixc_basename'] is None:
@@ -97,6 +145,7 @@ def main():
         truth_raster_list = [os.path.join(truth_raster, 'raster_data', 'raster.nc')
                              if os.path.isdir(truth_raster) else truth_raster
                              for truth_raster in truth_raster_list]
+        tile_pairs = []
         for proc_raster, truth_raster in zip(proc_raster_list, truth_raster_list):
             if os.path.isfile(proc_raster) and os.path.isfile(truth_raster):
                 if args['pixc_errors_basename'] is not None:
@@ -108,17 +157,13 @@ def main():
                     print('Not analyzing sim scene: {}'.format(sim_scene))
                     continue
 
-                # call the function to do the work
-                tile_metrics = load_data(
-                    proc_raster, truth_raster, sim_scene=sim_scene,
-                    dark_frac_thresh=args['dark_frac_thresh'],
-                    water_frac_thresh=args['water_frac_thresh'],
-                    wse_uncert_thresh=args['wse_uncert_thresh'],
-                    area_uncert_thresh=args['area_uncert_thresh'],
-                    cross_track_bounds=args['cross_track_bounds'],
-                    min_wse_pixels=args['min_wse_pixels'],
-                    min_area_pixels=args['min_area_pixels'])
-                metrics.append(tile_metrics)
+                tile_pairs.append((proc_raster, truth_raster, sim_scene))
+
+        # call the function to do the work, tiles are loaded as
+        # print_metrics consumes them
+        metrics = iter_all_data(tile_pairs, num_procs=args['num_procs'],
+                                cache_dir=args['metrics_cache_dir'],
+                                **load_kwargs)
     else:
         # Inputs can be either raster files, or basenames
         proc_raster = args['proc_raster']
@@ -129,15 +174,9 @@ def main():
             truth_raster = os.path.join(truth_raster, 'raster_data', 'raster.nc')
 
         # call the function to do the work
-        tile_metrics = load_data(
-            proc_raster, truth_raster,
-            dark_frac_thresh=args['dark_frac_thresh'],
-            water_frac_thresh=args['water_frac_thresh'],
-            wse_uncert_thresh=args['wse_uncert_thresh'],
-            area_uncert_thresh=args['area_uncert_thresh'],
-            cross_track_bounds=args['cross_track_bounds'],
-            min_wse_pixels=args['min_wse_pixels'],
-            min_area_pixels=args['min_area_pixels'])
+        tile_metrics = load_cached_data(proc_raster, truth_raster,
+                                        cache_dir=args['metrics_cache_dir'],
+                                        **load_kwargs)
         metrics.append(tile_metrics)
 
     print('\033[93m' + 'Accumulating Metrics:' + '\033[00m')
@@ -165,7 +204,86 @@ def main():
 
     print_metrics(metrics,
                   weighted=args['weighted'],
-                  scatter_plot=args['scatter_plot'])
+                  scatter_plot=args['scatter_plot'],
+                  plot=not args['no_plot'],
+                  exact=args['exact_global_metrics'],
+                  plot_dir=args['plot_dir'],
+                  num_procs=args['num_procs'])
+
+def iter_all_data(tile_pairs, num_procs=1, cache_dir=None, **load_kwargs):
+    '''
+    run load_data on a list of (proc_raster, truth_raster, sim_scene) tile
+    pairs over a pool of num_procs processes, yielding the tile metrics in
+    tile pair order as they are loaded (see load_cached_data for cache_dir)
+    '''
+    load_tile_pair = functools.partial(_load_tile_pair, cache_dir,
+                                       load_kwargs)
+    if num_procs > 1 and len(tile_pairs) > 1:
+        with multiprocessing.Pool(min(num_procs, len(tile_pairs))) as pool:
+            # imap keeps the tile pair order
+            for num_done, tile_metrics in enumerate(
+                    pool.imap(load_tile_pair, tile_pairs), 1):
+                print_progress(num_done, len(tile_pairs))
+                yield tile_metrics
+    else:
+        for num_done, tile_pair in enumerate(tile_pairs, 1):
+            tile_metrics = load_tile_pair(tile_pair)
+            print_progress(num_done, len(tile_pairs))
+            yield tile_metrics
+
+def _load_tile_pair(cache_dir, load_kwargs, tile_pair):
+    proc_raster, truth_raster, sim_scene = tile_pair
+    return load_cached_data(proc_raster, truth_raster, sim_scene=sim_scene,
+                            cache_dir=cache_dir, **load_kwargs)
+
+def load_cached_data(proc_raster_file, truth_raster_file, sim_scene='',
+                     cache_dir=None, **load_kwargs):
+    '''
+    load_data, with the tile metrics cached in cache_dir (if given) keyed by
+    the raster paths and modification times, the sim scene, the filter
+    arguments and this script's source
+    '''
+    if cache_dir is None:
+        return load_data(proc_raster_file, truth_raster_file,
+                         sim_scene=sim_scene, **load_kwargs)
+
+    cache_file = os.path.join(cache_dir, get_metrics_cache_key(
+        proc_raster_file, truth_raster_file, sim_scene, load_kwargs) + '.pkl')
+    try:
+        with open(cache_file, 'rb') as cache_fp:
+            return pickle.load(cache_fp)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    tile_metrics = load_data(proc_raster_file, truth_raster_file,
+                             sim_scene=sim_scene, **load_kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_cache_file = '{}.{}.part'.format(cache_file, os.getpid())
+    with open(tmp_cache_file, 'wb') as cache_fp:
+        pickle.dump(tile_metrics, cache_fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_cache_file, cache_file)
+    return tile_metrics
+
+def get_metrics_cache_key(proc_raster_file, truth_raster_file, sim_scene,
+                          load_kwargs):
+    key_data = {'sim_scene': sim_scene, 'load_kwargs': load_kwargs,
+                'files': []}
+    for filename in [proc_raster_file, truth_raster_file]:
+        stat = os.stat(filename)
+        key_data['files'].append(
+            [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns])
+    key_hash = hashlib.sha256(json.dumps(
+        key_data, sort_keys=True, default=repr).encode())
+    # Changes to the metrics code invalidate the cache
+    with open(os.path.abspath(__file__), 'rb') as src_fp:
+        key_hash.update(src_fp.read())
+    return key_hash.hexdigest()
+
+def print_progress(num_done, num_total):
+    sys.stderr.write('\rLoaded {}/{} tile pairs'.format(num_done, num_total))
+    if num_done == num_total:
+        sys.stderr.write('\n')
+    sys.stderr.flush()
 
 def load_data(
         proc_raster_file, truth_raster_file, sim_scene='', dark_frac_thresh=None,
@@ -176,8 +294,8 @@ def load_data(
     and accumulate the data, truth and metrics (if input)
     '''
 
-    truth_tmp = MutableProduct.from_ncfile(truth_raster_file)
-    data_tmp = MutableProduct.from_ncfile(proc_raster_file)
+    truth_tmp = RasterVariables.from_ncfile(truth_raster_file, TRUTH_VARIABLES)
+    data_tmp = RasterVariables.from_ncfile(proc_raster_file, DATA_VARIABLES)
 
     tile_metrics = {}
     tile_metrics['sim_scene'] = str(sim_scene)
@@ -247,7 +365,7 @@ def load_data(
 
         if area_uncert_thresh is not None:
             tmp_mask = np.logical_and(
-                tmp_mask, data_tmp['area_uncert'] <= area_uncert_thresh)
+                tmp_mask, data_tmp['water_area_uncert'] <= area_uncert_thresh)
 
         if cross_track_bounds is not None:
             tmp_mask = np.logical_and.reduce(
@@ -304,22 +422,73 @@ def load_data(
 
     return tile_metrics
 
+
+class RasterVariables(dict):
+    '''
+    the global attributes and a subset of the variables of a raster file,
+    read without loading the rest of the product
+    '''
+    @classmethod
+    def from_ncfile(cls, filename, variables):
+        from netCDF4 import Dataset
+        raster = cls()
+        with Dataset(filename, 'r') as dataset:
+            for name in dataset.ncattrs():
+                setattr(raster, name, dataset.getncattr(name))
+            for name in variables:
+                values = dataset.variables[name][:]
+                # Full masks, so .mask can be indexed like the values
+                raster[name] = np.ma.masked_array(
+                    values, mask=np.ma.getmaskarray(values))
+        return raster
+
+
 def print_metrics(metrics, dark_thresh=None, water_thresh=None,
                   wse_uncert_thresh=None, cross_track_bounds=None,
-                  weighted=False, scatter_plot=False):
+                  weighted=False, scatter_plot=False, plot=True, exact=False,
+                  plot_dir=None, num_procs=1):
+    # metrics may be any iterable of tile metrics, it is read once. Global
+    # metrics are accumulated tile by tile (see ErrorMetricsAccumulator), so
+    # the tile samples are only kept when plotting. exact keeps them to
+    # compute exact global percentiles. Plots are saved to plot_dir if
+    # given (see plot_metrics).
     # Get pass/fail bounds
     passfail = get_passfail()
 
     # Tile-by-Tile metrics
     tile_table = {}
     tile_table_normalized = {}
+    global_accumulators = {key: ErrorMetricsAccumulator(exact=exact)
+                           for key in ['wse', 'area', 'wse_normalized',
+                                       'area_normalized']}
+    pix_counts = {key: [] for key in PIX_COUNT_KEYS}
+    plot_arrays = {key: [] for key in PLOT_KEYS}
+    sources = []
+    # Tile table rows are computed for chunks of tiles at once
+    tile_chunk = []
+    chunk_pixels = 0
     for tile_metrics in metrics:
-        tile_table = append_tile_table(tile_metrics, tile_table,
-                                       inverse_variance_weight=weighted)
-        tile_table_normalized = append_tile_table(tile_metrics, tile_table_normalized,
-                                                  wse_prefix='wse_e/wse_u_',
-                                                  area_prefix='a_%e/a_%u_',
-                                                  normalize_by_uncert=True)
+        tile_chunk.append(tile_metrics)
+        chunk_pixels += len(tile_metrics['wse_err'])
+        if chunk_pixels >= TILE_CHUNK_PIXELS:
+            tile_table, tile_table_normalized = append_tile_tables(
+                tile_chunk, tile_table, tile_table_normalized,
+                weighted=weighted)
+            tile_chunk = []
+            chunk_pixels = 0
+        update_global_accumulators(global_accumulators, tile_metrics,
+                                   weighted=weighted)
+        for key in PIX_COUNT_KEYS:
+            pix_counts[key].append(tile_metrics[key])
+        if plot:
+            for key in PLOT_KEYS:
+                plot_arrays[key].append(tile_metrics[key])
+            sources.append((tile_metrics['sim_scene'] + '_'
+                            + tile_metrics['tile_names'],
+                            len(tile_metrics['cross_track'])))
+    if tile_chunk:
+        tile_table, tile_table_normalized = append_tile_tables(
+            tile_chunk, tile_table, tile_table_normalized, weighted=weighted)
 
     if weighted:
         weight_desc = 'inverse variance weight'
@@ -363,44 +532,19 @@ def print_metrics(metrics, dark_thresh=None, water_thresh=None,
     SWOTRiver.analysis.tabley.print_table(tile_table_area, precision=5,
                                           passfail=passfail)
 
-    # Concatenate tiles for global metrics
-    all_dark_frac = np.ma.concatenate(tuple(tile_metrics['dark_frac'] for tile_metrics in metrics))
-    all_dark_frac_err = np.ma.concatenate(tuple(tile_metrics['dark_frac_err'] for tile_metrics in metrics))
-    all_water_frac = np.ma.concatenate(tuple(tile_metrics['water_frac'] for tile_metrics in metrics))
-    all_water_frac_err = np.ma.concatenate(tuple(tile_metrics['water_frac_err'] for tile_metrics in metrics))
-    all_wse_err = np.ma.concatenate(tuple(tile_metrics['wse_err'] for tile_metrics in metrics))
-    all_wse_uncert = np.ma.concatenate(tuple(tile_metrics['wse_uncert'] for tile_metrics in metrics))
-    all_area_perc_err = np.ma.concatenate(tuple(tile_metrics['area_perc_err'] for tile_metrics in metrics))
-    all_area_perc_uncert = np.ma.concatenate(tuple(tile_metrics['area_perc_uncert'] for tile_metrics in metrics))
-    all_cross_track = np.ma.concatenate(tuple(tile_metrics['cross_track'] for tile_metrics in metrics))
-    all_n_wse_pix = np.ma.concatenate(tuple(tile_metrics['n_wse_pix'] for tile_metrics in metrics))
-    total_wse_pix = [tile_metrics['total_wse_pix'] for tile_metrics in metrics]
-    common_wse_pix = [tile_metrics['common_wse_pix'] for tile_metrics in metrics]
-    uncommon_wse_pix_truth = [tile_metrics['uncommon_wse_pix_truth'] for tile_metrics in metrics]
-    uncommon_wse_pix_data = [tile_metrics['uncommon_wse_pix_data'] for tile_metrics in metrics]
-    total_area_pix = [tile_metrics['total_area_pix'] for tile_metrics in metrics]
-    common_area_pix = [tile_metrics['common_area_pix'] for tile_metrics in metrics]
-    uncommon_area_pix_truth = [tile_metrics['uncommon_area_pix_truth'] for tile_metrics in metrics]
-    uncommon_area_pix_data = [tile_metrics['uncommon_area_pix_data'] for tile_metrics in metrics]
-    all_sim_scenes = np.array([tile_metrics['sim_scene'] + '_' + tile_metrics['tile_names']
-                           for tile_metrics in metrics
-                           for i in range(len(tile_metrics['cross_track']))])
     # Global metrics
-    total_wse_pix_count = np.sum(total_wse_pix)
-    common_wse_pix_pct = np.sum(common_wse_pix)/total_wse_pix_count * 100
-    uncommon_wse_pix_truth_pct = np.sum(uncommon_wse_pix_truth)/total_wse_pix_count * 100
-    uncommon_wse_pix_data_pct = np.sum(uncommon_wse_pix_data)/total_wse_pix_count * 100
-    total_area_pix_count = np.sum(total_area_pix)
-    common_area_pix_pct = np.sum(common_area_pix)/total_area_pix_count * 100
-    uncommon_area_pix_truth_pct = np.sum(uncommon_area_pix_truth)/total_area_pix_count * 100
-    uncommon_area_pix_data_pct = np.sum(uncommon_area_pix_data)/total_area_pix_count * 100
-
-    if weighted:
-        global_table = make_global_table(all_wse_err, all_area_perc_err,
-                                         wse_weight=1/np.square(all_wse_uncert),
-                                         area_weight=1/np.square(all_area_perc_uncert))
-    else:
-        global_table = make_global_table(all_wse_err, all_area_perc_err)
+    total_wse_pix_count = np.sum(pix_counts['total_wse_pix'])
+    common_wse_pix_pct = np.sum(pix_counts['common_wse_pix'])/total_wse_pix_count * 100
+    uncommon_wse_pix_truth_pct = np.sum(pix_counts['uncommon_wse_pix_truth'])/total_wse_pix_count * 100
+    uncommon_wse_pix_data_pct = np.sum(pix_counts['uncommon_wse_pix_data'])/total_wse_pix_count * 100
+    total_area_pix_count = np.sum(pix_counts['total_area_pix'])
+    common_area_pix_pct = np.sum(pix_counts['common_area_pix'])/total_area_pix_count * 100
+    uncommon_area_pix_truth_pct = np.sum(pix_counts['uncommon_area_pix_truth'])/total_area_pix_count * 100
+    uncommon_area_pix_data_pct = np.sum(pix_counts['uncommon_area_pix_data'])/total_area_pix_count * 100
+
+    global_table = make_global_table_from_metrics(
+        global_accumulators['wse'].get_metrics(),
+        global_accumulators['area'].get_metrics())
 
     global_table['total_wse_pix'] = [total_wse_pix_count]
     global_table['common_wse_pix_%'] = [common_wse_pix_pct]
@@ -427,10 +571,10 @@ def print_metrics(metrics, dark_thresh=None, water_thresh=None,
     SWOTRiver.analysis.tabley.print_table(global_table_area, precision=5,
                                           passfail=passfail)
 
-    global_table_weighted = make_global_table(all_wse_err/all_wse_uncert,
-                                              all_area_perc_err/all_area_perc_uncert,
-                                              wse_prefix='wse_e/wse_u_',
-                                              area_prefix='a_%e/a_%u_')
+    global_table_weighted = make_global_table_from_metrics(
+        global_accumulators['wse_normalized'].get_metrics(),
+        global_accumulators['area_normalized'].get_metrics(),
+        wse_prefix='wse_e/wse_u_', area_prefix='a_%e/a_%u_')
 
     global_table_weighted['total_wse_pix'] = [total_wse_pix_count]
     global_table_weighted['common_wse_pix_%'] = [common_wse_pix_pct]
@@ -457,6 +601,25 @@ def print_metrics(metrics, dark_thresh=None, water_thresh=None,
     SWOTRiver.analysis.tabley.print_table(global_table_area_weighted, precision=5,
                                           passfail=passfail)
 
+    if not plot:
+        return
+
+    # Concatenate tiles for plotting
+    all_arrays = {key: np.ma.concatenate(tuple(plot_arrays[key]))
+                  for key in PLOT_KEYS}
+    all_dark_frac = all_arrays['dark_frac']
+    all_dark_frac_err = all_arrays['dark_frac_err']
+    all_water_frac = all_arrays['water_frac']
+    all_water_frac_err = all_arrays['water_frac_err']
+    all_wse_err = all_arrays['wse_err']
+    all_wse_uncert = all_arrays['wse_uncert']
+    all_area_perc_err = all_arrays['area_perc_err']
+    all_area_perc_uncert = all_arrays['area_perc_uncert']
+    all_cross_track = all_arrays['cross_track']
+    all_n_wse_pix = all_arrays['n_wse_pix']
+    all_sim_scenes = np.repeat([source for source, _ in sources],
+                               [count for _, count in sources])
+
     metrics_to_plot = {'WSE Error (m)':all_wse_err,
                        'Area Percent Error (%)':all_area_perc_err,
                        'Water Fraction Error (%)':all_water_frac_err*100,
@@ -473,12 +636,58 @@ def print_metrics(metrics, dark_thresh=None, water_thresh=None,
                                'Water Fraction (%)':all_water_frac*100}
 
     plot_metrics(metrics_to_plot, metrics_to_plot_against,
-        uncert_to_plot=uncert_to_plot, sources=all_sim_scenes, scatter_plot=scatter_plot)
+        uncert_to_plot=uncert_to_plot, sources=all_sim_scenes, scatter_plot=scatter_plot,
+        plot_dir=plot_dir, num_procs=num_procs)
 
-def append_tile_table(tile_metrics, tile_table={},
-                      wse_prefix='wse_e_', area_prefix='a_%e_',
-                      inverse_variance_weight=False, normalize_by_uncert=False):
+def append_tile_tables(tile_metrics_list, tile_table, tile_table_normalized,
+                       weighted=False):
+    '''
+    append the rows of several tiles to the tile table and the normalized
+    tile table, with the metrics of all tiles computed in one pass
+    '''
+    tile_ids = np.concatenate([np.full(len(tile_metrics['wse_err']), tile_id)
+                               for tile_id, tile_metrics
+                               in enumerate(tile_metrics_list)])
+    tiles = np.arange(len(tile_metrics_list))
+    def concatenate(key):
+        return np.ma.concatenate(tuple(tile_metrics[key] for tile_metrics
+                                       in tile_metrics_list))
+    wse_err = concatenate('wse_err')
+    wse_uncert = concatenate('wse_uncert')
+    area_perc_err = concatenate('area_perc_err')
+    area_perc_uncert = concatenate('area_perc_uncert')
 
+    wse_weight = None
+    area_weight = None
+    if weighted:
+        wse_weight = 1/np.square(wse_uncert)
+        area_weight = 1/np.square(area_perc_uncert)
+
+    _, wse_err_metrics = grouped_metrics_from_error(
+        wse_err, tile_ids, weights=wse_weight, groups=tiles)
+    _, area_err_metrics = grouped_metrics_from_error(
+        area_perc_err, tile_ids, weights=area_weight, groups=tiles)
+    _, wse_norm_metrics = grouped_metrics_from_error(
+        wse_err/wse_uncert, tile_ids, groups=tiles)
+    _, area_norm_metrics = grouped_metrics_from_error(
+        area_perc_err/area_perc_uncert, tile_ids, groups=tiles)
+
+    for tile_id, tile_metrics in enumerate(tile_metrics_list):
+        tile_table = append_tile_row(
+            tile_metrics, get_group_metrics(wse_err_metrics, tile_id),
+            get_group_metrics(area_err_metrics, tile_id), tile_table)
+        tile_table_normalized = append_tile_row(
+            tile_metrics, get_group_metrics(wse_norm_metrics, tile_id),
+            get_group_metrics(area_norm_metrics, tile_id),
+            tile_table_normalized, wse_prefix='wse_e/wse_u_',
+            area_prefix='a_%e/a_%u_')
+    return tile_table, tile_table_normalized
+
+def get_group_metrics(grouped_metrics, group_idx):
+    return {key: values[group_idx] for key, values in grouped_metrics.items()}
+
+def append_tile_row(tile_metrics, wse_err_metrics, area_err_metrics,
+                    tile_table={}, wse_prefix='wse_e_', area_prefix='a_%e_'):
     if not tile_table:
         tile_table = {wse_prefix + 'mean':[],
                       wse_prefix + 'std':[],
@@ -500,23 +709,6 @@ def append_tile_table(tile_metrics, tile_table={},
                       'cycle':[],
                       'tile_names':[],}
 
-    wse_err = tile_metrics['wse_err']
-    area_perc_err = tile_metrics['area_perc_err']
-    if normalize_by_uncert:
-        wse_err = wse_err/tile_metrics['wse_uncert']
-        area_perc_err = area_perc_err/tile_metrics['area_perc_uncert']
-
-    wse_weight = None
-    area_weight = None
-    if inverse_variance_weight:
-        wse_weight = 1/np.square(tile_metrics['wse_uncert'])
-        area_weight = 1/np.square(tile_metrics['area_perc_uncert'])
-
-    wse_err_metrics = compute_metrics_from_error(
-        wse_err, weights=wse_weight)
-    area_err_metrics = compute_metrics_from_error(
-        area_perc_err, weights=area_weight)
-
     # Add data to table
     tile_table[wse_prefix + 'mean'].append(wse_err_metrics['mean'])
     tile_table[wse_prefix + 'std'].append(wse_err_metrics['std'])
@@ -558,16 +750,24 @@ def append_tile_table(tile_metrics, tile_table={},
     tile_table['tile_names'].append(tile_metrics['tile_names'])
     return tile_table
 
-def make_global_table(all_wse_err, all_area_perc_err,
-                      wse_weight=None, area_weight=None,
-                      wse_prefix='wse_e_', area_prefix='a_%e_', mask=None):
-    wse_err_metrics = compute_metrics_from_error(all_wse_err,
-                                                    weights=wse_weight,
-                                                    mask=mask)
-    area_err_metrics = compute_metrics_from_error(all_area_perc_err,
-                                                  weights=area_weight,
-                                                  mask=mask)
-
+def update_global_accumulators(global_accumulators, tile_metrics,
+                               weighted=False):
+    wse_weight = None
+    area_weight = None
+    if weighted:
+        wse_weight = 1/np.square(tile_metrics['wse_uncert'])
+        area_weight = 1/np.square(tile_metrics['area_perc_uncert'])
+    global_accumulators['wse'].update(tile_metrics['wse_err'],
+                                      weights=wse_weight)
+    global_accumulators['area'].update(tile_metrics['area_perc_err'],
+                                       weights=area_weight)
+    global_accumulators['wse_normalized'].update(
+        tile_metrics['wse_err']/tile_metrics['wse_uncert'])
+    global_accumulators['area_normalized'].update(
+        tile_metrics['area_perc_err']/tile_metrics['area_perc_uncert'])
+
+def make_global_table_from_metrics(wse_err_metrics, area_err_metrics,
+                                   wse_prefix='wse_e_', area_prefix='a_%e_'):
     global_table = {}
     global_table[wse_prefix + 'mean'] = [wse_err_metrics['mean']]
     global_table[wse_prefix + 'std'] = [wse_err_metrics['std']]
@@ -581,59 +781,191 @@ def make_global_table(all_wse_err, all_area_perc_err,
     return global_table
 
 def plot_metrics(metrics_to_plot, metrics_to_plot_against,
-                 uncert_to_plot=None, poly=2, sources=None, scatter_plot=False):
+                 uncert_to_plot=None, poly=2, sources=None, scatter_plot=False,
+                 plot_dir=None, num_procs=1):
+    # Plots are shown interactively, or saved to plot_dir with a
+    # non-interactive backend by a pool of num_procs processes
+    if plot_dir is not None:
+        import matplotlib
+        matplotlib.use('Agg')
+
+    # Plotting libraries are only loaded when plots are requested
+    import matplotlib.pyplot as plt
+
+    plot_data = {'metrics_to_plot': metrics_to_plot,
+                 'metrics_to_plot_against': metrics_to_plot_against,
+                 'uncert_to_plot': uncert_to_plot,
+                 'poly': poly,
+                 'sources': sources,
+                 'scatter_plot': scatter_plot,
+                 'axis_bins': None}
+    if not scatter_plot:
+        plot_data['axis_bins'] = get_axis_bins(metrics_to_plot,
+                                               metrics_to_plot_against)
+    plot_pairs = [(y_key, x_key) for y_key in metrics_to_plot
+                  for x_key in metrics_to_plot_against if x_key != y_key]
+
     warnings.simplefilter("ignore")
-    for y_key in metrics_to_plot:
-        for x_key in metrics_to_plot_against:
-            if x_key != y_key:
-                mask = np.logical_and(~np.isnan(metrics_to_plot[y_key]),
-                                      ~np.isnan(metrics_to_plot_against[x_key]))
-                this_y_data = metrics_to_plot[y_key][mask]
-                this_x_data = metrics_to_plot_against[x_key][mask]
-                this_uncert = None
-                if uncert_to_plot is not None:
-                    if uncert_to_plot[y_key] is not None:
-                        this_uncert = uncert_to_plot[y_key][mask]
-
-                if scatter_plot:
-                    plt.figure()
-                    plt.title('{} vs. {}'.format(y_key, x_key))
-                    plt.xlabel(x_key)
-                    plt.ylabel(y_key)
-                    plt.scatter(this_x_data, this_y_data,
-                                marker='o', s=1)
-                    try:
-                        x_new, y_new = metrics_fit(this_x_data, this_y_data,
-                                                   poly=poly, pts=25)
-                        plt.plot(x_new, y_new, 'r--')
-                        sig_mask = std_mask(this_y_data, 1)
-                        x_new, y_new = metrics_fit(this_x_data[sig_mask],
-                                                   this_y_data[sig_mask],
-                                                   poly=poly, pts=25)
-                        plt.plot(x_new, y_new, 'g--')
-                        plt.legend(['fit', '68pct fit', 'data'])
-                    except Exception as E:
-                        print('Plotting Exception: {}'.format(E))
-                else:
-                    # set bin_edges full extent for possibly filtered
-                    # water_frac and dark_frac
-                    bin_edges = 100
-                    if ('Water Fraction (%)' in x_key) or (
-                            'Dark Fraction (%)' in x_key):
-                        bin_edges = (100, np.linspace(0,100,100))
-                    if ('Cross Track (m)' in x_key):
-                        # don't do signed cross-track in the plot to
-                        # make it easier to read
-                        this_x_data = np.abs(this_x_data)
-                    scatter_density(this_x_data, this_y_data,
-                        uncert=this_uncert, source=sources, bin_edges=bin_edges)
-                    plt.title('{} vs. {}'.format(y_key, x_key))
-                    plt.xlabel(x_key)
-                    plt.ylabel(y_key)
-
-    plt.show()
+    if plot_dir is None:
+        for y_key, x_key in plot_pairs:
+            make_plot(y_key, x_key, **plot_data)
+        plt.show()
+    else:
+        os.makedirs(plot_dir, exist_ok=True)
+        save_plot = functools.partial(_save_plot, plot_dir)
+        if num_procs > 1:
+            with multiprocessing.Pool(num_procs, initializer=_init_plot_worker,
+                                      initargs=(plot_data,)) as pool:
+                plot_files = list(pool.imap(save_plot, plot_pairs))
+        else:
+            _init_plot_worker(plot_data)
+            plot_files = [save_plot(plot_pair) for plot_pair in plot_pairs]
+        for plot_file in plot_files:
+            if plot_file is not None:
+                print('Saved plot {}'.format(plot_file))
     warnings.resetwarnings()
 
+def get_plot_x_data(x_key, x_data):
+    if ('Cross Track (m)' in x_key):
+        # don't do signed cross-track in the plot to
+        # make it easier to read
+        x_data = np.abs(x_data)
+    return x_data
+
+def get_plot_x_bins(x_key):
+    # set bin_edges full extent for possibly filtered
+    # water_frac and dark_frac
+    if ('Water Fraction (%)' in x_key) or ('Dark Fraction (%)' in x_key):
+        return np.linspace(0,100,100)
+    return 100
+
+def get_axis_bins(metrics_to_plot, metrics_to_plot_against):
+    # Histogram bins of the valid samples of each plot axis, computed once
+    # and shared by the density plots of all pairs with that axis
+    from scatter_density import get_bin_edges, get_bin_index
+
+    axis_bins = {'y': {}, 'x': {}}
+    for y_key, y_data in metrics_to_plot.items():
+        valid = ~np.isnan(y_data)
+        if np.any(valid):
+            edges = get_bin_edges(y_data[valid], 100, exclude_outliers=True)
+            axis_bins['y'][y_key] = (valid, edges,
+                                     get_bin_index(y_data, edges))
+    for x_key, x_data in metrics_to_plot_against.items():
+        valid = ~np.isnan(x_data)
+        x_data = get_plot_x_data(x_key, x_data)
+        if np.any(valid):
+            edges = get_bin_edges(x_data[valid], get_plot_x_bins(x_key))
+            axis_bins['x'][x_key] = (valid, edges,
+                                     get_bin_index(x_data, edges))
+    return axis_bins
+
+def get_pair_histogram(axis_bins, y_key, x_key, mask):
+    # The shared axis bins only match the bins of the pair if the pair has
+    # the same valid samples as each axis, else the histogram is computed by
+    # scatter_density
+    from scatter_density import histogram2d_from_index
+
+    if y_key not in axis_bins['y'] or x_key not in axis_bins['x']:
+        return None
+    valid_y, edges_y, bin_idx_y = axis_bins['y'][y_key]
+    valid_x, edges_x, bin_idx_x = axis_bins['x'][x_key]
+    mask = np.ma.getdata(mask)
+    if not (np.array_equal(mask, np.ma.getdata(valid_y))
+            and np.array_equal(mask, np.ma.getdata(valid_x))):
+        return None
+    h = histogram2d_from_index(np.ma.getdata(bin_idx_y)[mask],
+                               np.ma.getdata(bin_idx_x)[mask],
+                               len(edges_y) - 1, len(edges_x) - 1)
+    return h, edges_y, edges_x
+
+def make_plot(y_key, x_key, metrics_to_plot, metrics_to_plot_against,
+              uncert_to_plot=None, poly=2, sources=None, scatter_plot=False,
+              axis_bins=None):
+    # Makes the figure of y_key vs. x_key, returns None if there is nothing
+    # to plot
+    import matplotlib.pyplot as plt
+    from scatter_density import scatter_density, scatter_image
+
+    mask = np.logical_and(~np.isnan(metrics_to_plot[y_key]),
+                          ~np.isnan(metrics_to_plot_against[x_key]))
+    this_y_data = metrics_to_plot[y_key][mask]
+    this_x_data = metrics_to_plot_against[x_key][mask]
+    this_uncert = None
+    if uncert_to_plot is not None:
+        if uncert_to_plot[y_key] is not None:
+            this_uncert = uncert_to_plot[y_key][mask]
+
+    if scatter_plot:
+        fig = plt.figure()
+        if len(this_y_data) > SCATTER_MAX_POINTS:
+            # Large sets are drawn as an image of the points per pixel and
+            # fit on binned means
+            scatter_image(this_x_data, this_y_data, fig=fig)
+            fit = metrics_fit_binned
+            leg_text = ['fit', '68pct fit']
+        else:
+            plt.scatter(this_x_data, this_y_data,
+                        marker='o', s=1)
+            fit = metrics_fit
+            leg_text = ['fit', '68pct fit', 'data']
+        plt.title('{} vs. {}'.format(y_key, x_key))
+        plt.xlabel(x_key)
+        plt.ylabel(y_key)
+        try:
+            x_new, y_new = fit(this_x_data, this_y_data,
+                               poly=poly, pts=25)
+            plt.plot(x_new, y_new, 'r--')
+            sig_mask = std_mask(this_y_data, 1)
+            x_new, y_new = fit(this_x_data[sig_mask],
+                               this_y_data[sig_mask],
+                               poly=poly, pts=25)
+            plt.plot(x_new, y_new, 'g--')
+            plt.legend(leg_text)
+        except Exception as E:
+            print('Plotting Exception: {}'.format(E))
+    else:
+        bin_edges = (100, get_plot_x_bins(x_key))
+        this_x_data = get_plot_x_data(x_key, this_x_data)
+        hist = None
+        if axis_bins is not None and len(this_y_data) > 0:
+            hist = get_pair_histogram(axis_bins, y_key, x_key, mask)
+        fig = scatter_density(this_x_data, this_y_data,
+            uncert=this_uncert, source=sources, bin_edges=bin_edges,
+            hist=hist)
+        if fig is None:
+            return None
+        plt.title('{} vs. {}'.format(y_key, x_key))
+        plt.xlabel(x_key)
+        plt.ylabel(y_key)
+    return fig
+
+def get_plot_file(plot_dir, y_key, x_key):
+    plot_name = re.sub('[^0-9a-zA-Z]+', '_', '{} vs {}'.format(y_key, x_key))
+    return os.path.join(plot_dir, plot_name.strip('_') + '.png')
+
+# Plot data shared by the plots of a worker process (set by
+# _init_plot_worker)
+_PLOT_DATA = {}
+
+def _init_plot_worker(plot_data):
+    import matplotlib
+    matplotlib.use('Agg')
+    warnings.simplefilter("ignore")
+    _PLOT_DATA.update(plot_data)
+
+def _save_plot(plot_dir, plot_pair):
+    import matplotlib.pyplot as plt
+
+    y_key, x_key = plot_pair
+    fig = make_plot(y_key, x_key, **_PLOT_DATA)
+    if fig is None:
+        return None
+    plot_file = get_plot_file(plot_dir, y_key, x_key)
+    fig.savefig(plot_file)
+    plt.close(fig)
+    return plot_file
+
 def sort_table(table, sort_key):
     sort_idx = np.argsort(table[sort_key])
     for key in table:
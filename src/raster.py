@@ -7,18 +7,19 @@ All rights reserved.
 Author (s): Shuai Zhang (UNC) and Alexander Corben (JPL)
 '''
 
+import os
+import copy
 import logging
 import raster_crs
 import numpy as np
-import geoloc_raster
-import raster_products
-import SWOTWater.aggregate as ag
-import cnes.modules.geoloc.lib.geoloc as geoloc
 
-from osgeo import osr
 from datetime import datetime
-from SWOTWater.constants import PIXC_CLASSES
-from cnes.common.lib.my_variables import GEN_RAD_EARTH_EQ, GEN_RAD_EARTH_POLE
+from raster_cache import get_geoloc_cache
+from raster_bin_index import BinIndexSidecar
+from raster_bin_stats import RasterBinStats, set_processor_grid
+
+# Note: the SWOTWater, CNES, GDAL and product modules are imported in the
+# methods that use them so that importing this module stays cheap
 
 LOGGER = logging.getLogger(__name__)
 
@@ -37,6 +38,88 @@ class L2PixcToRaster(object):
         self.runtime_config = runtime_config
 
     def process(self):
+        self.do_geolocation()
+        product = self.do_raster_processing()
+
+        return product
+
+    def process_multires(self, resolutions, bin_index_file=None):
+        '''Rasterizes the pixc once per resolution in resolutions, returning
+           one product per resolution. Geolocation is done once (using the
+           runtime_config raster_resolution), and the pixels are projected
+           once and then binned for each raster grid. If bin_index_file is
+           given, the projection and binning are kept in (and reused from)
+           that sidecar file.'''
+        self.do_geolocation()
+
+        projected_coords = get_projected_coords_cache(bin_index_file)
+        products = []
+        for resolution in resolutions:
+            products.append(self.do_raster_processing(
+                resolution=resolution, projected_coords=projected_coords))
+
+        if bin_index_file is not None:
+            projected_coords.save()
+        return products
+
+    def process_to_zarr(self, out_dirs, resolutions, bin_index_file=None,
+                        **writer_kwargs):
+        '''Rasterizes the pixc at each resolution in resolutions to a zarr
+           directory store in out_dirs, writing row bands as they are done
+           (see raster_zarr.ZarrRasterWriter for the writer_kwargs)'''
+        from raster_zarr import ZarrRasterWriter
+        self.do_geolocation()
+
+        projected_coords = get_projected_coords_cache(bin_index_file)
+        for resolution, out_dir in zip(resolutions, out_dirs):
+            raster_proc = self.get_raster_processor(resolution=resolution)
+            band_writer = ZarrRasterWriter(out_dir, **writer_kwargs)
+            raster_proc.rasterize_bands(
+                self.pixc, band_writer, band_writer.band_rows,
+                polygon_points=self.polygon_points,
+                use_improved_geoloc=self.use_improved_geoloc,
+                projected_coords=projected_coords)
+
+        if bin_index_file is not None:
+            projected_coords.save()
+
+    def process_incremental(self, bin_stats_file, bin_index_file=None):
+        '''Rasterizes the pixc and merges it into the per-bin stats stored in
+           bin_stats_file (if it exists) on the stored grid. The merged stats
+           are written back to bin_stats_file, and the product is made from
+           the merged stats. This lets tiles be added to a scene one at a
+           time without rasterizing the earlier tiles again.'''
+        self.do_geolocation()
+
+        projected_coords = get_projected_coords_cache(bin_index_file)
+        raster_proc = self.get_raster_processor(keep_bin_stats=True)
+        if os.path.exists(bin_stats_file):
+            LOGGER.info('Merging into bin stats {}'.format(bin_stats_file))
+            prior_bin_stats = RasterBinStats.from_file(bin_stats_file)
+            raster_proc.rasterize(
+                self.pixc, self.polygon_points,
+                use_improved_geoloc=self.use_improved_geoloc,
+                projected_coords=projected_coords,
+                grid=prior_bin_stats.grid)
+            bin_stats = prior_bin_stats.merge(raster_proc.bin_stats)
+            product = raster_proc.build_product_from_bin_stats(
+                bin_stats, polygon_points=self.polygon_points)
+        else:
+            product = raster_proc.rasterize(
+                self.pixc, self.polygon_points,
+                use_improved_geoloc=self.use_improved_geoloc,
+                projected_coords=projected_coords)
+            bin_stats = raster_proc.bin_stats
+
+        if bin_index_file is not None:
+            projected_coords.save()
+
+        tmp_bin_stats_file = bin_stats_file + '.part'
+        bin_stats.to_file(tmp_bin_stats_file)
+        os.replace(tmp_bin_stats_file, bin_stats_file)
+        return product
+
+    def do_geolocation(self):
         # Get height-constrained geolocation as specified in config:
         # "none" - we want to use non-improved geoloc
         # "lowres_raster" - we want to get height constrained geolocation using
@@ -45,12 +128,15 @@ class L2PixcToRaster(object):
 
         if self.algorithmic_config['height_constrained_geoloc_source'].lower() \
            == "none":
-            new_height = self.get_smoothed_height()
+            new_height, = self.get_cached_geoloc(
+                'smoothed_height', lambda: [self.get_smoothed_height()])
             self.pixc['pixel_cloud']['improved_height'] = new_height
             self.use_improved_geoloc = False
         elif self.algorithmic_config['height_constrained_geoloc_source'].lower() \
              == "lowres_raster":
-            new_lat, new_lon, new_height = self.do_height_constrained_geolocation()
+            new_lat, new_lon, new_height = self.get_cached_geoloc(
+                'height_constrained_geoloc',
+                self.do_height_constrained_geolocation)
             self.pixc['pixel_cloud']['improved_latitude'] = new_lat
             self.pixc['pixel_cloud']['improved_longitude'] = new_lon
             self.pixc['pixel_cloud']['improved_height'] = new_height
@@ -62,11 +148,31 @@ class L2PixcToRaster(object):
             raise ValueError('Invalid height_constrained_geoloc_source: {}'.format( \
                 self.algorithmic_config['height_constrained_geoloc_source']))
 
-        product = self.do_raster_processing()
-
-        return product
+    def get_cached_geoloc(self, method, compute):
+        """Returns the list of arrays from compute(), memoized in the geoloc
+           cache of the runtime config (if any) by pixc and low-res grid"""
+        cache = get_geoloc_cache(self.runtime_config)
+        if cache is None:
+            return compute()
+
+        lowres_params = {
+            'method': method,
+            'output_sampling_grid_type':
+                self.runtime_config['output_sampling_grid_type'],
+            'resolution': self.runtime_config['raster_resolution'] \
+                / self.algorithmic_config['lowres_raster_scale_factor'],
+            'utm_zone_adjust': self.runtime_config['utm_zone_adjust'],
+            'mgrs_band_adjust': self.runtime_config['mgrs_band_adjust'],
+            'polygon_points': self.polygon_points}
+        key = cache.get_key(self.pixc, lowres_params, self.algorithmic_config)
+        arrays = cache.fetch(key)
+        if arrays is None:
+            arrays = compute()
+            cache.store(key, arrays)
+        return arrays
 
     def do_height_constrained_geolocation(self):
+        import geoloc_raster
         LOGGER.info('Rasterizing for height-constrained geolocation')
         # TODO: Handle land edges better in improved geolocation
         # Normally land edges wouldn't get raster heights, but we are forcing
@@ -107,6 +213,7 @@ class L2PixcToRaster(object):
             self.pixc, height_constrained_geoloc_raster, self.algorithmic_config)
 
     def get_smoothed_height(self):
+        import geoloc_raster
         LOGGER.info('Getting smoothed heights')
         height_constrained_geoloc_raster_proc = RasterProcessor(
             self.runtime_config['output_sampling_grid_type'],
@@ -137,11 +244,22 @@ class L2PixcToRaster(object):
         this_geoloc_raster.update_heights_from_raster()
         return this_geoloc_raster.new_height
 
-    def do_raster_processing(self):
+    def do_raster_processing(self, resolution=None, projected_coords=None):
         LOGGER.info('Rasterizing')
-        raster_proc = RasterProcessor(
+        raster_proc = self.get_raster_processor(resolution=resolution)
+        out_raster = raster_proc.rasterize(
+            self.pixc, self.polygon_points,
+            use_improved_geoloc=self.use_improved_geoloc,
+            projected_coords=projected_coords)
+        return out_raster
+
+    def get_raster_processor(self, resolution=None, keep_bin_stats=False):
+        if resolution is None:
+            resolution = self.runtime_config['raster_resolution']
+
+        return RasterProcessor(
             self.runtime_config['output_sampling_grid_type'],
-            self.runtime_config['raster_resolution'],
+            resolution,
             self.runtime_config['utm_zone_adjust'],
             self.runtime_config['mgrs_band_adjust'],
             self.algorithmic_config['padding'],
@@ -151,12 +269,8 @@ class L2PixcToRaster(object):
             self.algorithmic_config['water_edge_classes'],
             self.algorithmic_config['land_edge_classes'],
             self.algorithmic_config['dark_water_classes'],
-            self.algorithmic_config['debug_flag'])
-
-        out_raster = raster_proc.rasterize(
-            self.pixc, self.polygon_points,
-            use_improved_geoloc=self.use_improved_geoloc)
-        return out_raster
+            self.algorithmic_config['debug_flag'],
+            keep_bin_stats=keep_bin_stats)
 
 
 class RasterProcessor(object):
@@ -164,7 +278,7 @@ class RasterProcessor(object):
                  mgrs_band_adjust, padding,
                  height_agg_method, area_agg_method, interior_water_classes,
                  water_edge_classes, land_edge_classes, dark_water_classes,
-                 debug_flag=False):
+                 debug_flag=False, keep_bin_stats=False):
         '''Initialize'''
         self.projection_type = projection_type
 
@@ -187,12 +301,72 @@ class RasterProcessor(object):
         self.land_edge_classes = land_edge_classes
         self.dark_water_classes = dark_water_classes
         self.debug_flag = debug_flag
+        # Keep mergeable per-bin stats of the rasterized pixc in bin_stats
+        self.keep_bin_stats = keep_bin_stats
+        self.bin_stats = None
 
-    def rasterize(self, pixc, polygon_points=None, use_improved_geoloc=True):
+    def rasterize(self, pixc, polygon_points=None, use_improved_geoloc=True,
+                  projected_coords=None, grid=None):
         '''Rasterize'''
         # Note: use_improved_geoloc indicates whether improved geolocations
         # are used for pixel binning. Improved heights are still needed for
         # interferogram flattening.
+        # projected_coords is an optional dict of projected pixel coordinates
+        # that is shared by processors rasterizing the same pixc at different
+        # resolutions. It is keyed by output crs and geoloc choice.
+        # projected_coords may also be a BinIndexSidecar, which keeps the
+        # coordinates and bin indices in a file for later runs.
+        # grid is an optional raster grid (as kept in RasterBinStats) to use
+        # instead of one made from the polygon/swath corners.
+        self.set_metadata(pixc)
+        self.set_grid(pixc, polygon_points, grid)
+        return self.rasterize_on_grid(pixc, polygon_points, use_improved_geoloc,
+                                      projected_coords,
+                                      warn_outside=grid is not None)
+
+    def rasterize_bands(self, pixc, band_writer, band_rows,
+                        polygon_points=None, use_improved_geoloc=True,
+                        projected_coords=None):
+        '''Rasterizes in bands of band_rows raster rows, passing each band
+           product to band_writer.write_band as soon as it is done so the
+           full raster is never held in memory'''
+        self.set_metadata(pixc)
+        self.set_grid(pixc, polygon_points)
+        grid = RasterBinStats.get_processor_grid(self)
+        if projected_coords is None:
+            projected_coords = {}
+
+        # The pixel mask, bin indices and flattened interferogram are
+        # computed once for the full grid, each band only maps its own rows
+        empty_product = self.build_product(populate_values=False)
+        pixc_mask = self.get_pixc_class_mask(pixc, use_improved_geoloc)
+        bin_index, flat_ifgram = None, None
+        if len(pixc['pixel_cloud']['height']) > 0:
+            bin_index = self.get_raster_bin_index(
+                pixc, pixc_mask, empty_product, use_improved_geoloc,
+                projected_coords)
+            flat_ifgram = self.get_flat_ifgram(pixc, use_improved_geoloc)
+
+        band_writer.open(empty_product)
+        for band_start in range(0, self.size_y, band_rows):
+            LOGGER.info('Rasterizing rows {} to {} of {}'.format(
+                band_start, min(band_start + band_rows, self.size_y),
+                self.size_y))
+            band_proc = copy.copy(self)
+            set_processor_grid(band_proc,
+                               get_band_grid(grid, band_start, band_rows))
+            band_bin_index = None
+            if bin_index is not None:
+                band_bin_index = get_band_bin_index(
+                    bin_index, band_start, band_proc.size_y, self.size_x)
+            band_product = band_proc.rasterize_on_grid(
+                pixc, polygon_points, use_improved_geoloc, projected_coords,
+                pixc_mask=pixc_mask, bin_index=band_bin_index,
+                flat_ifgram=flat_ifgram)
+            band_writer.write_band(band_product, band_start)
+        band_writer.close()
+
+    def set_metadata(self, pixc):
         self.input_crs = raster_crs.wgs84_crs()
         self.cycle_number = pixc.cycle_number
         self.pass_number = pixc.pass_number
@@ -215,8 +389,11 @@ class RasterProcessor(object):
         self.right_last_longitude = pixc.right_last_longitude
         self.right_last_latitude = pixc.right_last_latitude
 
+    def set_grid(self, pixc, polygon_points=None, grid=None):
         LOGGER.info('Calculating projection parameters')
-        if polygon_points is None:
+        if grid is not None:
+            set_processor_grid(self, grid)
+        elif polygon_points is None:
             swath_corners = \
                 [(pixc.left_first_latitude, pixc.left_first_longitude),
                  (pixc.right_first_latitude, pixc.right_first_longitude),
@@ -226,30 +403,43 @@ class RasterProcessor(object):
         else:
             self.create_projection_from_polygon(polygon_points)
 
-        # Get mask of valid pixc values
-        pixc_mask = get_pixc_mask(pixc, use_improved_geoloc)
-        # Exclude classes not defined in the processor
-        pixc_mask = np.logical_and(
-            pixc_mask,
-            np.isin(pixc['pixel_cloud']['classification'],
-                    np.concatenate((self.interior_water_classes,
-                                    self.water_edge_classes,
-                                    self.land_edge_classes,
-                                    self.dark_water_classes))))
+    def rasterize_on_grid(self, pixc, polygon_points=None,
+                          use_improved_geoloc=True, projected_coords=None,
+                          warn_outside=False, pixc_mask=None, bin_index=None,
+                          flat_ifgram=None):
+        '''Rasterize on the grid set by set_grid'''
+        # pixc_mask, bin_index and flat_ifgram may be given if they were
+        # already computed (see rasterize_bands), bin_index for this grid
+        if pixc_mask is None:
+            pixc_mask = self.get_pixc_class_mask(pixc, use_improved_geoloc)
 
         # Create an empty Raster
         empty_product = self.build_product(populate_values=False)
         # Return empty product if pixc is empty
         if len(pixc['pixel_cloud']['height'])==0:
             LOGGER.warn('Empty Pixel Cloud: returning empty raster')
+            if self.keep_bin_stats:
+                self.bin_stats = RasterBinStats(
+                    RasterBinStats.get_processor_grid(self))
             return empty_product
 
-        LOGGER.info('Mapping pixc pixels to raster bins')
-        self.proj_mapping = empty_product.get_raster_mapping(pixc, pixc_mask,
-                                                             use_improved_geoloc)
+        if bin_index is None:
+            bin_index = self.get_raster_bin_index(
+                pixc, pixc_mask, empty_product, use_improved_geoloc,
+                projected_coords)
+        self.bin_index = bin_index
+        self.proj_mapping = empty_product.get_raster_mapping(
+            pixc, pixc_mask, use_improved_geoloc, bin_index=self.bin_index)
+        if warn_outside:
+            num_outside = np.sum(np.logical_and(pixc_mask, self.bin_index < 0))
+            if num_outside > 0:
+                LOGGER.warning(
+                    '{} pixels are outside of the given grid'.format(
+                        num_outside))
 
         LOGGER.info('Rasterizing data')
-        self.aggregate_wse(pixc, pixc_mask, use_improved_geoloc)
+        self.aggregate_wse(pixc, pixc_mask, use_improved_geoloc,
+                           flat_ifgram=flat_ifgram)
         self.aggregate_water_area(pixc, pixc_mask)
         self.aggregate_cross_track(pixc, pixc_mask)
         self.aggregate_sig0(pixc, pixc_mask)
@@ -259,17 +449,77 @@ class RasterProcessor(object):
         self.aggregate_ice_flags(pixc, pixc_mask)
         self.aggregate_layover_impact(pixc, pixc_mask)
         self.aggregate_corrections(pixc, pixc_mask)
+        if self.debug_flag:
+            self.aggregate_classification(pixc, pixc_mask)
+
+        if self.keep_bin_stats:
+            self.bin_stats = self.get_bin_stats(pixc, pixc_mask)
+
         self.apply_wse_corrections()
         if self.projection_type == 'utm':
             self.aggregate_lat_lon(pixc_mask)
 
-        if self.debug_flag:
-            self.aggregate_classification(pixc, pixc_mask)
+        return self.build_product(polygon_points=polygon_points)
+
+    def get_pixc_class_mask(self, pixc, use_improved_geoloc=True):
+        '''Gets the mask of valid pixc pixels of the processor classes'''
+        # Get mask of valid pixc values
+        pixc_mask = get_pixc_mask(pixc, use_improved_geoloc)
+        # Exclude classes not defined in the processor
+        return np.logical_and(
+            pixc_mask,
+            np.isin(pixc['pixel_cloud']['classification'],
+                    np.concatenate((self.interior_water_classes,
+                                    self.water_edge_classes,
+                                    self.land_edge_classes,
+                                    self.dark_water_classes))))
+
+    def get_raster_bin_index(self, pixc, pixc_mask, empty_product,
+                             use_improved_geoloc=True, projected_coords=None):
+        '''Gets the flat bin index of each pixc pixel on the grid set by
+           set_grid (-1 for masked pixels and pixels outside of the grid)'''
+        LOGGER.info('Mapping pixc pixels to raster bins')
+        coords_key = (self.output_crs.ExportToWkt(), use_improved_geoloc)
+        if isinstance(projected_coords, BinIndexSidecar):
+            return projected_coords.get_bin_index(
+                self, empty_product, pixc, coords_key,
+                get_pixc_mask(pixc, use_improved_geoloc), pixc_mask)
+
+        if projected_coords is not None and coords_key in projected_coords:
+            this_projected_coords = projected_coords[coords_key]
+        else:
+            this_projected_coords = empty_product.get_projected_coords(
+                pixc, pixc_mask, use_improved_geoloc)
+            if projected_coords is not None:
+                projected_coords[coords_key] = this_projected_coords
+
+        return empty_product.get_raster_bin_index(
+            pixc, pixc_mask, use_improved_geoloc,
+            projected_coords=this_projected_coords)
+
+    def get_bin_stats(self, pixc, mask):
+        '''Gets the mergeable per-bin stats of the aggregated rasters'''
+        if self.height_agg_method == 'weight':
+            wse_pixel_weight = 1/get_pixc_height_std(pixc)**2
+        else:
+            wse_pixel_weight = np.ones(np.shape(pixc['pixel_cloud']['height']))
+        return RasterBinStats.from_processor(self, pixc, mask,
+                                             wse_pixel_weight)
+
+    def build_product_from_bin_stats(self, bin_stats, polygon_points=None):
+        '''Builds the raster product from (merged) per-bin stats. The
+           metadata attributes must already be set, e.g. by rasterize.'''
+        bin_stats.apply_to_processor(self)
+        self.bin_stats = bin_stats
+        self.apply_wse_corrections()
+        if self.projection_type == 'utm':
+            self.set_lat_lon(bin_stats['n_pix'] > 0)
 
         return self.build_product(polygon_points=polygon_points)
 
 
     def create_projection_from_polygon(self, polygon_points):
+        from osgeo import osr
         poly_edge_y = [point[0] for point in polygon_points]
         poly_edge_x = [point[1] for point in polygon_points]
 
@@ -344,29 +594,12 @@ class RasterProcessor(object):
                      'y_max': self.y_max,
                      'size_y': self.size_y})
 
-    def aggregate_wse(self, pixc, mask, use_improved_geoloc=True):
-        pixc_height = pixc['pixel_cloud']['height']
-        pixc_num_rare_looks = pixc['pixel_cloud']['eff_num_rare_looks']
-        pixc_num_med_looks = pixc['pixel_cloud']['eff_num_medium_looks']
-
-        pixc_power_plus_y = pixc['pixel_cloud']['power_plus_y']
-        pixc_power_minus_y = pixc['pixel_cloud']['power_minus_y']
-
-        pixc_dh_dphi = pixc['pixel_cloud']['dheight_dphase']
-        pixc_dlat_dphi = pixc['pixel_cloud']['dlatitude_dphase']
-        pixc_dlon_dphi = pixc['pixel_cloud']['dlongitude_dphase']
-        pixc_phase_noise_std = pixc['pixel_cloud']['phase_noise_std']
-
-        pixc_height_std = np.abs(pixc_phase_noise_std * pixc_dh_dphi)
-        # set bad pix height std to high number to deweight
-        # instead of giving infs/nans
-        bad_num = 1.0e5
-        pixc_height_std[pixc_height_std<=0] = bad_num
-        pixc_height_std[np.isinf(pixc_height_std)] = bad_num
-        pixc_height_std[np.isnan(pixc_height_std)] = bad_num
-
-        looks_to_efflooks = pixc['pixel_cloud'].looks_to_efflooks
-
+    def get_flat_ifgram(self, pixc, use_improved_geoloc=True):
+        '''Gets the flattened interferogram of all pixc pixels'''
+        import SWOTWater.aggregate as ag
+        import cnes.modules.geoloc.lib.geoloc as geoloc
+        from cnes.common.lib.my_variables import \
+            GEN_RAD_EARTH_EQ, GEN_RAD_EARTH_POLE
         if use_improved_geoloc:
             # Flatten ifgram with improved geoloc and height
             target_xyz = geoloc.convert_llh2ecef(
@@ -391,12 +624,33 @@ class RasterProcessor(object):
                                    pixc['tvp']['minus_y_antenna_z'])
         pixc_tvp_index = ag.get_sensor_index(pixc)
         pixc_wavelength = pixc.wavelength
-        flat_ifgram = ag.flatten_interferogram(pixc_ifgram,
-                                               tvp_plus_y_antenna_xyz,
-                                               tvp_minus_y_antenna_xyz,
-                                               target_xyz,
-                                               pixc_tvp_index,
-                                               pixc_wavelength)
+        return ag.flatten_interferogram(pixc_ifgram,
+                                        tvp_plus_y_antenna_xyz,
+                                        tvp_minus_y_antenna_xyz,
+                                        target_xyz,
+                                        pixc_tvp_index,
+                                        pixc_wavelength)
+
+    def aggregate_wse(self, pixc, mask, use_improved_geoloc=True,
+                      flat_ifgram=None):
+        import SWOTWater.aggregate as ag
+        pixc_height = pixc['pixel_cloud']['height']
+        pixc_num_rare_looks = pixc['pixel_cloud']['eff_num_rare_looks']
+        pixc_num_med_looks = pixc['pixel_cloud']['eff_num_medium_looks']
+
+        pixc_power_plus_y = pixc['pixel_cloud']['power_plus_y']
+        pixc_power_minus_y = pixc['pixel_cloud']['power_minus_y']
+
+        pixc_dh_dphi = pixc['pixel_cloud']['dheight_dphase']
+        pixc_dlat_dphi = pixc['pixel_cloud']['dlatitude_dphase']
+        pixc_dlon_dphi = pixc['pixel_cloud']['dlongitude_dphase']
+
+        pixc_height_std = get_pixc_height_std(pixc)
+
+        looks_to_efflooks = pixc['pixel_cloud'].looks_to_efflooks
+
+        if flat_ifgram is None:
+            flat_ifgram = self.get_flat_ifgram(pixc, use_improved_geoloc)
 
         # Only aggregate heights for interior water and water edges
         pixc_klass = pixc['pixel_cloud']['classification']
@@ -433,6 +687,7 @@ class RasterProcessor(object):
                     self.n_wse_pix[i][j] = ag.simple(good, metric='sum')
 
     def aggregate_water_area(self, pixc, mask):
+        import SWOTWater.aggregate as ag
         pixc_pixel_area = pixc['pixel_cloud']['pixel_area']
         pixc_water_fraction = pixc['pixel_cloud']['water_frac']
         pixc_water_fraction_uncert = pixc['pixel_cloud']['water_frac_uncert']
@@ -489,6 +744,7 @@ class RasterProcessor(object):
                     self.n_area_pix[i][j] = ag.simple(good, metric='sum')
 
     def aggregate_cross_track(self, pixc, mask):
+        import SWOTWater.aggregate as ag
         pixc_cross_track = pixc['pixel_cloud']['cross_track']
 
         self.cross_track = np.ma.masked_all((self.size_y, self.size_x))
@@ -502,6 +758,7 @@ class RasterProcessor(object):
                         metric='mean')
 
     def aggregate_sig0(self, pixc, mask):
+        import SWOTWater.aggregate as ag
         pixc_sig0 = pixc['pixel_cloud']['sig0']
         pixc_sig0_uncert = pixc['pixel_cloud']['sig0_uncert']
 
@@ -520,6 +777,7 @@ class RasterProcessor(object):
                     self.sig0_u[i][j] = grid_sig0[2]
 
     def aggregate_inc(self, pixc, mask):
+        import SWOTWater.aggregate as ag
         pixc_inc = pixc['pixel_cloud']['inc']
 
         self.inc = np.ma.masked_all((self.size_y, self.size_x))
@@ -559,6 +817,7 @@ class RasterProcessor(object):
         return dark_area/total_area
 
     def aggregate_classification(self, pixc, mask):
+        import SWOTWater.aggregate as ag
         pixc_klass = pixc['pixel_cloud']['classification']
 
         self.classification = np.ma.masked_all((self.size_y, self.size_x))
@@ -571,6 +830,7 @@ class RasterProcessor(object):
                         pixc_klass[self.proj_mapping[i][j]][good], metric='mode')
 
     def aggregate_illumination_time(self, pixc, mask):
+        import SWOTWater.aggregate as ag
         pixc_illumination_time = pixc['pixel_cloud']['illumination_time']
         pixc_illumination_time_tai = pixc['pixel_cloud']['illumination_time_tai']
 
@@ -588,10 +848,12 @@ class RasterProcessor(object):
                         pixc_illumination_time_tai[self.proj_mapping[i][j]][good],
                         metric='mean')
 
+        self.tai_utc_difference = self.get_tai_utc_difference()
+
+    def get_tai_utc_difference(self):
         min_illumination_time_index = np.unravel_index(
             np.argmin(self.illumination_time), self.illumination_time.shape)
-        self.tai_utc_difference = \
-            self.illumination_time_tai[min_illumination_time_index] \
+        return self.illumination_time_tai[min_illumination_time_index] \
             - self.illumination_time[min_illumination_time_index]
 
     def aggregate_ice_flags(self, pixc, mask):
@@ -624,17 +886,10 @@ class RasterProcessor(object):
                         self.ice_dyn_flag[i][j] = 1
 
     def aggregate_layover_impact(self, pixc, mask):
+        import SWOTWater.aggregate as ag
         pixc_layover_impact = pixc['pixel_cloud']['layover_impact']
 
-        pixc_dh_dphi = pixc['pixel_cloud']['dheight_dphase']
-        pixc_phase_noise_std = pixc['pixel_cloud']['phase_noise_std']
-        pixc_height_std = np.abs(pixc_phase_noise_std * pixc_dh_dphi)
-        # set bad pix height std to high number to deweight
-        # instead of giving infs/nans
-        bad_num = 1.0e5
-        pixc_height_std[pixc_height_std<=0] = bad_num
-        pixc_height_std[np.isinf(pixc_height_std)] = bad_num
-        pixc_height_std[np.isnan(pixc_height_std)] = bad_num
+        pixc_height_std = get_pixc_height_std(pixc)
 
         # Only aggregate heights for interior water and water edges
         pixc_klass = pixc['pixel_cloud']['classification']
@@ -658,6 +913,7 @@ class RasterProcessor(object):
                     self.layover_impact[i][j] = grid_height[0]
 
     def aggregate_corrections(self, pixc, mask):
+        import SWOTWater.aggregate as ag
         pixc_geoid = pixc['pixel_cloud']['geoid']
         pixc_solid_earth_tide = pixc['pixel_cloud']['solid_earth_tide']
         pixc_load_tide_fes = pixc['pixel_cloud']['load_tide_fes']
@@ -705,6 +961,17 @@ class RasterProcessor(object):
             self.pole_tide)
 
     def aggregate_lat_lon(self, mask):
+        # get the lat and lon if there are any good pixels at all
+        has_good_pix = np.zeros((self.size_y, self.size_x), dtype=bool)
+        for i in range(0, self.size_y):
+            for j in range(0, self.size_x):
+                if len(self.proj_mapping[i][j]) != 0:
+                    has_good_pix[i][j] = np.any(mask[self.proj_mapping[i][j]])
+
+        self.set_lat_lon(has_good_pix)
+
+    def set_lat_lon(self, has_good_pix):
+        from osgeo import osr
         x_vec = np.linspace(self.x_min, self.x_max, self.size_x)
         y_vec = np.linspace(self.y_min, self.y_max, self.size_y)
 
@@ -714,18 +981,14 @@ class RasterProcessor(object):
         self.latitude = np.ma.masked_all((self.size_y, self.size_x))
         self.longitude = np.ma.masked_all((self.size_y, self.size_x))
 
-        for i in range(0, self.size_y):
-            for j in range(0, self.size_x):
-                if len(self.proj_mapping[i][j]) != 0:
-                    good = mask[self.proj_mapping[i][j]]
-                    # get the lat and lon if there are any good pixels at all
-                    if np.any(good):
-                        lon, lat = transf.TransformPoint(x_vec[j], y_vec[i])[:2]
-                        self.latitude[i][j] = lon
-                        self.longitude[i][j] = lat
+        for i, j in zip(*np.nonzero(has_good_pix)):
+            lon, lat = transf.TransformPoint(x_vec[j], y_vec[i])[:2]
+            self.latitude[i][j] = lon
+            self.longitude[i][j] = lat
 
 
     def build_product(self, populate_values=True, polygon_points=None):
+        import raster_products
         # Assemble the product
         LOGGER.info('Assembling Raster Product - populated?: {}'.format(populate_values))
 
@@ -739,6 +1002,9 @@ class RasterProcessor(object):
                 product = raster_products.RasterGeoDebug()
             else:
                 product = raster_products.RasterGeo()
+        # The crs and illumination time definitions are set per product, so
+        # they must not change the class definitions other products share
+        product.VARIABLES = copy.deepcopy(product.VARIABLES)
 
         current_datetime = datetime.utcnow()
         product.history = \
@@ -845,6 +1111,43 @@ class RasterProcessor(object):
         return product
 
 
+def get_projected_coords_cache(bin_index_file=None):
+    """Gets the projected_coords dict shared by the processors of a pixc,
+       kept in a sidecar file if bin_index_file is given"""
+    if bin_index_file is None:
+        return {}
+    return BinIndexSidecar.from_file(bin_index_file)
+
+def get_band_grid(grid, band_start, band_rows):
+    '''Gets the grid of the raster rows band_start to band_start+band_rows'''
+    band_grid = dict(grid)
+    band_grid['size_y'] = min(band_rows, grid['size_y'] - band_start)
+    band_grid['y_min'] = grid['y_min'] + band_start*grid['resolution']
+    band_grid['y_max'] = band_grid['y_min'] \
+                         + (band_grid['size_y'] - 1)*grid['resolution']
+    return band_grid
+
+def get_band_bin_index(bin_index, band_start, band_rows, size_x):
+    '''Gets the bin indices on the grid of the raster rows band_start to
+       band_start+band_rows from the bin indices on the full grid'''
+    band_bin_index = bin_index - band_start*size_x
+    band_bin_index[np.logical_or(band_bin_index < 0,
+                                 band_bin_index >= band_rows*size_x)] = -1
+    return band_bin_index
+
+def get_pixc_height_std(pixc):
+    pixc_dh_dphi = pixc['pixel_cloud']['dheight_dphase']
+    pixc_phase_noise_std = pixc['pixel_cloud']['phase_noise_std']
+
+    pixc_height_std = np.abs(pixc_phase_noise_std * pixc_dh_dphi)
+    # set bad pix height std to high number to deweight
+    # instead of giving infs/nans
+    bad_num = 1.0e5
+    pixc_height_std[pixc_height_std<=0] = bad_num
+    pixc_height_std[np.isinf(pixc_height_std)] = bad_num
+    pixc_height_std[np.isnan(pixc_height_std)] = bad_num
+    return pixc_height_std
+
 def get_pixc_mask(pixc, use_improved_geoloc=False):
     if use_improved_geoloc:
         lat_keyword = 'improved_latitude'
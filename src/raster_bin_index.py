@@ -0,0 +1,152 @@
+'''
+Copyright (c) 2020-, California Institute of Technology ("Caltech"). U.S.
+Government sponsorship acknowledged.
+All rights reserved.
+
+Author(s): Alexander Corben
+'''
+
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+
+from raster_json import to_json
+from raster_bin_stats import RasterBinStats
+
+LOGGER = logging.getLogger(__name__)
+
+BIN_INDEX_HEADER = '_header'
+
+
+class BinIndexSidecar(dict):
+    '''Projected pixel coordinates and raster bin indices of a pixc, kept in
+       a sidecar file so later runs over the same pixc skip the projection
+
+       This is a projected_coords dict (see RasterProcessor.rasterize) keyed
+       by (output crs wkt, use_improved_geoloc), with (x, y) values. Unlike
+       the in-memory dict, the coordinates cover every pixel with valid
+       geolocation, not only the pixels of the configured classes, so they
+       can be reused with other class lists. The bin indices of each grid
+       are kept for the same pixels and masked down to the pixels being
+       rasterized.
+
+       Each coordinate entry is stored with a checksum of the lat/lon arrays
+       and the valid pixel mask it was made from. Entries whose checksum
+       does not match the pixc are dropped and recomputed.'''
+    def __init__(self, filename=None):
+        super().__init__()
+        self.filename = filename
+        self.checksums = {}
+        self.bin_indices = {}
+        self.modified = False
+
+    @classmethod
+    def from_file(cls, filename):
+        """Reads a sidecar file, or returns an empty sidecar for filename if
+           it does not exist yet"""
+        sidecar = cls(filename)
+        if not os.path.exists(filename):
+            return sidecar
+
+        with np.load(filename, allow_pickle=False) as npz:
+            header = json.loads(str(npz[BIN_INDEX_HEADER]))
+            for idx, entry in enumerate(header['coords']):
+                coords_key = (entry['crs_wkt'], entry['use_improved_geoloc'])
+                sidecar[coords_key] = (npz['x_{}'.format(idx)],
+                                       npz['y_{}'.format(idx)])
+                sidecar.checksums[coords_key] = entry['checksum']
+            for idx, entry in enumerate(header['bin_indices']):
+                coords_key = (entry['crs_wkt'], entry['use_improved_geoloc'])
+                sidecar.bin_indices[(coords_key, entry['grid'])] = \
+                    npz['bin_index_{}'.format(idx)]
+        LOGGER.info('Read bin index sidecar {}'.format(filename))
+        return sidecar
+
+    def to_file(self, filename=None):
+        """Writes the sidecar (to its own filename by default)"""
+        if filename is None:
+            filename = self.filename
+        header = {'coords': [], 'bin_indices': []}
+        arrays = {}
+        for idx, (coords_key, (x, y)) in enumerate(self.items()):
+            header['coords'].append({'crs_wkt': coords_key[0],
+                                     'use_improved_geoloc': coords_key[1],
+                                     'checksum': self.checksums[coords_key]})
+            arrays['x_{}'.format(idx)] = x
+            arrays['y_{}'.format(idx)] = y
+        for idx, ((coords_key, grid), bin_index) in enumerate(
+                self.bin_indices.items()):
+            header['bin_indices'].append(
+                {'crs_wkt': coords_key[0],
+                 'use_improved_geoloc': coords_key[1],
+                 'grid': grid})
+            arrays['bin_index_{}'.format(idx)] = bin_index
+        arrays[BIN_INDEX_HEADER] = np.array(json.dumps(header))
+
+        # np.savez adds .npz to names without it
+        tmp_filename = filename + '.part.npz'
+        np.savez(tmp_filename, **arrays)
+        os.replace(tmp_filename, filename)
+        self.modified = False
+
+    def save(self):
+        """Writes the sidecar if anything was added since it was read"""
+        if self.modified:
+            LOGGER.info('Writing bin index sidecar {}'.format(self.filename))
+            self.to_file()
+
+    def get_bin_index(self, proc, empty_product, pixc, coords_key, valid_mask,
+                      pixc_mask):
+        """Gets the flat raster bin index of each pixc pixel on the grid of
+           proc, reusing stored coordinates and bin indices when they match.
+           valid_mask is the mask of pixels with valid geolocation and
+           pixc_mask the (subset) mask of pixels being rasterized."""
+        use_improved_geoloc = coords_key[1]
+        checksum = get_latlon_checksum(pixc, valid_mask, use_improved_geoloc)
+        if coords_key in self and self.checksums[coords_key] != checksum:
+            LOGGER.warning(
+                'Bin index sidecar {} is stale, recomputing it'.format(
+                    self.filename))
+            del self[coords_key]
+            self.bin_indices = {key: value for key, value
+                                in self.bin_indices.items()
+                                if key[0] != coords_key}
+
+        if coords_key not in self:
+            self[coords_key] = empty_product.get_projected_coords(
+                pixc, valid_mask, use_improved_geoloc)
+            self.checksums[coords_key] = checksum
+            self.modified = True
+
+        grid = json.dumps(RasterBinStats.get_processor_grid(proc),
+                          sort_keys=True, default=to_json)
+        if (coords_key, grid) not in self.bin_indices:
+            self.bin_indices[(coords_key, grid)] = \
+                empty_product.get_raster_bin_index(
+                    pixc, valid_mask, use_improved_geoloc,
+                    projected_coords=self[coords_key])
+            self.modified = True
+        else:
+            LOGGER.info('Reusing bin indices from {}'.format(self.filename))
+
+        bin_index = np.array(self.bin_indices[(coords_key, grid)])
+        bin_index[~np.asarray(pixc_mask, dtype=bool)] = -1
+        return bin_index
+
+
+def get_latlon_checksum(pixc, valid_mask, use_improved_geoloc=True):
+    """Returns a sha256 of the pixc lat/lon used for binning and the mask of
+       pixels with valid geolocation"""
+    if use_improved_geoloc:
+        keywords = ['improved_latitude', 'improved_longitude']
+    else:
+        keywords = ['latitude', 'longitude']
+
+    checksum = hashlib.sha256()
+    for keyword in keywords:
+        checksum.update(np.ascontiguousarray(
+            np.ma.getdata(pixc['pixel_cloud'][keyword])))
+    checksum.update(np.packbits(np.asarray(valid_mask, dtype=bool)))
+    return checksum.hexdigest()
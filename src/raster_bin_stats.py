@@ -0,0 +1,412 @@
+'''
+Copyright (c) 2020-, California Institute of Technology ("Caltech"). U.S.
+Government sponsorship acknowledged.
+All rights reserved.
+
+Author(s): Alexander Corben
+'''
+
+import json
+import logging
+import raster_crs
+import numpy as np
+
+from raster_json import to_json
+from collections import OrderedDict as odict
+
+LOGGER = logging.getLogger(__name__)
+
+# Raster variables that are plain means over the good pixels in a bin
+MEAN_FIELDS = ['cross_track', 'inc', 'illumination_time',
+               'illumination_time_tai', 'geoid', 'solid_earth_tide',
+               'load_tide_fes', 'load_tide_got', 'pole_tide',
+               'model_dry_tropo_cor', 'model_wet_tropo_cor',
+               'iono_cor_gim_ka']
+
+# Height aggregation methods whose results can be merged
+MERGEABLE_HEIGHT_AGG_METHODS = ['weight', 'mean']
+
+# Rule used to merge each statistic between two sets of bin stats
+MERGE_RULES = odict([
+    ['n_pix', 'sum'],
+    ['n_wse_pix', 'sum'],
+    ['n_area_pix', 'sum'],
+    ['wse_weight', 'sum'],
+    ['wse_sum', 'sum'],
+    ['wse_inv_var', 'sum'],
+    ['layover_impact_sum', 'sum'],
+    ['water_area', 'sum'],
+    ['water_area_var', 'sum'],
+    ['sig0_sum', 'sum'],
+    ['sig0_var_sum', 'sum'],
+    ['dark_area', 'sum'],
+    ['total_area', 'sum'],
+    ['ice_clim_flag_min', 'min'],
+    ['ice_clim_flag_max', 'max'],
+    ['ice_dyn_flag_min', 'min'],
+    ['ice_dyn_flag_max', 'max']] +
+    [[field + '_sum', 'sum'] for field in MEAN_FIELDS])
+
+# Statistics with this prefix count the pixels of one class (debug only)
+CLASS_COUNT_PREFIX = 'n_class_'
+
+MERGE_FUNCS = {'sum': np.add,
+               'min': np.minimum,
+               'max': np.maximum}
+
+EMPTY_VALUES = {'sum': 0,
+                'min': np.inf,
+                'max': -np.inf}
+
+GRID_KEYS = ['projection_type', 'resolution', 'x_min', 'x_max', 'y_min',
+             'y_max', 'size_x', 'size_y', 'utm_zone', 'mgrs_band']
+
+# Processor metadata attributes kept with the bin stats
+TILE_KEYS = ['tile_numbers', 'tile_names', 'tile_polarizations']
+METADATA_KEYS = TILE_KEYS + [
+    'cycle_number', 'pass_number', 'scene_number', 'time_coverage_start',
+    'time_coverage_end', 'geospatial_lon_min', 'geospatial_lon_max',
+    'geospatial_lat_min', 'geospatial_lat_max', 'left_first_longitude',
+    'left_first_latitude', 'left_last_longitude', 'left_last_latitude',
+    'right_first_longitude', 'right_first_latitude', 'right_last_longitude',
+    'right_last_latitude']
+
+# Keys of the non-statistic entries in bin stats files
+GRID_FILE_KEY = '_grid'
+METADATA_FILE_KEY = '_metadata'
+
+def get_merge_rule(name):
+    """Returns the merge rule of a statistic"""
+    if name.startswith(CLASS_COUNT_PREFIX):
+        return 'sum'
+    if name not in MERGE_RULES:
+        raise ValueError('Unknown bin statistic: {}'.format(name))
+    return MERGE_RULES[name]
+
+
+class RasterBinStats(object):
+    '''Per-bin sufficient statistics of a raster
+
+       The statistics of rasters made from disjoint sets of pixels on the
+       same grid (e.g. tiles, row bands or the output of separate workers)
+       can be merged in any order, and the raster variables are then
+       regenerated from the merged statistics.
+
+       Sums and min/max values reproduce the full-raster result exactly.
+       Values from the SWOTWater aggregators are merged with per-bin weights:
+       heights by the sum of the pixel height weights, and sig0 by the pixel
+       count. Their uncertainties are combined by inverse variance (wse) or
+       in quadrature (water area and sig0). This is exact where only one
+       part has pixels in a bin, which is every bin except those on the
+       boundaries between parts.'''
+    def __init__(self, grid, stats=None, metadata=None):
+        self.grid = dict(grid)
+        self.metadata = {} if metadata is None else dict(metadata)
+        self.stats = odict()
+        if stats is not None:
+            for name, value in stats.items():
+                get_merge_rule(name)
+                self.stats[name] = np.asarray(value, dtype=np.float64)
+
+    @property
+    def shape(self):
+        return (self.grid['size_y'], self.grid['size_x'])
+
+    def __getitem__(self, name):
+        if name not in self.stats:
+            self.stats[name] = np.full(
+                self.shape, EMPTY_VALUES[get_merge_rule(name)],
+                dtype=np.float64)
+        return self.stats[name]
+
+    def __setitem__(self, name, value):
+        get_merge_rule(name)
+        self.stats[name] = np.asarray(value, dtype=np.float64)
+
+    @classmethod
+    def get_processor_grid(cls, proc):
+        """Gets the raster grid of a RasterProcessor"""
+        return {key: getattr(proc, key, None) for key in GRID_KEYS}
+
+    @classmethod
+    def get_processor_metadata(cls, proc):
+        """Gets the metadata attributes of a RasterProcessor"""
+        return {key: getattr(proc, key, None) for key in METADATA_KEYS}
+
+    def is_same_grid(self, other):
+        return all(self.grid.get(key) == other.grid.get(key)
+                   for key in GRID_KEYS)
+
+    def merge(self, other):
+        """Returns the merged stats of self and other"""
+        if not self.is_same_grid(other):
+            raise ValueError(
+                'Cannot merge bin stats on different grids: {} and {}'.format(
+                    self.grid, other.grid))
+
+        merged = RasterBinStats(self.grid,
+                                metadata=merge_metadata(self.metadata,
+                                                        other.metadata))
+        for name in list(self.stats.keys()) + [
+                name for name in other.stats.keys() if name not in self.stats]:
+            merge_func = MERGE_FUNCS[get_merge_rule(name)]
+            merged[name] = merge_func(self[name], other[name])
+        return merged
+
+    @classmethod
+    def merge_all(cls, bin_stats_list):
+        """Merges a list of bin stats"""
+        if len(bin_stats_list) == 0:
+            raise ValueError('No bin stats to merge')
+        merged = bin_stats_list[0]
+        for bin_stats in bin_stats_list[1:]:
+            merged = merged.merge(bin_stats)
+        return merged
+
+    @classmethod
+    def from_processor(cls, proc, pixc, mask, wse_pixel_weight):
+        """Gets the bin stats of a RasterProcessor after aggregation (before
+           wse corrections are applied). wse_pixel_weight is the per-pixel
+           height aggregation weight."""
+        if proc.height_agg_method not in MERGEABLE_HEIGHT_AGG_METHODS:
+            raise ValueError(
+                'Cannot get bin stats for height_agg_method {}'.format(
+                    proc.height_agg_method))
+
+        bin_stats = cls(cls.get_processor_grid(proc),
+                        metadata=cls.get_processor_metadata(proc))
+        num_bins = proc.size_x*proc.size_y
+        valid = np.logical_and(proc.bin_index >= 0, mask)
+        bin_index = proc.bin_index[valid]
+
+        def bin_sum(values=None):
+            if values is not None:
+                values = np.asarray(values, dtype=np.float64)[valid]
+            return np.bincount(bin_index, weights=values,
+                               minlength=num_bins).reshape(bin_stats.shape)
+
+        def filled(values):
+            return np.ma.filled(np.ma.asarray(values, dtype=np.float64), 0)
+
+        n_pix = bin_sum()
+        has_pix = n_pix > 0
+        bin_stats['n_pix'] = n_pix
+        bin_stats['n_wse_pix'] = filled(proc.n_wse_pix)
+        bin_stats['n_area_pix'] = filled(proc.n_area_pix)
+
+        for field in MEAN_FIELDS:
+            bin_stats[field + '_sum'] = np.where(
+                has_pix, filled(getattr(proc, field))*n_pix, 0)
+
+        pixc_klass = pixc['pixel_cloud']['classification']
+        is_water = np.isin(pixc_klass, np.concatenate((
+            proc.interior_water_classes, proc.water_edge_classes)))
+        wse_weight = bin_sum(np.where(is_water, wse_pixel_weight, 0))
+        has_wse = wse_weight > 0
+        bin_stats['wse_weight'] = wse_weight
+        bin_stats['wse_sum'] = np.where(
+            has_wse, filled(proc.wse)*wse_weight, 0)
+        bin_stats['layover_impact_sum'] = np.where(
+            has_wse, filled(proc.layover_impact)*wse_weight, 0)
+        with np.errstate(divide='ignore'):
+            bin_stats['wse_inv_var'] = np.where(
+                has_wse, 1/filled(proc.wse_u)**2, 0)
+
+        bin_stats['water_area'] = np.where(has_pix, filled(proc.water_area), 0)
+        bin_stats['water_area_var'] = np.where(
+            has_pix, filled(proc.water_area_u)**2, 0)
+        bin_stats['sig0_sum'] = np.where(has_pix, filled(proc.sig0)*n_pix, 0)
+        bin_stats['sig0_var_sum'] = np.where(
+            has_pix, (filled(proc.sig0_u)*n_pix)**2, 0)
+
+        pixc_water_area = pixc['pixel_cloud']['pixel_area'] \
+                          * pixc['pixel_cloud']['water_frac']
+        is_dark = np.isin(pixc_klass, proc.dark_water_classes)
+        bin_stats['dark_area'] = bin_sum(np.where(is_dark, pixc_water_area, 0))
+        bin_stats['total_area'] = bin_sum(pixc_water_area)
+
+        for flag in ['ice_clim_flag', 'ice_dyn_flag']:
+            flag_value = getattr(proc, flag)
+            bin_stats[flag + '_min'] = np.where(
+                has_pix, filled(flag_value), np.inf)
+            bin_stats[flag + '_max'] = np.where(
+                has_pix, filled(flag_value), -np.inf)
+
+        if proc.debug_flag:
+            for klass in get_classes(proc):
+                bin_stats[CLASS_COUNT_PREFIX + str(klass)] = bin_sum(
+                    pixc_klass == klass)
+
+        return bin_stats
+
+    def apply_to_processor(self, proc):
+        """Sets the grid and the aggregated raster variables of a
+           RasterProcessor from the bin stats (before wse corrections)"""
+        set_processor_grid(proc, self.grid)
+        for key, value in self.metadata.items():
+            setattr(proc, key, value)
+
+        n_pix = self['n_pix']
+        no_pix = n_pix == 0
+
+        def masked(values):
+            return np.ma.masked_array(values, mask=no_pix)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for field in MEAN_FIELDS:
+                setattr(proc, field, masked(self[field + '_sum']/n_pix))
+
+            proc.n_wse_pix = masked(self['n_wse_pix'])
+            proc.n_area_pix = masked(self['n_area_pix'])
+
+            wse_weight = self['wse_weight']
+            has_wse = wse_weight > 0
+            proc.wse = masked(np.where(
+                has_wse, self['wse_sum']/wse_weight, np.nan))
+            proc.wse_u = masked(np.where(
+                has_wse, 1/np.sqrt(self['wse_inv_var']), np.nan))
+            proc.layover_impact = masked(np.where(
+                has_wse, self['layover_impact_sum']/wse_weight, np.nan))
+
+            proc.water_area = masked(self['water_area'])
+            proc.water_area_u = masked(np.sqrt(self['water_area_var']))
+            pixel_area = get_pixel_area(proc)
+            proc.water_frac = proc.water_area/pixel_area
+            proc.water_frac_u = proc.water_area_u/pixel_area
+
+            proc.sig0 = masked(self['sig0_sum']/n_pix)
+            proc.sig0_u = masked(np.sqrt(self['sig0_var_sum'])/n_pix)
+
+            total_area = self['total_area']
+            proc.dark_frac = masked(np.where(
+                total_area == 0, 0, self['dark_area']/total_area))
+
+        for flag in ['ice_clim_flag', 'ice_dyn_flag']:
+            flag_min = self[flag + '_min']
+            flag_max = self[flag + '_max']
+            # Bins with differing flags are partially covered (1)
+            setattr(proc, flag, masked(np.where(
+                flag_min == flag_max, flag_min, 1)))
+
+        proc.tai_utc_difference = proc.get_tai_utc_difference()
+
+        if proc.debug_flag:
+            classes = get_classes(proc)
+            class_counts = np.stack([self[CLASS_COUNT_PREFIX + str(klass)]
+                                     for klass in classes])
+            # Ties go to the lowest class
+            proc.classification = masked(
+                classes[np.argmax(class_counts, axis=0)])
+
+    def to_file(self, bin_stats_file):
+        """Writes the bin stats to a (compressed) numpy .npz file"""
+        arrays = dict(self.stats)
+        arrays[GRID_FILE_KEY] = json.dumps(self.grid, default=to_json)
+        arrays[METADATA_FILE_KEY] = json.dumps(self.metadata, default=to_json)
+        # Write with the file object so numpy does not append .npz
+        with open(bin_stats_file, 'wb') as bin_stats_fp:
+            np.savez_compressed(bin_stats_fp, **arrays)
+
+    @classmethod
+    def from_file(cls, bin_stats_file):
+        """Reads bin stats written by to_file"""
+        with np.load(bin_stats_file) as arrays:
+            grid = json.loads(str(arrays[GRID_FILE_KEY]))
+            metadata = json.loads(str(arrays[METADATA_FILE_KEY]))
+            stats = odict([[name, arrays[name]] for name in arrays.files
+                           if name not in [GRID_FILE_KEY, METADATA_FILE_KEY]])
+        return cls(grid, stats=stats, metadata=metadata)
+
+def merge_metadata(metadata, other_metadata):
+    """Merges the metadata of bin stats from disjoint sets of tiles"""
+    if not metadata:
+        return dict(other_metadata)
+    if not other_metadata:
+        return dict(metadata)
+
+    common_tiles = set(metadata['tile_names'] or []).intersection(
+        other_metadata['tile_names'] or [])
+    if common_tiles:
+        raise ValueError('Tiles already in bin stats: {}'.format(
+            sorted(common_tiles)))
+
+    merged = dict(metadata)
+    for key in TILE_KEYS:
+        merged[key] = list(metadata[key] or []) + list(other_metadata[key] or [])
+    # Order the tiles as RasterPixc.from_tiles does: left then right swath,
+    # in order of measurement time (increasing tile number within the pass)
+    tile_order = sorted(range(len(merged['tile_names'])),
+                        key=lambda idx: get_tile_sort_key(
+                            merged['tile_names'][idx]))
+    for key in TILE_KEYS:
+        if len(merged[key]) == len(tile_order):
+            merged[key] = [merged[key][idx] for idx in tile_order]
+    for key, merge_func in [['geospatial_lon_min', min],
+                            ['geospatial_lat_min', min],
+                            ['geospatial_lon_max', max],
+                            ['geospatial_lat_max', max]]:
+        merged[key] = merge_optional(merge_func, metadata[key],
+                                     other_metadata[key])
+
+    # Times are in a sortable format ('%Y-%m-%d %H:%M:%S.%fZ'), so the first
+    # and last swath edges are taken from the earliest and latest parts
+    if merge_optional(min, metadata['time_coverage_start'],
+                      other_metadata['time_coverage_start']) \
+       != metadata['time_coverage_start']:
+        for key in ['time_coverage_start', 'left_first_longitude',
+                    'left_first_latitude', 'right_first_longitude',
+                    'right_first_latitude']:
+            merged[key] = other_metadata[key]
+    if merge_optional(max, metadata['time_coverage_end'],
+                      other_metadata['time_coverage_end']) \
+       != metadata['time_coverage_end']:
+        for key in ['time_coverage_end', 'left_last_longitude',
+                    'left_last_latitude', 'right_last_longitude',
+                    'right_last_latitude']:
+            merged[key] = other_metadata[key]
+    return merged
+
+def get_tile_sort_key(tile_name):
+    # Tile names are PPP_TTTS, with S the swath side (L or R)
+    return tile_name[-1], tile_name[:-1]
+
+def merge_optional(merge_func, value, other_value):
+    if value is None:
+        return other_value
+    if other_value is None:
+        return value
+    return merge_func(value, other_value)
+
+def set_processor_grid(proc, grid):
+    """Sets the raster grid (and output crs) of a RasterProcessor"""
+    for key in GRID_KEYS:
+        if key in ['projection_type', 'resolution']:
+            if getattr(proc, key) != grid[key]:
+                raise ValueError(
+                    'Bin stats {} {} does not match processor {}'.format(
+                        key, grid[key], getattr(proc, key)))
+        elif grid[key] is not None:
+            setattr(proc, key, grid[key])
+
+    if proc.projection_type == 'utm':
+        proc.output_crs = raster_crs.utm_crs(proc.utm_zone, proc.mgrs_band)
+        proc.utm_hemisphere = raster_crs.hemisphere_from_mgrs_band(
+            proc.mgrs_band)
+    else:
+        proc.output_crs = raster_crs.wgs84_crs()
+
+def get_classes(proc):
+    """Gets the sorted pixc classes handled by a RasterProcessor"""
+    return np.unique(np.concatenate((proc.interior_water_classes,
+                                     proc.water_edge_classes,
+                                     proc.land_edge_classes,
+                                     proc.dark_water_classes)))
+
+def get_pixel_area(proc):
+    """Gets the area of the raster pixels of a RasterProcessor as a column
+       vector for geo rasters (area varies with latitude) or a scalar"""
+    if proc.projection_type == 'utm':
+        return proc.resolution**2
+    px_latitudes = proc.y_min + proc.resolution*np.arange(proc.size_y)
+    return np.array([raster_crs.wgs84_px_area(px_latitude, proc.resolution)
+                     for px_latitude in px_latitudes])[:, np.newaxis]
@@ -0,0 +1,285 @@
+'''
+Copyright (c) 2020-, California Institute of Technology ("Caltech"). U.S.
+Government sponsorship acknowledged.
+All rights reserved.
+
+Author(s): Alexander Corben
+'''
+
+import os
+import json
+import glob
+import time
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+RESULT_CACHE_MAX_GB = 50
+GEOLOC_CACHE_MAX_GB = 20
+CACHE_ENTRY_INFO_FILE = 'entry.json'
+GEOLOC_CACHE_FILE = 'geoloc.npz'
+
+# Runtime config keys that do not change the rasterization results
+CACHE_EXCLUDED_RT_KEYS = ['result_cache_dir', 'result_cache_max_gb',
+                          'geoloc_cache_dir', 'geoloc_cache_max_gb']
+
+# Algorithmic config keys that do not change the geolocation. The debug
+# flag only changes the output product, and the low-res raster resolution is
+# part of the geoloc cache key instead of the scale factor, so runs with
+# matching low-res grids share entries
+GEOLOC_EXCLUDED_ALG_KEYS = ['debug_flag', 'lowres_raster_scale_factor']
+
+_CODE_VERSION = {}
+
+def get_code_version():
+    """Returns a hash of the source of the raster processing modules"""
+    if 'sha256' not in _CODE_VERSION:
+        code_hash = hashlib.sha256()
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        for src_file in sorted(glob.glob(os.path.join(src_dir, '*.py'))):
+            code_hash.update(os.path.basename(src_file).encode())
+            with open(src_file, 'rb') as src_fp:
+                code_hash.update(src_fp.read())
+        _CODE_VERSION['sha256'] = code_hash.hexdigest()
+    return _CODE_VERSION['sha256']
+
+def get_file_identity(filename):
+    """Returns the identity (absolute path, size and modification time) of an
+       input file. Rewriting a file in place changes its identity."""
+    if filename is None:
+        return None
+    stat = os.stat(filename)
+    return [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+
+def get_product_hash(product, product_hash=None):
+    """Returns a sha256 of the attributes and variables of a product and its
+       groups, as the identity of an in-memory product"""
+    if product_hash is None:
+        product_hash = hashlib.sha256()
+    for name in product.ATTRIBUTES:
+        product_hash.update('{}={!r}'.format(
+            name, getattr(product, name, None)).encode())
+    for name in product.VARIABLES:
+        if name not in product.variables:
+            continue
+        values = product[name]
+        product_hash.update('{}:{}:{}'.format(
+            name, np.ma.getdata(values).dtype.str,
+            np.shape(values)).encode())
+        product_hash.update(np.ascontiguousarray(np.ma.getdata(values)))
+        product_hash.update(np.packbits(np.ma.getmaskarray(values)))
+    for group in product.GROUPS:
+        product_hash.update(group.encode())
+        get_product_hash(product[group], product_hash)
+    return product_hash
+
+def get_result_cache(rt_cfg):
+    """Returns the result cache configured in a runtime config, or None"""
+    cache_dir = rt_cfg.get('result_cache_dir')
+    if cache_dir is None:
+        return None
+    max_gb = rt_cfg.get('result_cache_max_gb', RESULT_CACHE_MAX_GB)
+    return RasterResultCache(cache_dir, max_bytes=int(max_gb*1e9))
+
+def get_geoloc_cache(rt_cfg):
+    """Returns the geoloc cache configured in a runtime config, or None"""
+    cache_dir = rt_cfg.get('geoloc_cache_dir')
+    if cache_dir is None:
+        return None
+    max_gb = rt_cfg.get('geoloc_cache_max_gb', GEOLOC_CACHE_MAX_GB)
+    return GeolocCache(cache_dir, max_bytes=int(max_gb*1e9))
+
+
+class DirectoryCache(object):
+    '''On-disk cache with one directory per entry
+
+       Entries are evicted least recently used first once the cache is
+       larger than max_bytes. The cache size is scanned on the first store
+       and kept as a running total of the entries stored since, so the
+       cache is only scanned again when the total is over max_bytes.'''
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = None
+
+    def _store_entry(self, key, write_entry):
+        # Entries are built next to the cache and renamed into place
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry_dir):
+            return
+        tmp_dir = os.path.join(self.cache_dir, '.{}.{}'.format(
+            key, os.getpid()))
+        try:
+            os.makedirs(tmp_dir)
+            write_entry(tmp_dir)
+            entry_bytes = get_size(tmp_dir)
+            os.rename(tmp_dir, entry_dir)
+        except OSError as exception:
+            # Another process may have stored the same entry first. A failed
+            # store only costs a later cache miss.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.exists(entry_dir):
+                LOGGER.warning('Could not store cache entry {}: {}'.format(
+                    key, exception))
+            return
+        if self.total_bytes is not None:
+            # Entries stored by other processes are counted at the next scan
+            self.total_bytes += entry_bytes
+        if self.total_bytes is None or self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is no
+           larger than max_bytes, and updates the running total_bytes"""
+        entries = []
+        for entry_dir in glob.glob(os.path.join(self.cache_dir, '*')):
+            if os.path.isdir(entry_dir):
+                entries.append((os.stat(entry_dir).st_mtime, entry_dir,
+                                get_size(entry_dir)))
+        entries.sort()
+
+        total_bytes = sum(entry[2] for entry in entries)
+        for _, entry_dir, entry_bytes in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            LOGGER.info('Evicting cache entry {}'.format(entry_dir))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_bytes -= entry_bytes
+        self.total_bytes = total_bytes
+
+
+class RasterResultCache(DirectoryCache):
+    '''On-disk cache of finished rasterization outputs
+
+       Entries are keyed by a hash of the input file identities, the parsed
+       algorithmic and runtime configs and the code version, so any change to
+       those misses the cache. Each entry is a directory holding copies of
+       the output files.'''
+    def __init__(self, cache_dir, max_bytes=int(RESULT_CACHE_MAX_GB*1e9)):
+        super().__init__(cache_dir, max_bytes)
+
+    def get_key(self, input_files, alg_cfg, rt_cfg):
+        """Returns the cache key of a job"""
+        rt_cfg = {key: value for key, value in rt_cfg.items()
+                  if key not in CACHE_EXCLUDED_RT_KEYS}
+        key_data = json.dumps(
+            {'inputs': [get_file_identity(input_file)
+                        for input_file in input_files],
+             'alg_cfg': alg_cfg,
+             'rt_cfg': rt_cfg,
+             'code_version': get_code_version()},
+            sort_keys=True, default=repr)
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+    def fetch(self, key, out_files):
+        """Copies the cached outputs of key to out_files. Returns False on a
+           cache miss."""
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry_dir, CACHE_ENTRY_INFO_FILE),
+                      'r') as info_fp:
+                info = json.load(info_fp)
+        except (OSError, ValueError):
+            return False
+        if info['num_files'] != len(out_files):
+            return False
+
+        for file_idx, out_file in enumerate(out_files):
+            cached_file = os.path.join(entry_dir, str(file_idx))
+            tmp_file = out_file + '.cache_tmp'
+            copy_output(cached_file, tmp_file)
+            replace_output(tmp_file, out_file)
+
+        # Mark the entry as recently used
+        os.utime(entry_dir)
+        LOGGER.info('Result cache hit {}'.format(key))
+        return True
+
+    def store(self, key, out_files):
+        """Copies out_files into the cache entry of key and evicts old
+           entries if the cache is over its size limit"""
+        def write_entry(entry_dir):
+            for file_idx, out_file in enumerate(out_files):
+                copy_output(out_file, os.path.join(entry_dir, str(file_idx)))
+            with open(os.path.join(entry_dir, CACHE_ENTRY_INFO_FILE),
+                      'w') as info_fp:
+                json.dump({'num_files': len(out_files),
+                           'out_files': out_files,
+                           'created': time.time()}, info_fp)
+        self._store_entry(key, write_entry)
+
+
+class GeolocCache(DirectoryCache):
+    '''On-disk cache of the improved geolocation computed from a low-res
+       raster
+
+       Entries are keyed by a hash of the pixc contents, the low-res grid
+       parameters, the algorithmic config and the code version, so output
+       rasters that share the low-res grid (e.g. different output
+       resolutions with the same lowres raster resolution) reuse the
+       geolocation. Each entry holds the geolocated arrays in an npz file.'''
+    def __init__(self, cache_dir, max_bytes=int(GEOLOC_CACHE_MAX_GB*1e9)):
+        super().__init__(cache_dir, max_bytes)
+
+    def get_key(self, pixc, lowres_params, alg_cfg):
+        """Returns the cache key of the geolocation of pixc"""
+        key_hash = get_product_hash(pixc)
+        alg_cfg = {key: value for key, value in alg_cfg.items()
+                   if key not in GEOLOC_EXCLUDED_ALG_KEYS}
+        key_hash.update(json.dumps(
+            {'lowres_params': lowres_params,
+             'alg_cfg': alg_cfg,
+             'code_version': get_code_version()},
+            sort_keys=True, default=repr).encode())
+        return key_hash.hexdigest()
+
+    def fetch(self, key):
+        """Returns the list of cached (masked) arrays of key, or None on a
+           cache miss"""
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            with np.load(os.path.join(entry_dir, GEOLOC_CACHE_FILE),
+                         allow_pickle=False) as npz:
+                arrays = [np.ma.masked_array(npz['data_{}'.format(idx)],
+                                             mask=npz['mask_{}'.format(idx)])
+                          for idx in range(int(npz['num_arrays']))]
+        except (OSError, KeyError, ValueError):
+            return None
+
+        # Mark the entry as recently used
+        os.utime(entry_dir)
+        LOGGER.info('Geoloc cache hit {}'.format(key))
+        return arrays
+
+    def store(self, key, arrays):
+        """Stores a list of (masked) arrays as the cache entry of key"""
+        npz_arrays = {'num_arrays': len(arrays)}
+        for idx, values in enumerate(arrays):
+            npz_arrays['data_{}'.format(idx)] = np.ma.getdata(values)
+            npz_arrays['mask_{}'.format(idx)] = np.ma.getmaskarray(values)
+        self._store_entry(key, lambda entry_dir: np.savez(
+            os.path.join(entry_dir, GEOLOC_CACHE_FILE), **npz_arrays))
+
+def copy_output(src, dst):
+    """Copies an output file, or output directory (zarr)"""
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copyfile(src, dst)
+
+def replace_output(src, dst):
+    """Renames an output file or directory over an existing one"""
+    if os.path.isdir(dst):
+        shutil.rmtree(dst)
+    os.replace(src, dst)
+
+def get_size(path):
+    """Returns the total size in bytes of the files under path"""
+    total_bytes = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            total_bytes += os.path.getsize(os.path.join(dirpath, filename))
+    return total_bytes
@@ -9,8 +9,8 @@ Author(s): Alexander Corben
 
 import logging
 import argparse
+import functools
 import numpy as np
-from osgeo import osr
 
 LOGGER = logging.getLogger(__name__)
 
@@ -22,8 +22,7 @@ MGRS_VALID_BANDS = "CDEFGHJKLMNPQRSTUVWXX"
 def wgs84_px_area(center_lat, px_size):
     # Calculates the area of a pixel by getting the total area between
     # the lat bounds and taking the fraction of that area between the lon bounds
-    spatial_ref = osr.SpatialReference()
-    spatial_ref.ImportFromEPSG(WGS84_ID)
+    spatial_ref = wgs84_crs()
     semi_maj = spatial_ref.GetSemiMajor()
     semi_min = spatial_ref.GetSemiMinor()
     e = np.sqrt(1 - (semi_min/semi_maj)**2)
@@ -100,13 +99,16 @@ def utm_zone_identifier(utm_zone, hemisphere):
     return int(identifier)
 
 
+@functools.lru_cache(maxsize=None)
 def utm_crs(utm_zone, mgrs_band):
     # Gets a UTM Coordinate Reference System
+    # Cached per process, so callers must not modify the returned object
     if not is_utm_zone_valid(utm_zone):
         raise ValueError("Invalid UTM Zone: {}".format(utm_zone))
     if not is_mgrs_band_valid(mgrs_band):
         raise ValueError("Invalid MGRS Band: {}".format(mgrs_band))
 
+    from osgeo import osr
     hemisphere = hemisphere_from_mgrs_band(mgrs_band)
     utm_zone_id = utm_zone_identifier(utm_zone, hemisphere)
     spatial_ref = osr.SpatialReference()
@@ -114,8 +116,11 @@ def utm_crs(utm_zone, mgrs_band):
     return spatial_ref
 
 
+@functools.lru_cache(maxsize=None)
 def wgs84_crs():
     # Gets the WGS84 Coordinate Reference System
+    # Cached per process, so callers must not modify the returned object
+    from osgeo import osr
     spatial_ref = osr.SpatialReference()
     spatial_ref.ImportFromEPSG(WGS84_ID)
     return spatial_ref
@@ -0,0 +1,14 @@
+'''
+Copyright (c) 2020-, California Institute of Technology ("Caltech"). U.S.
+Government sponsorship acknowledged.
+All rights reserved.
+
+Author(s): Alexander Corben
+'''
+
+def to_json(value):
+    """json default for the numpy scalars and arrays in raster metadata,
+       attributes and headers"""
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError('Cannot serialize {!r}'.format(value))
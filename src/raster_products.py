@@ -5,16 +5,17 @@ All rights reserved.
 
 Author(s): Alexander Corben
 '''
+import os
+import copy
+import json
 import logging
 import textwrap
 import raster_crs
 import numpy as np
 
-from osgeo import osr
-from netCDF4 import Dataset
 from datetime import datetime
-from shapely.geometry import Point, Polygon
 from collections import OrderedDict as odict
+from raster_json import to_json
 from SWOTWater.products.product import Product
 
 UNIX_EPOCH = datetime(1970, 1, 1)
@@ -22,6 +23,19 @@ SWOT_EPOCH = datetime(2000, 1, 1)
 
 LOGGER = logging.getLogger(__name__)
 
+# Default netCDF storage settings for raster variables
+NC_COMPLEVEL = 4
+NC_CHUNK_BYTES = 2**20
+
+# Files of the .npy directory format of RasterPixc
+NPY_HEADER_FILE = 'header.json'
+NPY_EXT = '.npy'
+NPY_MASK_EXT = '.mask.npy'
+
+# Default GeoTIFF export settings
+GEOTIFF_BLOCK_SIZE = 256
+GEOTIFF_OVERVIEW_LEVELS = [2, 4, 8, 16, 32]
+
 def textjoin(text):
     """Dedent join and strip text"""
     text = textwrap.dedent(text)
@@ -29,6 +43,144 @@ def textjoin(text):
     text = text.strip()
     return text
 
+def get_pixc_latlon(pixc, use_improved_geoloc=True):
+    """Gets the pixc lat/lon (lon in [-180, 180)) used for pixel binning"""
+    if use_improved_geoloc:
+        lat_keyword = 'improved_latitude'
+        lon_keyword = 'improved_longitude'
+    else:
+        lat_keyword = 'latitude'
+        lon_keyword = 'longitude'
+
+    pixc_lats = np.asarray(pixc['pixel_cloud'][lat_keyword])
+    pixc_lons = raster_crs.lon_360to180(
+        np.asarray(pixc['pixel_cloud'][lon_keyword]))
+    return pixc_lats, pixc_lons
+
+def get_bin_index(x, y, mask, x_min, y_min, resolution, size_x, size_y):
+    """Gets the flat (row-major) raster bin index of each pixel from its
+       projected coordinates. Pixels that are masked or fall outside of the
+       raster get an index of -1"""
+    i = np.round((y - y_min) / resolution)
+    j = np.round((x - x_min) / resolution)
+    # check bounds
+    valid = np.logical_and.reduce((np.asarray(mask, dtype=bool),
+                                   i >= 0, i < size_y, j >= 0, j < size_x))
+
+    bin_index = np.full(len(x), -1, dtype=np.int64)
+    bin_index[valid] = i[valid].astype(np.int64)*size_x \
+                       + j[valid].astype(np.int64)
+    return bin_index
+
+def get_mapping_from_bin_index(bin_index, size_x, size_y):
+    """Converts flat bin indices to a [size_y][size_x] nested list of the
+       pixel indices in each bin (in increasing pixel order)"""
+    mapping = [[[] for j in range(size_x)] for i in range(size_y)]
+
+    # Only the pixels in the raster are sorted, e.g. those of a row band
+    order = np.flatnonzero(bin_index >= 0)
+    order = order[np.argsort(bin_index[order], kind='stable')]
+    sorted_bins = bin_index[order]
+
+    bins, bin_starts = np.unique(sorted_bins, return_index=True)
+    for this_bin, pixels in zip(bins, np.split(order, bin_starts[1:])):
+        mapping[this_bin // size_x][this_bin % size_x] = pixels.tolist()
+    return mapping
+
+def get_product_attributes(product):
+    """Gets the attributes of a product that are set"""
+    attributes = odict()
+    for name in product.ATTRIBUTES:
+        value = getattr(product, name, None)
+        if value is not None:
+            attributes[name] = value
+    return attributes
+
+def get_fill_value(dtype):
+    """Gets the value used for masked cells when a raster variable is
+       written without a mask: NaN for floats and the maximum otherwise"""
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return np.nan
+    return np.iinfo(dtype).max
+
+def copy_ncfile(in_file, out_file, storage):
+    """Copies a netCDF file, creating the variables with the given per
+       variable storage settings (createVariable keyword arguments)"""
+    from netCDF4 import Dataset
+    with Dataset(in_file, 'r') as in_dataset, \
+         Dataset(out_file, 'w') as out_dataset:
+        copy_ncgroup(in_dataset, out_dataset, storage)
+
+def copy_ncgroup(in_group, out_group, storage):
+    out_group.setncatts({name: in_group.getncattr(name)
+                         for name in in_group.ncattrs()})
+    for name, dimension in in_group.dimensions.items():
+        out_group.createDimension(
+            name, None if dimension.isunlimited() else len(dimension))
+
+    for name, in_var in in_group.variables.items():
+        in_var.set_auto_maskandscale(False)
+        attributes = {attr: in_var.getncattr(attr)
+                      for attr in in_var.ncattrs() if attr != '_FillValue'}
+        out_var = out_group.createVariable(
+            name, in_var.datatype, in_var.dimensions,
+            fill_value=getattr(in_var, '_FillValue', None),
+            **storage.get(name, {}))
+        out_var.set_auto_maskandscale(False)
+        out_var.setncatts(attributes)
+        if in_var.size > 0:
+            out_var[...] = in_var[...]
+
+    for name, in_subgroup in in_group.groups.items():
+        copy_ncgroup(in_subgroup, out_group.createGroup(name),
+                     storage.get(name, {}))
+
+def compare_ncfiles(file_a, file_b):
+    """Compares the contents (dimensions, attributes, variable types, fill
+       values and data) of two netCDF files, ignoring how the variables are
+       stored. Returns a list of the differences found."""
+    from netCDF4 import Dataset
+    with Dataset(file_a, 'r') as dataset_a, Dataset(file_b, 'r') as dataset_b:
+        return compare_ncgroups(dataset_a, dataset_b, '/')
+
+def compare_ncgroups(group_a, group_b, path):
+    differences = []
+    def compare(what, value_a, value_b):
+        value_a, value_b = np.asarray(value_a), np.asarray(value_b)
+        if value_a.dtype != value_b.dtype or not np.array_equal(
+                value_a, value_b, equal_nan=value_a.dtype.kind in 'fc'):
+            differences.append('{}{}: {!r} != {!r}'.format(
+                path, what, value_a, value_b))
+
+    def compare_attributes(what, object_a, object_b):
+        compare(what + ' attributes', object_a.ncattrs(), object_b.ncattrs())
+        for name in set(object_a.ncattrs()) & set(object_b.ncattrs()):
+            compare('{}:{}'.format(what, name), object_a.getncattr(name),
+                    object_b.getncattr(name))
+
+    compare_attributes('', group_a, group_b)
+    compare('dimensions', [[name, len(dim)] for name, dim
+                           in group_a.dimensions.items()],
+            [[name, len(dim)] for name, dim in group_b.dimensions.items()])
+    compare('variables', list(group_a.variables), list(group_b.variables))
+    for name in set(group_a.variables) & set(group_b.variables):
+        var_a, var_b = group_a.variables[name], group_b.variables[name]
+        var_a.set_auto_maskandscale(False)
+        var_b.set_auto_maskandscale(False)
+        compare(name + ' dtype', str(var_a.datatype), str(var_b.datatype))
+        compare(name + ' dimensions', var_a.dimensions, var_b.dimensions)
+        compare_attributes(name, var_a, var_b)
+        if var_a.size > 0 and var_a.shape == var_b.shape:
+            compare(name, var_a[...], var_b[...])
+
+    compare('groups', list(group_a.groups), list(group_b.groups))
+    for name in set(group_a.groups) & set(group_b.groups):
+        differences += compare_ncgroups(group_a.groups[name],
+                                        group_b.groups[name],
+                                        path + name + '/')
+    return differences
+
 COMMON_ATTRIBUTES = odict([
     ['Conventions',
      {'dtype': 'str' ,'value': 'CF-1.7',
@@ -596,7 +748,143 @@ COMMON_VARIABLES = odict([
 ])
 
 
-class RasterUTM(Product):
+class RasterNcMixin(object):
+    '''Chunked and compressed netCDF output for raster products'''
+    # Per-variable overrides of the storage settings derived from the
+    # variable definitions, e.g. {'wse': {'complevel': 6}}
+    NC_STORAGE = {}
+
+    def to_ncfile(self, filename, complevel=NC_COMPLEVEL,
+                  chunk_bytes=NC_CHUNK_BYTES):
+        """Writes self to a netCDF file with zlib compressed variables stored
+           in row-block chunks of about chunk_bytes. A complevel of 0 writes
+           the file without any storage settings."""
+        if not complevel:
+            return super().to_ncfile(filename)
+
+        # Write with the product writer and copy the datasets with the storage
+        # settings, so the file contents are the same either way
+        tmp_file = filename + '.nostorage'
+        super().to_ncfile(tmp_file)
+        try:
+            copy_ncfile(tmp_file, filename,
+                        self.get_nc_storage(complevel, chunk_bytes))
+        finally:
+            os.remove(tmp_file)
+
+    def get_nc_storage(self, complevel=NC_COMPLEVEL,
+                       chunk_bytes=NC_CHUNK_BYTES):
+        """Gets the netCDF storage settings of each variable from its dtype
+           and dimensions"""
+        storage = {}
+        for name, variable in self.VARIABLES.items():
+            dtype = np.dtype(variable['dtype'])
+            dims = list(variable.get('dimensions', {}).keys())
+            shape = [self.dimensions[dim] for dim in dims]
+            if not shape or min(shape) == 0 or dtype.kind in 'SU':
+                storage[name] = {}
+            else:
+                # Row blocks of whole rows, shuffle only helps multi-byte types
+                row_bytes = int(np.prod(shape[1:]))*dtype.itemsize
+                chunk_rows = int(np.clip(chunk_bytes // row_bytes, 1, shape[0]))
+                storage[name] = {'zlib': True,
+                                 'complevel': complevel,
+                                 'shuffle': dtype.itemsize > 1,
+                                 'chunksizes': [chunk_rows] + shape[1:]}
+            storage[name].update(self.NC_STORAGE.get(name, {}))
+        return storage
+
+    def to_geotiff(self, out_root, variables=None,
+                   block_size=GEOTIFF_BLOCK_SIZE,
+                   overview_levels=GEOTIFF_OVERVIEW_LEVELS,
+                   num_threads='ALL_CPUS', suffix=''):
+        """Writes 2-D raster variables to tiled, cloud-optimized GeoTIFFs
+           with overviews, one file per variable named <out_root>_<var>.tif
+           followed by suffix (e.g. for temporary files). The arrays are
+           written north-up from memory in the raster crs. Overviews are
+           built with num_threads threads. Returns the list of files
+           written."""
+        from osgeo import gdal
+        gdal.UseExceptions()
+
+        if variables is None:
+            variables = [name for name in
+                         SparseRaster.get_raster_variables(type(self))
+                         if name in self.variables]
+
+        x_dim, y_dim = list(self.DIMENSIONS.keys())
+        x_coords = np.asarray(self[x_dim])
+        y_coords = np.asarray(self[y_dim])
+        # Rows go from south to north in the product, so flip to north-up.
+        # The geotransform is for the corner of the first (north-west) pixel.
+        resolution = self.resolution
+        geotransform = (x_coords[0] - resolution/2, resolution, 0,
+                        y_coords[-1] + resolution/2, 0, -resolution)
+        crs_wkt = self.VARIABLES['crs']['crs_wkt']
+
+        if gdal.GetDriverByName('COG') is not None:
+            driver = gdal.GetDriverByName('COG')
+            options = ['COMPRESS=DEFLATE', 'BLOCKSIZE={}'.format(block_size),
+                       'NUM_THREADS={}'.format(num_threads),
+                       'OVERVIEWS=IGNORE_EXISTING']
+        else:
+            # Older GDAL, build the overviews in memory and copy them
+            driver = gdal.GetDriverByName('GTiff')
+            options = ['TILED=YES', 'COMPRESS=DEFLATE', 'COPY_SRC_OVERVIEWS=YES',
+                       'BLOCKXSIZE={}'.format(block_size),
+                       'BLOCKYSIZE={}'.format(block_size),
+                       'NUM_THREADS={}'.format(num_threads)]
+
+        old_num_threads = gdal.GetConfigOption('GDAL_NUM_THREADS')
+        gdal.SetConfigOption('GDAL_NUM_THREADS', str(num_threads))
+        out_files = []
+        try:
+            for name in variables:
+                out_file = '{}_{}.tif{}'.format(out_root, name, suffix)
+                mem_dataset = self._get_gdal_dataset(
+                    name, geotransform, crs_wkt)
+                # Average continuous values, but not classes/flags/counts
+                resampling = 'AVERAGE' \
+                    if np.dtype(self.VARIABLES[name]['dtype']).kind == 'f' \
+                    else 'NEAREST'
+                this_options = list(options)
+                if driver.ShortName == 'COG':
+                    this_options.append('RESAMPLING={}'.format(resampling))
+                else:
+                    levels = [level for level in overview_levels
+                              if min(x_coords.size, y_coords.size) // level > 0]
+                    mem_dataset.BuildOverviews(resampling, levels)
+                driver.CreateCopy(out_file, mem_dataset, options=this_options)
+                mem_dataset = None
+                out_files.append(out_file)
+        finally:
+            gdal.SetConfigOption('GDAL_NUM_THREADS', old_num_threads)
+        return out_files
+
+    def _get_gdal_dataset(self, name, geotransform, crs_wkt):
+        from osgeo import gdal, gdal_array
+        dtype = np.dtype(self.VARIABLES[name]['dtype'])
+        data = np.ma.asarray(self[name])
+        nodata = get_fill_value(dtype)
+        values = np.ma.filled(data.astype(dtype), nodata)[::-1]
+
+        mem_dataset = gdal.GetDriverByName('MEM').Create(
+            '', values.shape[1], values.shape[0], 1,
+            gdal_array.NumericTypeCodeToGDALTypeCode(dtype))
+        mem_dataset.SetGeoTransform(geotransform)
+        mem_dataset.SetProjection(crs_wkt)
+        band = mem_dataset.GetRasterBand(1)
+        band.SetNoDataValue(float(nodata))
+        band.SetDescription(name)
+        band.WriteArray(values)
+        return mem_dataset
+
+    def to_sparse(self):
+        """Gets the sparse layout of self (see SparseRaster)"""
+        return SparseRaster.from_product(self)
+
+
+class RasterUTM(RasterNcMixin, Product):
     UID = "raster"
     DIMENSIONS = odict([
         ['x', 0],
@@ -767,53 +1055,54 @@ class RasterUTM(Product):
     VARIABLES['y']['dimensions'] = odict([['y', 0]])
     VARIABLES['crs']['dimensions'] = odict([])
 
-    def get_raster_mapping(self, pixc, mask, use_improved_geoloc=True):
-        LOGGER.info('Getting raster mapping')
-        if use_improved_geoloc:
-            lat_keyword = 'improved_latitude'
-            lon_keyword = 'improved_longitude'
-        else:
-            lat_keyword = 'latitude'
-            lon_keyword = 'longitude'
-
-        pixc_lats = pixc['pixel_cloud'][lat_keyword]
-        pixc_lons = raster_crs.lon_360to180(pixc['pixel_cloud'][lon_keyword])
+    def get_projected_coords(self, pixc, mask, use_improved_geoloc=True):
+        """Projects the pixc pixels to the raster coordinate system. Returns
+           x/y arrays over all pixels with zeros where mask is False"""
+        from osgeo import osr
+        pixc_lats, pixc_lons = get_pixc_latlon(pixc, use_improved_geoloc)
 
         input_crs = raster_crs.wgs84_crs()
         output_crs = raster_crs.utm_crs(self.utm_zone_num,
                                         self.mgrs_latitude_band)
         transf = osr.CoordinateTransformation(input_crs, output_crs)
 
-        x_tmp=[]
-        y_tmp=[]
-        for x in range(0, len(pixc_lats)):
-            if mask[x]:
-                u_x, u_y = transf.TransformPoint(pixc_lats[x], pixc_lons[x])[:2]
-                x_tmp.append(u_x)
-                y_tmp.append(u_y)
-            else:
-                x_tmp.append(0)
-                y_tmp.append(0)
-
-        mapping_tmp = []
-        for i in range(0, self.dimensions['y']):
-            mapping_tmp.append([])
-            for j in range(0, self.dimensions['x']):
-                mapping_tmp[i].append([])
-
-        for x in range(0,len(pixc_lats)):
-            if mask[x]:
-                i = int(round((y_tmp[x] - self.y_min) / self.resolution))
-                j = int(round((x_tmp[x] - self.x_min) / self.resolution))
-                # check bounds
-                if (i >= 0 and i < self.dimensions['y'] and
-                    j >= 0 and j < self.dimensions['x']):
-                    mapping_tmp[i][j].append(x)
-
-        return mapping_tmp
+        mask = np.asarray(mask, dtype=bool)
+        x_tmp = np.zeros(len(pixc_lats))
+        y_tmp = np.zeros(len(pixc_lats))
+        if np.any(mask):
+            utm_points = np.array(transf.TransformPoints(
+                np.column_stack((pixc_lats[mask], pixc_lons[mask])).tolist()))
+            x_tmp[mask] = utm_points[:, 0]
+            y_tmp[mask] = utm_points[:, 1]
+
+        return x_tmp, y_tmp
+
+    def get_raster_bin_index(self, pixc, mask, use_improved_geoloc=True,
+                             projected_coords=None):
+        """Gets the flat raster bin index of each pixc pixel (-1 if the
+           pixel is masked or outside of the raster)"""
+        if projected_coords is None:
+            projected_coords = self.get_projected_coords(
+                pixc, mask, use_improved_geoloc)
+        x_tmp, y_tmp = projected_coords
+
+        return get_bin_index(x_tmp, y_tmp, mask, self.x_min, self.y_min,
+                             self.resolution, self.dimensions['x'],
+                             self.dimensions['y'])
+
+    def get_raster_mapping(self, pixc, mask, use_improved_geoloc=True,
+                           projected_coords=None, bin_index=None):
+        LOGGER.info('Getting raster mapping')
+        if bin_index is None:
+            bin_index = self.get_raster_bin_index(
+                pixc, mask, use_improved_geoloc, projected_coords)
+        return get_mapping_from_bin_index(bin_index, self.dimensions['x'],
+                                          self.dimensions['y'])
 
     def crop_to_bounds(self, swath_polygon_points):
         """Crops a raster to the given swath polygon"""
+        from osgeo import osr
+        from shapely.geometry import Point, Polygon
         # Convert polygon points to UTM
         input_crs = raster_crs.wgs84_crs()
         output_crs = raster_crs.utm_crs(self.utm_zone_num,
@@ -855,7 +1144,7 @@ class RasterUTM(Product):
         return 1
 
 
-class RasterGeo(Product):
+class RasterGeo(RasterNcMixin, Product):
     UID = "raster"
     DIMENSIONS = odict([
         ['longitude', 0],
@@ -989,39 +1278,43 @@ class RasterGeo(Product):
     VARIABLES['latitude']['dimensions'] = odict([['latitude', 0]])
     VARIABLES['crs']['dimensions'] = odict([])
 
-    def get_raster_mapping(self, pixc, mask, use_improved_geoloc=True):
+    def get_projected_coords(self, pixc, mask, use_improved_geoloc=True):
+        """Gets the pixc pixel lon/lat as raster x/y arrays over all pixels
+           with zeros where mask is False"""
+        pixc_lats, pixc_lons = get_pixc_latlon(pixc, use_improved_geoloc)
+
+        mask = np.asarray(mask, dtype=bool)
+        x_tmp = np.where(mask, pixc_lons, 0)
+        y_tmp = np.where(mask, pixc_lats, 0)
+        return x_tmp, y_tmp
+
+    def get_raster_bin_index(self, pixc, mask, use_improved_geoloc=True,
+                             projected_coords=None):
+        """Gets the flat raster bin index of each pixc pixel (-1 if the
+           pixel is masked or outside of the raster)"""
+        if projected_coords is None:
+            projected_coords = self.get_projected_coords(
+                pixc, mask, use_improved_geoloc)
+        x_tmp, y_tmp = projected_coords
+
+        return get_bin_index(x_tmp, y_tmp, mask, self.longitude_min,
+                             self.latitude_min, self.resolution,
+                             self.dimensions['longitude'],
+                             self.dimensions['latitude'])
+
+    def get_raster_mapping(self, pixc, mask, use_improved_geoloc=True,
+                           projected_coords=None, bin_index=None):
         LOGGER.info('Getting raster mapping')
-        if use_improved_geoloc:
-            lat_keyword = 'improved_latitude'
-            lon_keyword = 'improved_longitude'
-        else:
-            lat_keyword = 'latitude'
-            lon_keyword = 'longitude'
-
-        pixc_lats = pixc['pixel_cloud'][lat_keyword]
-        pixc_lons = raster_crs.lon_360to180(pixc['pixel_cloud'][lon_keyword])
-
-        mapping_tmp = []
-        for i in range(0, self.dimensions['latitude']):
-            mapping_tmp.append([])
-            for j in range(0, self.dimensions['longitude']):
-                mapping_tmp[i].append([])
-
-        for x in range(0, len(pixc_lats)):
-            if mask[x]:
-                i = int(round((pixc_lats[x] - self.latitude_min)
-                              / self.resolution).astype(int))
-                j = int(round((pixc_lons[x] - self.longitude_min)
-                              / self.resolution).astype(int))
-                # check bounds
-                if (i >= 0 and i < self.dimensions['latitude'] and
-                    j >= 0 and j < self.dimensions['longitude']):
-                    mapping_tmp[i][j].append(x)
-
-        return mapping_tmp
+        if bin_index is None:
+            bin_index = self.get_raster_bin_index(
+                pixc, mask, use_improved_geoloc, projected_coords)
+        return get_mapping_from_bin_index(bin_index,
+                                          self.dimensions['longitude'],
+                                          self.dimensions['latitude'])
 
     def crop_to_bounds(self, swath_polygon_points):
         """Crops a raster to the given swath polygon"""
+        from shapely.geometry import Point, Polygon
         poly = Polygon(swath_polygon_points)
 
         # Check whether each pixel center is within the polygon
@@ -1107,6 +1400,168 @@ class RasterGeoDebug(RasterGeo):
     VARIABLES['classification']['dimensions'] = \
         odict([['latitude', 0], ['longitude', 0]])
 
+class SparseRaster(object):
+    '''Sparse layout of a raster product
+
+       The flat (row-major) indices of the occupied raster cells are stored
+       once, and every 2-D raster variable is stored as a packed 1-D array
+       of its values in those cells. Memory and file size scale with the
+       number of occupied cells rather than with the raster size. Variables
+       are densified to 2-D masked arrays on demand.'''
+    PRODUCT_CLASSES = odict([
+        ['RasterUTM', RasterUTM],
+        ['RasterGeo', RasterGeo],
+        ['RasterUTMDebug', RasterUTMDebug],
+        ['RasterGeoDebug', RasterGeoDebug],
+    ])
+    CELL_DIMENSION = 'cell'
+    CELL_INDEX = 'cell_index'
+    PRODUCT_CLASS_ATTRIBUTE = 'sparse_product_class'
+
+    def __init__(self, product_class, attributes, coordinates, crs_attributes,
+                 cell_index, values):
+        self.product_class = product_class
+        self.attributes = attributes
+        self.coordinates = coordinates
+        self.crs_attributes = crs_attributes
+        self.cell_index = cell_index
+        self.values = values
+
+    @property
+    def shape(self):
+        # Raster variables are (y, x) / (latitude, longitude)
+        return tuple(len(self.coordinates[dim])
+                     for dim in self.get_raster_dimensions())
+
+    def get_raster_dimensions(self):
+        return list(self.product_class.DIMENSIONS.keys())[::-1]
+
+    @classmethod
+    def get_raster_variables(cls, product_class):
+        """Gets the names of the 2-D variables of a product class"""
+        return [name for name, variable in product_class.VARIABLES.items()
+                if len(variable.get('dimensions', {})) == 2]
+
+    @classmethod
+    def from_product(cls, product):
+        """Gets the sparse layout of a (dense) raster product"""
+        product_class = type(product)
+        if product_class.__name__ not in cls.PRODUCT_CLASSES:
+            raise ValueError('Unsupported product class: {}'.format(
+                product_class.__name__))
+
+        attributes = get_product_attributes(product)
+
+        coordinates = odict([[dim, np.asarray(product[dim])]
+                             for dim in product_class.DIMENSIONS])
+        crs_attributes = odict([
+            [key, value] for key, value in product_class.VARIABLES['crs'].items()
+            if key not in ['dtype', 'dimensions']])
+
+        raster_variables = [name for name in
+                            cls.get_raster_variables(product_class)
+                            if name in product.variables]
+        occupied = np.zeros(
+            [len(coordinates[dim]) for dim in product_class.DIMENSIONS][::-1],
+            dtype=bool)
+        for name in raster_variables:
+            occupied |= ~np.ma.getmaskarray(product[name])
+        cell_index = np.flatnonzero(occupied)
+
+        values = odict([[name, np.ma.asarray(product[name]).ravel()[cell_index]]
+                        for name in raster_variables])
+        return cls(product_class, attributes, coordinates, crs_attributes,
+                   cell_index, values)
+
+    def densify(self, name):
+        """Gets a 2-D masked array of a raster variable"""
+        dense = np.ma.masked_all(
+            self.shape, dtype=self.product_class.VARIABLES[name]['dtype'])
+        dense[np.unravel_index(self.cell_index, self.shape)] = \
+            self.values[name]
+        return dense
+
+    def to_product(self):
+        """Gets the dense raster product"""
+        product = self.product_class()
+        product.VARIABLES = copy.deepcopy(product.VARIABLES)
+        for name, value in self.attributes.items():
+            setattr(product, name, value)
+        for dim, coordinate in self.coordinates.items():
+            product[dim] = coordinate
+        product.VARIABLES['crs'].update(self.crs_attributes)
+        for name in self.values:
+            product[name] = self.densify(name)
+        return product
+
+    def to_ncfile(self, filename, complevel=NC_COMPLEVEL):
+        """Writes the sparse layout to a netCDF file"""
+        from netCDF4 import Dataset, default_fillvals
+        with Dataset(filename, 'w') as dataset:
+            dataset.setncatts(self.attributes)
+            dataset.setncattr(self.PRODUCT_CLASS_ATTRIBUTE,
+                              self.product_class.__name__)
+
+            for dim, coordinate in self.coordinates.items():
+                dataset.createDimension(dim, len(coordinate))
+                self._create_variable(dataset, dim, (dim,))[:] = coordinate
+            dataset.createDimension(self.CELL_DIMENSION, len(self.cell_index))
+
+            crs = dataset.createVariable('crs', 'S1')
+            crs.setncatts(self.crs_attributes)
+
+            cell_index = dataset.createVariable(
+                self.CELL_INDEX, 'i8', (self.CELL_DIMENSION,),
+                zlib=complevel > 0, complevel=max(complevel, 1), shuffle=True)
+            cell_index.setncatts({
+                'long_name': 'occupied raster cell index',
+                'comment': textjoin("""
+                    Flat (row-major) index of the raster cell in the
+                    ({}) raster.""".format(
+                        ', '.join(self.get_raster_dimensions())))})
+            cell_index[:] = self.cell_index
+
+            for name, values in self.values.items():
+                dtype = np.dtype(self.product_class.VARIABLES[name]['dtype'])
+                variable = self._create_variable(
+                    dataset, name, (self.CELL_DIMENSION,),
+                    fill_value=default_fillvals[dtype.str[1:]],
+                    zlib=complevel > 0, complevel=max(complevel, 1),
+                    shuffle=dtype.itemsize > 1)
+                variable[:] = values
+
+    def _create_variable(self, dataset, name, dimensions, **kwargs):
+        definition = self.product_class.VARIABLES[name]
+        variable = dataset.createVariable(name, definition['dtype'],
+                                          dimensions, **kwargs)
+        # The raster coordinates attribute does not apply to packed values
+        variable.setncatts(odict([
+            [key, value] for key, value in definition.items()
+            if key not in ['dtype', 'dimensions', 'coordinates']]))
+        return variable
+
+    @classmethod
+    def from_ncfile(cls, filename):
+        """Reads a sparse layout written by to_ncfile"""
+        from netCDF4 import Dataset
+        with Dataset(filename, 'r') as dataset:
+            attributes = odict([[name, dataset.getncattr(name)]
+                                for name in dataset.ncattrs()])
+            product_class = cls.PRODUCT_CLASSES[
+                attributes.pop(cls.PRODUCT_CLASS_ATTRIBUTE)]
+            coordinates = odict([[dim, dataset[dim][:].data]
+                                 for dim in product_class.DIMENSIONS])
+            crs_attributes = odict([
+                [name, dataset['crs'].getncattr(name)]
+                for name in dataset['crs'].ncattrs()])
+            cell_index = dataset[cls.CELL_INDEX][:].data
+            values = odict([[name, dataset[name][:]] for name in
+                            cls.get_raster_variables(product_class)
+                            if name in dataset.variables])
+        return cls(product_class, attributes, coordinates, crs_attributes,
+                   cell_index, values)
+
+
 class RasterPixc(Product):
     ATTRIBUTES = odict([
         ['cycle_number', odict([])],
@@ -1270,6 +1725,62 @@ class RasterPixc(Product):
         raster_pixc.geospatial_lon_max = max(lons)
         return raster_pixc
 
+    def to_npy_dir(self, out_dir):
+        """Writes self to a directory with a header.json of the attributes
+           and one raw .npy file per variable (plus a .mask.npy file for
+           masked variables), which from_npy_dir can memory map"""
+        os.makedirs(out_dir, exist_ok=True)
+        header = {'attributes': get_product_attributes(self), 'groups': {}}
+        for group in self.GROUPS:
+            group_dir = os.path.join(out_dir, group)
+            os.makedirs(group_dir, exist_ok=True)
+            group_product = self[group]
+            variables = [name for name in group_product.VARIABLES
+                         if name in group_product.variables]
+            header['groups'][group] = {
+                'attributes': get_product_attributes(group_product),
+                'variables': variables}
+            for name in variables:
+                values = group_product[name]
+                # np.save writes the array buffers without copying them
+                np.save(os.path.join(group_dir, name + NPY_EXT),
+                        np.ma.getdata(values), allow_pickle=False)
+                mask = np.ma.getmask(values)
+                if mask is not np.ma.nomask and mask.any():
+                    np.save(os.path.join(group_dir, name + NPY_MASK_EXT),
+                            mask, allow_pickle=False)
+
+        with open(os.path.join(out_dir, NPY_HEADER_FILE), 'w') as header_fp:
+            json.dump(header, header_fp, indent=4, default=to_json)
+
+    @classmethod
+    def from_npy_dir(cls, in_dir, mmap_mode='c'):
+        """Reads a directory written by to_npy_dir with its variables
+           memory mapped. The default copy-on-write mode lets callers modify
+           the arrays without changing the files."""
+        with open(os.path.join(in_dir, NPY_HEADER_FILE), 'r') as header_fp:
+            header = json.load(header_fp)
+
+        raster_pixc = cls()
+        for name, value in header['attributes'].items():
+            setattr(raster_pixc, name, value)
+
+        for group, group_header in header['groups'].items():
+            group_product = globals()[cls.GROUPS[group]]()
+            for name, value in group_header['attributes'].items():
+                setattr(group_product, name, value)
+            for name in group_header['variables']:
+                values = np.load(os.path.join(in_dir, group, name + NPY_EXT),
+                                 mmap_mode=mmap_mode, allow_pickle=False)
+                mask_file = os.path.join(in_dir, group, name + NPY_MASK_EXT)
+                if os.path.exists(mask_file):
+                    values = np.ma.masked_array(
+                        values, mask=np.load(mask_file, mmap_mode=mmap_mode,
+                                             allow_pickle=False))
+                group_product[name] = values
+            raster_pixc[group] = group_product
+        return raster_pixc
+
     def __add__(self, other):
         """Adds other to self"""
         klass = RasterPixc()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2017-, California Institute of Technology ("Caltech"). U.S.
+Government sponsorship acknowledged.
+All rights reserved.
+
+Author(s): Alexander Corben
+'''
+
+import os
+import glob
+import time
+import logging
+import argparse
+import socketserver
+
+from pixc_to_raster import load_raster_configs
+from batch_pixc_to_raster import run_job, parse_job_line
+
+LOGGER = logging.getLogger(__name__)
+
+description = """
+description:
+    raster_worker.py is a resident rasterization worker. It imports the
+    raster processing stack and parses the config files once, then serves
+    jobs from a local queue until it is stopped. Each job runs exactly as
+    pixc_to_raster.py would with the same config files.
+
+job format:
+    A single line with the same fields as a batch manifest line:
+        pixc_file  pixcvec_file  out_file
+    Use '-' as the pixcvec_file for jobs without a pixcvec.
+
+spool directory queue (--spool_dir):
+    Jobs are files named *.job in the spool directory, processed in name
+    order. A job is claimed by renaming it to *.running, and on completion
+    it is renamed to *.done or *.failed with the output path or the error
+    appended as a last line.
+
+unix socket queue (--socket):
+    Clients connect, send one job line and read back one reply line:
+        done <out_file>   or   failed <error>
+"""
+
+SPOOL_JOB_EXT = '.job'
+SPOOL_RUNNING_EXT = '.running'
+SPOOL_DONE_EXT = '.done'
+SPOOL_FAILED_EXT = '.failed'
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description = description)
+    parser.add_argument("alg_config_file", type=str,
+                        help='raster algorithmic config file')
+    parser.add_argument("runtime_config_file", type=str,
+                        help='raster runtime config file')
+    queue = parser.add_mutually_exclusive_group(required=True)
+    queue.add_argument("-sd", "--spool_dir", type=str, default=None,
+                       help='spool directory to take *.job files from')
+    queue.add_argument("-s", "--socket", type=str, default=None,
+                       help='unix socket path to serve jobs on')
+    parser.add_argument("--poll_interval", type=float, default=1.0,
+                        help='seconds between spool directory scans')
+    args = parser.parse_args()
+
+    alg_cfg, rt_cfg = load_raster_configs(args.alg_config_file,
+                                          args.runtime_config_file)
+    worker = RasterWorker(alg_cfg, rt_cfg)
+
+    if args.spool_dir is not None:
+        worker.serve_spool_dir(args.spool_dir,
+                               poll_interval=args.poll_interval)
+    else:
+        worker.serve_socket(args.socket)
+
+
+class RasterWorker(object):
+    '''Runs rasterization jobs in a long-lived process'''
+    def __init__(self, alg_cfg, rt_cfg):
+        self.alg_cfg = alg_cfg
+        self.rt_cfg = rt_cfg
+
+    def run(self, job_line):
+        """Runs a job given as a job line and returns its result"""
+        job = parse_job_line(job_line)
+        LOGGER.info('Running job for {}'.format(job[0]))
+        result = run_job(job, self.alg_cfg, self.rt_cfg)
+        LOGGER.info('Job {} in {:.3f} s: {}'.format(
+            result['status'], result['elapsed'], result['out_file']))
+        return result
+
+    def serve_spool_dir(self, spool_dir, poll_interval=1.0):
+        """Processes *.job files from spool_dir until interrupted"""
+        LOGGER.info('Serving jobs from spool directory {}'.format(spool_dir))
+        while True:
+            job_files = sorted(glob.glob(
+                os.path.join(spool_dir, '*' + SPOOL_JOB_EXT)))
+            if not job_files:
+                time.sleep(poll_interval)
+                continue
+
+            for job_file in job_files:
+                base_file = job_file[:-len(SPOOL_JOB_EXT)]
+                running_file = base_file + SPOOL_RUNNING_EXT
+                try:
+                    # Claim the job, another worker may have been faster
+                    os.rename(job_file, running_file)
+                except FileNotFoundError:
+                    continue
+
+                with open(running_file, 'r') as job_fp:
+                    job_line = job_fp.read()
+
+                result = self._run_safe(job_line)
+                if result['status'] == 'done':
+                    reply, finished_file = (result['out_file'],
+                                            base_file + SPOOL_DONE_EXT)
+                else:
+                    reply, finished_file = (result['error'],
+                                            base_file + SPOOL_FAILED_EXT)
+
+                with open(running_file, 'a') as job_fp:
+                    job_fp.write('\n' + str(reply) + '\n')
+                os.rename(running_file, finished_file)
+
+    def serve_socket(self, socket_path):
+        """Serves jobs on a unix socket until interrupted"""
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        worker = self
+        class JobHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                job_line = self.rfile.readline().decode()
+                result = worker._run_safe(job_line)
+                if result['status'] == 'done':
+                    reply = 'done {}'.format(result['out_file'])
+                else:
+                    reply = 'failed {}'.format(result['error'])
+                self.wfile.write((reply + '\n').encode())
+
+        LOGGER.info('Serving jobs on unix socket {}'.format(socket_path))
+        with socketserver.UnixStreamServer(socket_path, JobHandler) as server:
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(socket_path)
+
+    def _run_safe(self, job_line):
+        # Bad job lines should not bring down the worker
+        try:
+            return self.run(job_line)
+        except ValueError as exception:
+            LOGGER.error('Invalid job: {}'.format(exception))
+            return {'status': 'failed', 'error': repr(exception),
+                    'out_file': None, 'elapsed': 0}
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+'''
+Copyright (c) 2020-, California Institute of Technology ("Caltech"). U.S.
+Government sponsorship acknowledged.
+All rights reserved.
+
+Author(s): Alexander Corben
+'''
+
+import os
+import json
+import zlib
+import shutil
+import logging
+import numpy as np
+
+from collections import OrderedDict as odict
+from raster_json import to_json
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger(__name__)
+
+ZARR_FORMAT = 2
+ZARR_BAND_ROWS = 256
+ZARR_CHUNK_COLS = 1024
+ZARR_COMPLEVEL = 4
+
+def write_json(filename, obj):
+    with open(filename, 'w') as json_fp:
+        json.dump(obj, json_fp, indent=4, default=to_json)
+
+def get_zarr_fill_value(fill_value):
+    # zarr v2 stores NaN fill values as a string
+    if isinstance(fill_value, float) and np.isnan(fill_value):
+        return 'NaN'
+    return fill_value
+
+
+class ZarrRasterWriter(object):
+    '''Writes a raster product as a zarr (v2) directory store, one row band
+       at a time
+
+       Each variable is split into chunks of band_rows rows and chunk_cols
+       columns, so the chunks of a band do not depend on any other band. The
+       chunks are compressed (zlib) and written by a thread pool while the
+       next band is rasterized. Chunks that are entirely masked are not
+       written and read back as the fill value.'''
+    def __init__(self, out_dir, band_rows=ZARR_BAND_ROWS,
+                 chunk_cols=ZARR_CHUNK_COLS, complevel=ZARR_COMPLEVEL,
+                 num_threads=4):
+        self.out_dir = out_dir
+        self.band_rows = band_rows
+        self.chunk_cols = chunk_cols
+        self.complevel = complevel
+        self.num_threads = num_threads
+        self.executor = None
+        self.futures = []
+        self.variables = odict()
+        self.earliest_band = None
+
+    def open(self, empty_product):
+        """Creates the store with the attributes and coordinates of an empty
+           (unpopulated) product of the full raster, replacing any existing
+           store in out_dir"""
+        from raster_products import SparseRaster, get_fill_value, \
+            get_product_attributes
+        # e.g. a partial store left by a failed run
+        if os.path.isdir(self.out_dir):
+            LOGGER.info('Removing existing store {}'.format(self.out_dir))
+            shutil.rmtree(self.out_dir)
+        os.makedirs(self.out_dir)
+        write_json(os.path.join(self.out_dir, '.zgroup'),
+                   {'zarr_format': ZARR_FORMAT})
+
+        product_class = type(empty_product)
+        write_json(os.path.join(self.out_dir, '.zattrs'),
+                   get_product_attributes(empty_product))
+
+        x_dim, y_dim = list(product_class.DIMENSIONS.keys())
+        self.shape = (empty_product.dimensions[y_dim],
+                      empty_product.dimensions[x_dim])
+        for dim in [x_dim, y_dim]:
+            coordinate = np.asarray(empty_product[dim])
+            self._create_array(dim, product_class.VARIABLES[dim],
+                               coordinate.shape, coordinate.shape, [dim],
+                               get_fill_value(coordinate.dtype))
+            self._write_chunk(dim, '0', coordinate)
+
+        self._create_array('crs', product_class.VARIABLES['crs'], [], [], [],
+                           0, dtype='|i1')
+
+        self.chunk_shape = (self.band_rows, min(self.chunk_cols, self.shape[1]))
+        for name in SparseRaster.get_raster_variables(product_class):
+            dtype = np.dtype(product_class.VARIABLES[name]['dtype'])
+            self.variables[name] = (dtype, get_fill_value(dtype))
+            self._create_array(name, product_class.VARIABLES[name],
+                               self.shape, self.chunk_shape, [y_dim, x_dim],
+                               get_fill_value(dtype))
+
+        self.executor = ThreadPoolExecutor(self.num_threads)
+
+    def write_band(self, band_product, band_start):
+        """Queues the chunks of a band product starting at row band_start"""
+        if band_start % self.band_rows != 0:
+            raise ValueError('Band start {} is not a multiple of {}'.format(
+                band_start, self.band_rows))
+        self._update_tai_utc_difference(band_product)
+
+        chunk_row = band_start // self.band_rows
+        for name, (dtype, fill_value) in self.variables.items():
+            if name not in band_product.variables:
+                continue
+            data = np.ma.asarray(band_product[name])
+            self.futures.append(self.executor.submit(
+                self._write_band_chunks, name, chunk_row, data, dtype,
+                fill_value))
+
+        # Limit the number of bands waiting to be written
+        max_pending = 2*self.num_threads*max(len(self.variables), 1)
+        while len(self.futures) > max_pending:
+            self.futures.pop(0).result()
+
+    def close(self):
+        """Waits for all chunks to be written and finishes the store"""
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.executor.shutdown()
+            self.futures = []
+
+        if self.earliest_band is not None \
+           and 'illumination_time' in self.variables:
+            attrs_file = os.path.join(self.out_dir, 'illumination_time',
+                                      '.zattrs')
+            with open(attrs_file, 'r') as attrs_fp:
+                attrs = json.load(attrs_fp)
+            attrs['tai_utc_difference'] = self.earliest_band[1]
+            write_json(attrs_file, attrs)
+
+    def _update_tai_utc_difference(self, band_product):
+        # The product value comes from the earliest pixel in the raster
+        if 'illumination_time' not in band_product.variables:
+            return
+        illumination_time = np.ma.asarray(band_product['illumination_time'])
+        if illumination_time.count() == 0:
+            return
+        min_time = illumination_time.min()
+        if self.earliest_band is None or min_time < self.earliest_band[0]:
+            self.earliest_band = (min_time, band_product.VARIABLES[
+                'illumination_time'].get('tai_utc_difference'))
+
+    def _write_band_chunks(self, name, chunk_row, data, dtype, fill_value):
+        chunk_rows, chunk_cols = self.chunk_shape
+        for chunk_col, col_start in enumerate(
+                range(0, data.shape[1], chunk_cols)):
+            chunk = data[:, col_start:col_start + chunk_cols]
+            if np.ma.getmaskarray(chunk).all():
+                continue
+            # Edge chunks are padded to the full chunk shape
+            padded = np.full(self.chunk_shape, fill_value, dtype=dtype)
+            padded[:chunk.shape[0], :chunk.shape[1]] = np.ma.filled(
+                chunk.astype(dtype), fill_value)
+            self._write_chunk(name, '{}.{}'.format(chunk_row, chunk_col),
+                              padded)
+
+    def _write_chunk(self, name, chunk_key, values):
+        data = zlib.compress(np.ascontiguousarray(values).tobytes(),
+                             self.complevel)
+        with open(os.path.join(self.out_dir, name, chunk_key), 'wb') as chunk_fp:
+            chunk_fp.write(data)
+
+    def _create_array(self, name, definition, shape, chunks, dimensions,
+                      fill_value, dtype=None):
+        if dtype is None:
+            dtype = np.dtype(definition['dtype']).str
+        os.makedirs(os.path.join(self.out_dir, name))
+        write_json(os.path.join(self.out_dir, name, '.zarray'),
+                   {'zarr_format': ZARR_FORMAT,
+                    'shape': list(shape),
+                    'chunks': list(chunks),
+                    'dtype': dtype,
+                    'compressor': {'id': 'zlib', 'level': self.complevel},
+                    'fill_value': get_zarr_fill_value(fill_value),
+                    'filters': None,
+                    'order': 'C'})
+
+        # _ARRAY_DIMENSIONS names the dimensions for xarray
+        attributes = odict([[key, value] for key, value in definition.items()
+                            if key not in ['dtype', 'dimensions']])
+        attributes['_ARRAY_DIMENSIONS'] = dimensions
+        write_json(os.path.join(self.out_dir, name, '.zattrs'), attributes)
@@ -9,39 +9,46 @@ Author(s): Brent Williams
 import numpy as np
 import matplotlib.pyplot as plt
 import mpl_scatter_density
-from metrics import compute_metrics_from_error
-from collections import Counter
+from metrics import compute_metrics_from_error, compute_segmented_metrics
 
 def get_top_sources(x_in, y_in, sources_in, bins_x, bins_y, n=3):
     """
     gets the n top sources for data in each bin
     assumes bin edges are in increasing order
     """
-    mapped_data = []
-    out_vals = []
-    out_pcts = []
-    for i in range(0, len(bins_x)):
-        mapped_data.append([])
-        out_vals.append([])
-        out_pcts.append([])
-        for j in range(0, len(bins_y)):
-            mapped_data[i].append([])
-            out_vals[i].append([])
-            out_pcts[i].append([])
-
-    for idx in range(0, len(x_in)):
-        bin_x = np.searchsorted(bins_x, x_in[idx])-1
-        bin_y = np.searchsorted(bins_y, y_in[idx])-1
-        mapped_data[bin_x][bin_y].append(sources_in[idx])
-
-    for i in range(0, len(bins_x)):
-        for j in range(0, len(bins_y)):
-            bin_data = mapped_data[i][j]
-            c = Counter(bin_data)
-            common_vals = c.most_common(n)
-            out_vals[i][j] = [this_tup[0] for this_tup in common_vals]
-            counts = [this_tup[1] for this_tup in common_vals]
-            out_pcts[i][j] = [100*this_count/len(bin_data) for this_count in counts]
+    num_x, num_y = len(bins_x), len(bins_y)
+    out_vals = [[[] for j in range(num_y)] for i in range(num_x)]
+    out_pcts = [[[] for j in range(num_y)] for i in range(num_x)]
+    if len(x_in) == 0:
+        return out_vals, out_pcts
+
+    # bin index of each sample, values at or below the first edge wrap
+    # around to the last bin
+    bin_x = (np.searchsorted(bins_x, x_in) - 1) % num_x
+    bin_y = (np.searchsorted(bins_y, y_in) - 1) % num_y
+    bin_idx = bin_x * num_y + bin_y
+
+    # count each (bin, source) pair, keeping the first sample of each pair
+    # so ties are ordered as Counter orders them
+    source_vals, source_idx = np.unique(
+        np.asarray(sources_in)[:len(x_in)], return_inverse=True)
+    keys = bin_idx * len(source_vals) + source_idx.ravel()
+    keys, first_idx, counts = np.unique(keys, return_index=True,
+                                        return_counts=True)
+    key_bins = keys // len(source_vals)
+    key_sources = keys % len(source_vals)
+    bin_counts = np.bincount(bin_idx, minlength=num_x*num_y)
+
+    # rank the pairs of each bin by count, then by first sample
+    order = np.lexsort((first_idx, -counts, key_bins))
+    key_bins = key_bins[order]
+    bin_starts = np.searchsorted(key_bins, key_bins)
+    top = np.arange(len(order)) - bin_starts < n
+    for this_bin, this_source, this_count in zip(
+            key_bins[top], key_sources[order][top], counts[order][top]):
+        i, j = divmod(this_bin, num_y)
+        out_vals[i][j].append(source_vals[this_source])
+        out_pcts[i][j].append(100*this_count/bin_counts[this_bin])
     return out_vals, out_pcts
 
 def make_format(bins_x, bins_y, top_sources, top_source_pcts):
@@ -64,34 +71,123 @@ def make_format(bins_x, bins_y, top_sources, top_source_pcts):
         return format_str
     return format_coord
 
+def get_bin_segments(x, bin_edges):
+    """
+    gets the (inclusive) bins of each sample, a sample on an edge shared by
+    two bins is in both. returns the sample index and bin of each
+    (sample, bin) pair
+    """
+    # bins [first, last) with start <= x <= stop
+    first = np.searchsorted(bin_edges[1:], x, side='left')
+    last = np.searchsorted(bin_edges[:-1], x, side='right')
+    num_bins = np.maximum(last - first, 0)
+    sample_idx = np.repeat(np.arange(len(x)), num_bins)
+    offsets = np.cumsum(num_bins) - num_bins
+    bin_idx = first[sample_idx] + np.arange(len(sample_idx)) \
+              - offsets[sample_idx]
+    return sample_idx, bin_idx
+
+def get_binned_metrics(x, y, bin_edges, uncert=None):
+    """
+    gets the 50%-ile and |68|%-ile of y and the median and mean of uncert
+    in each x bin (edges inclusive), sorting the samples once for all bins
+    """
+    # masked samples are NaN, so they are left out of every bin
+    x = np.ma.filled(np.ma.asarray(x, dtype=float), np.nan)
+    y = np.ma.filled(np.ma.asarray(y, dtype=float), np.nan)
+    bin_edges = np.asarray(bin_edges)
+    num_bins = len(bin_edges) - 1
+    sample_idx, bin_idx = get_bin_segments(x, bin_edges)
+    metrics, = compute_segmented_metrics(y[sample_idx], bin_idx, num_bins)
+    if uncert is None:
+        return metrics['50_pct'], metrics['|68_pct|'], np.array([]), \
+            np.array([])
+    uncert = np.ma.filled(np.ma.asarray(uncert, dtype=float), np.nan)
+    uncert_metrics, = compute_segmented_metrics(uncert[sample_idx], bin_idx,
+                                                num_bins)
+    return metrics['50_pct'], metrics['|68_pct|'], uncert_metrics['mean'], \
+        uncert_metrics['50_pct']
+
+def scatter_image(x_in, y_in, fig=None, cmap='jet'):
+    """
+    plot the points as an image of the number of points in each pixel
+    (mpl_scatter_density), so drawing does not depend on the number of
+    points. pixels without points are left blank. returns the axes
+    """
+    msk = ~np.logical_or(np.ma.getmaskarray(x_in), np.ma.getmaskarray(y_in))
+    x = np.ma.getdata(x_in)[msk]
+    y = np.ma.getdata(y_in)[msk]
+    if fig is None:
+        fig = plt.gcf()
+    cmap = plt.get_cmap(cmap).copy()
+    cmap.set_under('white')
+    ax = fig.add_subplot(1, 1, 1, projection='scatter_density')
+    density = ax.scatter_density(x, y, cmap=cmap, vmin=0.5)
+    fig.colorbar(density, label='num points per pixel')
+    if len(x) > 0:
+        ax.set_xlim((np.min(x), np.max(x)))
+        ax.set_ylim((np.min(y), np.max(y)))
+    return ax
+
+def get_bin_edges(data, bins, exclude_outliers=False):
+    """
+    gets the bin edges of data, bins is a number of edges or the edges.
+    excluding outliers sets the extent from the data with |data| below its
+    95%-ile, keeping the number of edges
+    """
+    if isinstance(bins, int):
+        bins = np.linspace(np.min(data), np.max(data), bins)
+    if exclude_outliers:
+        msk = np.abs(data)<np.percentile(np.abs(data),95)
+        bins = np.linspace(np.min(data[msk]), np.max(data[msk]), len(bins))
+    return bins
+
+def get_bin_index(data, bin_edges):
+    """
+    gets the histogram bin of each sample, -1 outside of the edges
+    the last bin includes its upper edge, as in np.histogram
+    """
+    bin_idx = np.searchsorted(bin_edges, data, side='right') - 1
+    bin_idx[np.asarray(data) == bin_edges[-1]] = len(bin_edges) - 2
+    bin_idx[bin_idx >= len(bin_edges) - 1] = -1
+    return bin_idx
+
+def histogram2d_from_index(bin_idx_y, bin_idx_x, num_bins_y, num_bins_x):
+    """
+    gets the 2d histogram (as np.histogram2d) of samples from their bins
+    along each axis, so axis bins can be shared by several histograms
+    """
+    msk = np.logical_and(bin_idx_y >= 0, bin_idx_x >= 0)
+    h = np.bincount(bin_idx_y[msk]*num_bins_x + bin_idx_x[msk],
+                    minlength=num_bins_y*num_bins_x)
+    return h.reshape((num_bins_y, num_bins_x)).astype(float)
+
 def scatter_density(x_in, y_in,
-        uncert=None, bin_edges=100, source=None, cmap='jet', exclude_outliers=True):
+        uncert=None, bin_edges=100, source=None, cmap='jet', exclude_outliers=True,
+        hist=None):
     """
     plot a 2d histogram with 50%-ile and |68|%-tile
+    hist is an optional precomputed (histogram, y-bin edges, x-bin edges) of
+    the data, see histogram2d_from_index. returns the figure
     """
     if len(y_in)<=0:
         # dont try to plot empty arrays
         return
     x = x_in
     y = y_in
-    # setup customized limits
-    if isinstance(bin_edges, int):
-        binsy = np.linspace(np.min(y_in), np.max(y_in), bin_edges)
-        binsx = np.linspace(np.min(x_in), np.max(x_in), bin_edges)
-    else:
-        binsy, binsx = bin_edges
-    if isinstance(binsy, int):
-        binsy = np.linspace(np.min(y_in), np.max(y_in), binsy)
-    if isinstance(binsx, int):
-        binsx = np.linspace(np.min(x_in), np.max(x_in), binsx)
-    if exclude_outliers:
+    if hist is None:
+        # setup customized limits
+        if isinstance(bin_edges, int):
+            binsy, binsx = bin_edges, bin_edges
+        else:
+            binsy, binsx = bin_edges
         # this only excludes outliers for choosing the y-bin extents
-        msk = np.abs(y_in)<np.percentile(np.abs(y_in),95)
-        num_binsy = len(binsy)
-        binsy = binsy = np.linspace(
-            np.min(y_in[msk]), np.max(y_in[msk]), num_binsy)
-    # generate the 2d histogram and plot
-    h, by, bx = np.histogram2d(y, x, bins=(binsy, binsx))
+        binsy = get_bin_edges(y_in, binsy, exclude_outliers=exclude_outliers)
+        binsx = get_bin_edges(x_in, binsx)
+        # generate the 2d histogram and plot
+        h, by, bx = np.histogram2d(y, x, bins=(binsy, binsx))
+    else:
+        h, binsy, binsx = hist
 
     # aggregate the data sources if provided
     if source is not None:
@@ -107,28 +203,8 @@ def scatter_density(x_in, y_in,
     plt.colorbar(label='dB num points')
 
     # plot the 50%-ile and |68|%-ile
-    p50 = []
-    p68 = []
-    unc = []
-    unc_med = []
-    for start, stop in zip(binsx[:-1],binsx[1:]):
-        msk = np.logical_and(x>=start, x<=stop)
-        this_y = y[msk]
-        metrics = compute_metrics_from_error(this_y)
-        p50.append(metrics['50_pct'])
-        p68.append(metrics['|68_pct|'])
-        if uncert is not None:
-            if len(uncert[msk])>0:
-                unc_med.append(np.nanmedian(uncert[msk]))
-                unc.append(np.nanmean(uncert[msk]))
-            else:
-                unc_med.append(np.nan)
-                unc.append(np.nan)
+    p50, p68, unc, unc_med = get_binned_metrics(x, y, binsx, uncert=uncert)
     metrics = compute_metrics_from_error(y)
-    p50 = np.array(p50)
-    p68 = np.array(p68)
-    unc = np.array(unc)
-    unc_med = np.array(unc_med)
 
     binsx_cen = binsx[:-1] + (binsx[1]-binsx[0]) / 2.0
     ax.plot(binsx_cen, p50,'--k')
@@ -153,3 +229,4 @@ def scatter_density(x_in, y_in,
     # Add sources to cursor string format
     if source is not None:
         ax.format_coord = make_format(binsx, binsy, top_sources, top_source_pcts)
+    return fig